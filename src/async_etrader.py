@@ -0,0 +1,425 @@
+import asyncio
+import json
+import random
+import time
+from collections import deque
+from datetime import datetime
+from hashlib import sha1
+from threading import Thread
+
+import aiohttp
+from rauth.oauth import HmacSha1Signature
+from rauth.utils import OAuth1Auth
+
+import credentials as cd
+import constants as ct
+from logger import Logger
+from fills import FillSync, parse_fill
+from etrader import ORDER_TEMPLATE, PREVIEW_TEMPLATE, PLACE_TEMPLATE, parse_quotes, parse_preview_id, parse_place
+from transport import CircuitBreaker, EndpointStats, backoff
+
+log = Logger.get('async_etrader')
+
+
+class Response(object):
+    """
+    Status and body of a finished request (what ETrader's parsing needs of a requests.Response).
+    """
+    __slots__ = ('status_code', 'text')
+
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text) if len(self.text) > 0 else None
+
+
+class OAuth1Signer(object):
+    """
+    Signs requests (HMAC-SHA1, in the Authorization header) with the tokens
+    of an authenticated session, the same way rauth does.
+    """
+    def __init__(self, consumer_key: str, consumer_secret: str, access_token: str, access_token_secret: str):
+        self.__consumer_key = consumer_key
+        self.__consumer_secret = consumer_secret
+        self.__access_token = access_token
+        self.__access_token_secret = access_token_secret
+        self.__signature = HmacSha1Signature()
+
+    def header(self, method: str, url: str, params: dict = None) -> str:
+        """
+        Returns Authorization header for a request of method to url with query params.
+        """
+        oauth_params = {
+            'oauth_consumer_key': self.__consumer_key,
+            'oauth_nonce': sha1(str(random.random()).encode('ascii')).hexdigest(),
+            'oauth_signature_method': self.__signature.NAME,
+            'oauth_timestamp': int(time.time()),
+            'oauth_token': self.__access_token,
+            'oauth_version': '1.0',
+        }
+        oauth_params['oauth_signature'] = self.__signature.sign(self.__consumer_secret, self.__access_token_secret, method, url, oauth_params, {'params': params or {}, 'headers': {}})
+        return OAuth1Auth(oauth_params)._get_auth_header()
+
+
+class AsyncTransport(object):
+    """
+    asyncio counterpart of transport.Transport: same timeouts, retries,
+    circuit breaker & stats, plus a semaphore bounding requests in flight.
+    Must be started (and used) on one event loop.
+    """
+    def __init__(self, signer: OAuth1Signer = None, concurrency: int = None, timeouts: dict = None, retries: int = None, breaker: CircuitBreaker = None):
+        self.__signer = signer
+        self.__concurrency = ct.ASYNC_MAX_CONCURRENCY if concurrency is None else concurrency
+        self.__timeouts = ct.HTTP_TIMEOUTS if timeouts is None else timeouts
+        self.__retries = ct.HTTP_RETRIES if retries is None else retries
+        self.breaker = CircuitBreaker(ct.BREAKER_FAILURES, ct.BREAKER_COOLDOWN) if breaker is None else breaker
+        self.__stats = EndpointStats()
+        self.__session = None
+        self.__semaphore = None
+
+    async def start(self) -> None:
+        self.__semaphore = asyncio.Semaphore(self.__concurrency)
+        # as many kept-alive connections as requests we let out at once
+        self.__session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.__concurrency))
+
+    async def close(self) -> None:
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def get(self, endpoint: str, url: str, params: dict = None, headers: dict = None) -> Response:
+        return await self.request('GET', endpoint, url, params=params, headers=headers)
+
+    async def post(self, endpoint: str, url: str, data: str = None, headers: dict = None) -> Response:
+        return await self.request('POST', endpoint, url, data=data, headers=headers)
+
+    async def request(self, method: str, endpoint: str, url: str, params: dict = None, headers: dict = None, data: str = None) -> Response:
+        """
+        Sends request, retrying what can be retried.
+
+        :returns: Response or None
+        """
+        connect, read = self.__timeouts.get(endpoint, (None, None))
+        timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        idempotent = endpoint not in {'place'}
+        response = None
+
+        for attempt in range(self.__retries + 1):
+            if not self.breaker.allow():
+                self.__stats.count(endpoint, EndpointStats.SHORT_CIRCUITED)
+                log.warn('Not calling %s: broker calls are on hold', endpoint)
+                return response
+
+            request_headers = dict(headers) if headers is not None else {}
+            if self.__signer is not None:
+                request_headers['Authorization'] = self.__signer.header(method, url, params)
+
+            error = None
+            async with self.__semaphore:
+                start = time.perf_counter()
+                try:
+                    async with self.__session.request(method, url, params=params, headers=request_headers, data=data, timeout=timeout) as raw:
+                        response = Response(raw.status, await raw.text())
+                except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                    response = None
+                    error = ex
+                self.__stats.record(endpoint, time.perf_counter() - start)
+
+            if error is None and response.status_code < 500:
+                self.breaker.success()
+                return response
+
+            self.breaker.failure()
+            if error is None:
+                retry = idempotent
+                log.warn('%s returned %s (attempt %d)', endpoint, response.status_code, attempt + 1)
+            else:
+                # a timed out read may have placed the order already
+                retry = idempotent or isinstance(error, (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError))
+                log.warn('%s failed: %r (attempt %d)', endpoint, error, attempt + 1)
+
+            if not retry or attempt == self.__retries:
+                break
+
+            self.__stats.count(endpoint, EndpointStats.RETRIES)
+            await asyncio.sleep(backoff(attempt))
+
+        self.__stats.count(endpoint, EndpointStats.FAILED)
+        log.warn('Giving up on %s after %d attempts', endpoint, attempt + 1)
+        return response
+
+    def stats(self) -> dict:
+        return {'breaker': self.breaker.state, 'endpoints': self.__stats.as_dict()}
+
+
+class AsyncETrader(object):
+    """
+    asyncio-native broker client with ETrader's operations. Requests of
+    concurrent calls share one connection pool and are bounded by
+    ASYNC_MAX_CONCURRENCY instead of needing a thread each.
+    """
+    # dump order payloads & broker responses (costly on the order path)
+    DEBUG = False
+
+    def __init__(self, signer: OAuth1Signer = None, concurrency: int = None):
+        self.__headers = {"Content-Type": "application/xml", "consumerKey": cd.CONSUMER_KEY}
+        # (symbol, preview seconds, preview->place seconds) of recent orders
+        self.order_timings = deque(maxlen=1000)
+        # fills seen so far, to report only what changed
+        self.__fill_sync = FillSync()
+        self.__transport = AsyncTransport(signer, concurrency)
+
+    @staticmethod
+    def from_session(session, concurrency: int = None) -> 'AsyncETrader':
+        """
+        Returns client signing with the tokens of an authenticated rauth session
+        (unsigned if it has none, e.g. one pointed at a stub broker).
+        """
+        secret = getattr(session, 'consumer_secret', None)
+        signer = None if secret is None else OAuth1Signer(session.consumer_key, secret, session.access_token, session.access_token_secret)
+        return AsyncETrader(signer, concurrency)
+
+    async def start(self) -> None:
+        await self.__transport.start()
+
+    async def close(self) -> None:
+        await self.__transport.close()
+
+    @property
+    def transport(self) -> AsyncTransport:
+        return self.__transport
+
+    async def get_ticker_price(self, ticker: str) -> float:
+        """
+        Gets the latest price for the given ticker: -1 if it has no quote,
+        None if the request failed.
+        """
+        response = await self.__transport.get('quote', cd.BASE_URL + "/v1/market/quote/" + ticker + ".json")
+
+        if response is not None and response.status_code == 200:
+            prices = parse_quotes(response.json())
+
+            if len(prices) > 0:
+                return next(iter(prices.values()))
+
+            log.warn('Could not retrive price for ticker %s', ticker)
+            return -1
+
+    async def get_ticker_prices(self, tickers: list) -> dict:
+        """
+        Gets the latest prices for the given tickers; batches of
+        QUOTE_BATCH_SIZE symbols are requested concurrently.
+
+        :returns: dict of ticker -> price (-1 for tickers without a quote, None for
+                  tickers whose request failed)
+        """
+        tickers = list(dict.fromkeys(tickers))
+        chunks = [tickers[i:i + ct.QUOTE_BATCH_SIZE] for i in range(0, len(tickers), ct.QUOTE_BATCH_SIZE)]
+        prices = {}
+        # tickers of requests that failed; we don't know if they have a quote
+        failed = set()
+
+        async def fetch(chunk: list):
+            # above 25 symbols the broker wants us to acknowledge the larger batch
+            params = {"overrideSymbolCount": "true"} if len(chunk) > 25 else None
+            response = await self.__transport.get('quote', cd.BASE_URL + "/v1/market/quote/" + ",".join(chunk) + ".json", params=params)
+
+            if response is not None and response.status_code == 200:
+                prices.update(parse_quotes(response.json()))
+            else:
+                log.warn('Could not retrieve quotes for %d tickers', len(chunk))
+                failed.update(chunk)
+
+        await asyncio.gather(*[fetch(chunk) for chunk in chunks])
+
+        for ticker in tickers:
+            if ticker not in prices:
+                log.warn('Could not retrive price for ticker %s', ticker)
+                prices[ticker] = None if ticker in failed else -1
+
+        return prices
+
+    async def __get_fills(self, from_date: str = None) -> list:
+        """
+        Returns Fill objects of INDIVIDUAL_FILLS orders, newest first.
+        """
+        url = cd.BASE_URL + "/v1/accounts/" + cd.ACCOUNT_ID_KEY + "/orders.json"
+        headers = {"consumerkey": cd.CONSUMER_KEY}
+        params = {"status": "INDIVIDUAL_FILLS", "count": str(ct.ORDERS_PAGE_SIZE)}
+
+        if from_date is not None:
+            params['fromDate'] = from_date
+            params['toDate'] = datetime.now().strftime('%m%d%Y')
+
+        fills = []
+        # pages depend on the marker of the previous one, so they come one by one
+        while True:
+            response = await self.__transport.get('orders', url, params=params, headers=headers)
+
+            if response is None or response.status_code == 204:
+                return fills
+            elif response.status_code != 200:
+                log.warn('Invalid status code; response: %s', response.text)
+                return fills
+
+            parsed = response.json()
+            if parsed is None or 'OrdersResponse' not in parsed or 'Order' not in parsed['OrdersResponse']:
+                return fills
+
+            for order in parsed['OrdersResponse']['Order']:
+                fill = parse_fill(order)
+                if fill is not None:
+                    fills.append(fill)
+
+            marker = parsed['OrdersResponse'].get('marker')
+            if not marker:
+                return fills
+            log.debug('Retrieving for marker %s', marker)
+            params['marker'] = marker
+
+    async def get_filled_orders(self) -> dict:
+        """
+        Returns a dict of ticker -> (share no., value) over the whole order history.
+        """
+        positions = {}
+        for fill in await self.__get_fills():
+            position = positions.setdefault(fill.symbol, [0, 0.0])
+            position[0] += fill.shares
+            position[1] += fill.value
+        return {ticker: (shares, value) for ticker, (shares, value) in positions.items()}
+
+    async def sync_filled_orders(self) -> (list, bool):
+        """
+        Fetches only fills newer than the last sync.
+
+        :returns: tuple of Fill deltas (oldest first) and whether they cover the whole order history
+        """
+        synced_at = time.time()
+        complete = self.__fill_sync.from_date is None
+        deltas = []
+
+        for fill in await self.__get_fills(self.__fill_sync.from_date):
+            delta = self.__fill_sync.apply(fill)
+            if delta is not None:
+                deltas.append(delta)
+
+        self.__fill_sync.advance(synced_at)
+        deltas.reverse()
+        return deltas, complete
+
+    async def preview_order(self, price_type: str, order_term: str, limit_price: str, symbol: str, order_action: str, quantity: int, client_order_id: int = None) -> (int, str):
+        """
+        Returns preview_id and order_html if successful. Otherwise, it returns (0, '').
+        """
+        url = cd.BASE_URL + "/v1/accounts/" + cd.ACCOUNT_ID_KEY + "/orders/preview.json"
+
+        if client_order_id is None:
+            client_order_id = random.randint(1000000000, 9999999999)
+
+        order_html = ORDER_TEMPLATE.format(price_type=price_type, order_term=order_term, limit_price=limit_price, symbol=symbol, order_action=order_action, quantity=quantity)
+        payload = PREVIEW_TEMPLATE.format(client_order_id=client_order_id, order_html=order_html)
+
+        if AsyncETrader.DEBUG:
+            log.debug('posting payload %s', payload)
+        response = await self.__transport.post('preview', url, data=payload, headers=self.__headers)
+
+        if response is not None and response.status_code == 200:
+            preview_id = parse_preview_id(response.json())
+            if preview_id != 0:
+                return preview_id, order_html
+
+        return 0, ''
+
+    async def place_order(self, price_type: str, order_term: str, limit_price: str, symbol: str, order_action: str, quantity: int, client_order_id: int = None) -> (bool, dict):
+        """
+        Returns tuple of success_flag (bool) and place order response (dict).
+        """
+        start = time.perf_counter()
+
+        # preview and place must agree on the client order id
+        if client_order_id is None:
+            client_order_id = random.randint(1000000000, 9999999999)
+
+        preview_id, order_html = await self.preview_order(price_type, order_term, limit_price, symbol, order_action, quantity, client_order_id)
+
+        if preview_id == 0 or len(order_html) <= 0:
+            log.error('Order preview was invalid. Not placing order!')
+            return False, {}
+
+        previewed = time.perf_counter()
+
+        url = cd.BASE_URL + "/v1/accounts/" + cd.ACCOUNT_ID_KEY + "/orders/place.json"
+        payload = PLACE_TEMPLATE.format(client_order_id=client_order_id, preview_id=preview_id, order_html=order_html)
+        response = await self.__transport.post('place', url, data=payload, headers=self.__headers)
+
+        if AsyncETrader.DEBUG and response is not None:
+            log.debug('place response %s', response.text)
+
+        placed = time.perf_counter()
+        self.order_timings.append((symbol, previewed - start, placed - previewed))
+        log.info('Order for %s: preview %.1f ms, preview->place %.1f ms, total %.1f ms', symbol, (previewed - start) * 1000, (placed - previewed) * 1000, (placed - start) * 1000)
+
+        if response is not None and response.status_code == 200:
+            placed_order = parse_place(response.json())
+            if placed_order is not None:
+                return True, placed_order
+        else:
+            log.error('Error: place_order did not return valid status code')
+
+        return False, {}
+
+
+class BlockingETrader(object):
+    """
+    Blocking facade of an AsyncETrader with ETrader's interface, so Trader
+    and Watchdog can use it as is. The client runs on an event loop in a
+    thread of its own; calls from any thread are handed over to it and wait
+    for their result, so concurrent callers share its pool instead of
+    holding a connection each.
+    """
+    def __init__(self, client: AsyncETrader):
+        self.__client = client
+        self.__loop = asyncio.new_event_loop()
+        loop = Thread(target=self.__loop.run_forever, name='broker-loop')
+        loop.daemon = True
+        loop.start()
+        self.__call(client.start())
+
+    def __call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result()
+
+    def close(self) -> None:
+        self.__call(self.__client.close())
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+
+    @property
+    def client(self) -> AsyncETrader:
+        return self.__client
+
+    @property
+    def transport(self) -> AsyncTransport:
+        return self.__client.transport
+
+    @property
+    def order_timings(self) -> deque:
+        return self.__client.order_timings
+
+    def get_ticker_price(self, ticker: str) -> float:
+        return self.__call(self.__client.get_ticker_price(ticker))
+
+    def get_ticker_prices(self, tickers: list) -> dict:
+        return self.__call(self.__client.get_ticker_prices(tickers))
+
+    def get_filled_orders(self) -> dict:
+        return self.__call(self.__client.get_filled_orders())
+
+    def sync_filled_orders(self) -> (list, bool):
+        return self.__call(self.__client.sync_filled_orders())
+
+    def preview_order(self, *args, **kwargs) -> (int, str):
+        return self.__call(self.__client.preview_order(*args, **kwargs))
+
+    def place_order(self, *args, **kwargs) -> (bool, dict):
+        return self.__call(self.__client.place_order(*args, **kwargs))
@@ -0,0 +1,502 @@
+import json
+import os
+import sys
+import time
+import heapq
+from threading import Lock
+
+import numpy as np
+
+import clock
+import constants as ct
+from fills import Fill
+from logger import Logger
+from reader import Reader
+from tick_store import TickStore, DICTIONARY
+from trader import Trader
+
+log = Logger.get('backtest')
+
+# constants a backtest always runs with: orders go through the simulated
+# broker, one signal worker keeps replays deterministic and the throwaway
+# db is json files, which hold no connections open once the run is over
+BACKTEST_CONSTANTS = {'LIVE_TRADING': True, 'SIGNAL_WORKERS': 1, 'STORAGE_BACKEND': 'json', 'TICK_RECORDING': False}
+
+
+class PriceHistory(object):
+    """
+    Trade prices of many symbols kept in two flat arrays; the ticks of
+    symbol i are timestamps[offsets[i]:offsets[i + 1]], in time order.
+    """
+    def __init__(self, symbols: list, offsets: np.ndarray, timestamps: np.ndarray, prices: np.ndarray):
+        self.symbols = symbols
+        self.offsets = offsets
+        self.timestamps = timestamps
+        self.prices = prices
+        self.__index = {symbol: i for i, symbol in enumerate(symbols)}
+
+    @staticmethod
+    def from_series(series: dict) -> 'PriceHistory':
+        """
+        Returns history of a dict of symbol -> (timestamps, prices).
+        """
+        symbols = sorted(series)
+        lengths = [len(series[symbol][0]) for symbol in symbols]
+        offsets = np.zeros(len(symbols) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        timestamps = np.empty(offsets[-1], dtype=np.float64)
+        prices = np.empty(offsets[-1], dtype=np.float64)
+        for i, symbol in enumerate(symbols):
+            ts = np.asarray(series[symbol][0], dtype=np.float64)
+            order = np.argsort(ts, kind='stable')
+            timestamps[offsets[i]:offsets[i + 1]] = ts[order]
+            prices[offsets[i]:offsets[i + 1]] = np.asarray(series[symbol][1], dtype=np.float64)[order]
+        return PriceHistory(symbols, offsets, timestamps, prices)
+
+    @staticmethod
+    def load_csv(directory: str) -> 'PriceHistory':
+        """
+        Returns history of a directory of <SYMBOL>.csv files holding
+        timestamp (seconds since epoch),price rows; a header line is skipped.
+        """
+        series = {}
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.csv'):
+                continue
+            path = os.path.join(directory, name)
+            with open(path) as fh:
+                header = fh.readline()
+            skip = 0 if header[:1].isdigit() else 1
+            rows = np.loadtxt(path, delimiter=',', skiprows=skip, ndmin=2, usecols=(0, 1))
+            series[name[:-4].upper()] = (rows[:, 0], rows[:, 1])
+
+        log.info('Loaded %d symbols from %s', len(series), directory)
+        return PriceHistory.from_series(series)
+
+    @staticmethod
+    def load_ticks(directory: str, first_day: str = None, last_day: str = None) -> 'PriceHistory':
+        """
+        Returns history of the quotes a TickRecorder wrote to directory
+        between two days (YYYYMMDD, inclusive).
+        """
+        series = TickStore(directory).all_series(first_day, last_day)
+        log.info('Loaded %d symbols from %s', len(series), directory)
+        return PriceHistory.from_series(series)
+
+    @staticmethod
+    def load(directory: str) -> 'PriceHistory':
+        """
+        Returns history of a tick store or a directory of csv files.
+        """
+        if os.path.exists(os.path.join(directory, DICTIONARY)):
+            return PriceHistory.load_ticks(directory)
+        return PriceHistory.load_csv(directory)
+
+    def save(self, directory: str) -> None:
+        """
+        Writes history as .npy files open() can map into memory.
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(directory, 'timestamps.npy'), self.timestamps)
+        np.save(os.path.join(directory, 'prices.npy'), self.prices)
+        # symbols last: their file marks a complete history
+        with open(os.path.join(directory, 'symbols.txt'), 'w') as fh:
+            fh.write('\n'.join(self.symbols))
+
+    @staticmethod
+    def open(directory: str) -> 'PriceHistory':
+        """
+        Returns history saved in directory, mapped read-only so processes
+        opening the same files share their pages.
+        """
+        with open(os.path.join(directory, 'symbols.txt')) as fh:
+            symbols = fh.read().split()
+        # plain ndarray views of the maps; memmap's subclass hooks cost more than the slices they run on
+        timestamps = np.load(os.path.join(directory, 'timestamps.npy'), mmap_mode='r').view(np.ndarray)
+        prices = np.load(os.path.join(directory, 'prices.npy'), mmap_mode='r').view(np.ndarray)
+        return PriceHistory(symbols, np.load(os.path.join(directory, 'offsets.npy')), timestamps, prices)
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self.__index
+
+    def series(self, symbol: str) -> (np.ndarray, np.ndarray):
+        """
+        Returns (timestamps, prices) of symbol (views, not copies) or None.
+        """
+        i = self.__index.get(symbol)
+        if i is None:
+            return None
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.timestamps[start:end], self.prices[start:end]
+
+    def span(self) -> (float, float):
+        """
+        Returns time of the first and the last tick.
+        """
+        if len(self.timestamps) == 0:
+            return 0.0, 0.0
+        starts = self.timestamps[self.offsets[:-1][np.diff(self.offsets) > 0]]
+        ends = self.timestamps[self.offsets[1:][np.diff(self.offsets) > 0] - 1]
+        return float(starts.min()), float(ends.max())
+
+    def price_at(self, symbol: str, when: float) -> float:
+        """
+        Returns last trade price of symbol at or before when, or -1 if there is none.
+        """
+        series = self.series(symbol)
+        if series is None:
+            return -1
+        i = np.searchsorted(series[0], when, side='right') - 1
+        return float(series[1][i]) if i >= 0 else -1
+
+
+def first_outside(prices: np.ndarray, start: int, stop: int, low: float, high: float) -> int:
+    """
+    Returns index of the first price in prices[start:stop] below low or
+    above high, or -1. Scans chunks of doubling size so a crossing close
+    to start doesn't cost a scan of the whole range.
+    """
+    chunk = 64
+    while start < stop:
+        end = min(stop, start + chunk)
+        window = prices[start:end]
+        outside = (window < low) | (window > high)
+        i = int(outside.argmax())
+        if outside[i]:
+            return start + i
+        start = end
+        chunk *= 4
+    return -1
+
+
+class SimBroker(object):
+    """
+    Stands in for ETrader in a backtest. Quotes are the last trade at or
+    before the virtual clock. A limit order fills in full at the first
+    trade on its side of the limit price, from placement until it would
+    have expired (ORDER_MAX_AGE); fill syncs report it once the clock has
+    passed that trade.
+    """
+    def __init__(self, history: PriceHistory):
+        self.__history = history
+        self.__lock = Lock()
+        # heap of (fill time, order id, Fill) not reported yet
+        self.__pending = []
+        # fills reported so far
+        self.__reported = []
+        self.__next_id = 1
+        self.placed = 0
+        self.rejected = 0
+
+    def get_ticker_price(self, ticker: str) -> float:
+        return self.__history.price_at(ticker, clock.time())
+
+    def get_ticker_prices(self, tickers: list) -> dict:
+        now = clock.time()
+        return {ticker: self.__history.price_at(ticker, now) for ticker in tickers}
+
+    def place_order(self, price_type: str, order_term: str, limit_price: float, symbol: str, order_action: str, quantity: int, client_order_id: int = None) -> (bool, dict):
+        """
+        Returns tuple of success_flag and a place order response holding the order id.
+        """
+        now = clock.time()
+        series = self.__history.series(symbol)
+        if series is None or quantity < 1 or self.__history.price_at(symbol, now) <= 0:
+            log.error('Order preview was invalid. Not placing order!')
+            self.rejected += 1
+            return False, {}
+
+        timestamps, prices = series
+        # from the trade in effect now until the order would have expired
+        start = np.searchsorted(timestamps, now, side='right') - 1
+        stop = np.searchsorted(timestamps, now + ct.ORDER_MAX_AGE, side='right')
+        window = prices[start:stop]
+        crossed = window <= float(limit_price) if order_action == 'BUY' else window >= float(limit_price)
+        i = int(crossed.argmax())
+
+        self.__lock.acquire()
+        order_id = self.__next_id
+        self.__next_id += 1
+        self.placed += 1
+        if crossed[i]:
+            sign = 1 if order_action == 'BUY' else -1
+            price = float(window[i])
+            fill = Fill(order_id, symbol, sign * quantity, sign * quantity * price, now)
+            heapq.heappush(self.__pending, (max(now, float(timestamps[start + i])), order_id, fill))
+        self.__lock.release()
+
+        return True, {'OrderIds': [{'orderId': order_id}]}
+
+    def sync_filled_orders(self) -> (list, bool):
+        """
+        Returns fills that happened since the last sync, oldest first, and False
+        (they never cover the whole history).
+        """
+        now = clock.time()
+        fills = []
+        self.__lock.acquire()
+        while len(self.__pending) > 0 and self.__pending[0][0] <= now:
+            fills.append(heapq.heappop(self.__pending)[2])
+        self.__reported.extend(fills)
+        self.__lock.release()
+        return fills, False
+
+    def get_filled_orders(self) -> dict:
+        """
+        Returns a dict of ticker -> [share no., value] over the fills reported so far.
+        """
+        positions = {}
+        self.__lock.acquire()
+        for fill in self.__reported:
+            position = positions.setdefault(fill.symbol, [0, 0.0])
+            position[0] += fill.shares
+            position[1] += fill.value
+        self.__lock.release()
+        return positions
+
+    def next_fill(self) -> float:
+        """
+        Returns time of the earliest fill not reported yet (inf if none).
+        """
+        self.__lock.acquire()
+        result = self.__pending[0][0] if len(self.__pending) > 0 else float('inf')
+        self.__lock.release()
+        return result
+
+
+def load_messages(path: str) -> list:
+    """
+    Returns (time, payload) of the recorded TDLib payloads in path (one JSON
+    object per line), oldest first. Payloads without a message date are skipped.
+    """
+    messages = []
+    with open(path) as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            payload = json.loads(line)
+            date = payload.get('message', {}).get('date')
+            if date is None:
+                continue
+            messages.append((float(date), payload))
+    messages.sort(key=lambda message: message[0])
+    return messages
+
+
+class Backtest(object):
+    """
+    Replays recorded channel messages through the real Reader, Trader,
+    Portfolio & Watchdog against a SimBroker on a virtual clock.
+
+    The watchdog is stepped cycle by cycle, except that stretches in which
+    no watched price leaves the band between its rules, no fill comes in and
+    no order or position expires are skipped in one step.
+    """
+    def __init__(self, history: PriceHistory, messages: list, params: dict = None):
+        """
+        :param messages: (time, TDLib payload) tuples, oldest first
+        :param params: constants to run with, e.g. {'SELL_THRESH_MULTIPLIER': 1.2}
+        """
+        params = {} if params is None else params
+        unknown = [name for name in params if not hasattr(ct, name)]
+        if len(unknown) > 0:
+            raise ValueError(f'Unknown constants {unknown}')
+
+        self.__history = history
+        self.__messages = messages
+        self.__params = dict(BACKTEST_CONSTANTS, **params)
+        self.__clock = None
+        self.__broker = None
+        self.__trader = None
+        # ticker -> (low, high, scanned from, first crossing or None, scanned up to)
+        self.__crossings = {}
+        self.ticks = 0
+
+    def run(self, workdir: str) -> dict:
+        """
+        Runs the replay with workdir (which gets a fresh db/) as working directory.
+
+        :returns: summary of the run
+        """
+        saved = {name: getattr(ct, name) for name in self.__params}
+        cwd = os.getcwd()
+        start_time = time.perf_counter()
+
+        first, last = self.__history.span()
+        if len(self.__messages) > 0:
+            first = min(first, self.__messages[0][0])
+            last = max(last, self.__messages[-1][0])
+
+        self.__clock = clock.VirtualClock(first)
+        clock.install(self.__clock)
+        reader = None
+        try:
+            for name, value in self.__params.items():
+                setattr(ct, name, value)
+            # keep logging to the same file from the run's directory
+            Logger.PATH = os.path.abspath(Logger.PATH)
+            os.chdir(workdir)
+            os.makedirs('db', exist_ok=True)
+            # prices we don't have can't be quoted anyway
+            with open('db/symbols.txt', 'w') as fh:
+                fh.write('\n'.join(self.__history.symbols))
+
+            self.__broker = SimBroker(self.__history)
+            self.__trader = Trader(self.__broker, background=False)
+            reader = Reader(self.__trader)
+
+            for when, payload in self.__messages:
+                self.__run_until(when)
+                reader.handle_payload(payload)
+                reader.pipeline.join()
+            self.__run_until(last)
+
+            return self.__summary(first, last, time.perf_counter() - start_time)
+        finally:
+            if reader is not None:
+                reader.pipeline.close()
+            if self.__trader is not None:
+                self.__trader.portfolio.store.stop()
+                self.__trader.watchdog.rules.stop()
+            clock.install(clock.SystemClock())
+            for name, value in saved.items():
+                setattr(ct, name, value)
+            os.chdir(cwd)
+
+    def __run_until(self, when: float) -> None:
+        """
+        Steps the watchdog through every cycle due up to when.
+        """
+        watchdog = self.__trader.watchdog
+        while True:
+            wake = watchdog.next_wake()
+            if wake > when:
+                break
+            now = max(wake, self.__clock.now)
+            # nothing can happen before quiet_until, so neither can the cycles in between
+            quiet_until = self.__quiet_until(now, when)
+            if quiet_until > now:
+                now = min(quiet_until, when)
+            self.__clock.advance_to(now)
+            watchdog.tick(now)
+            self.ticks += 1
+        self.__clock.advance_to(when)
+
+    def __quiet_until(self, now: float, limit: float) -> float:
+        """
+        Returns the earliest time up to limit at which a watched price leaves
+        the band its rules keep quiet in, a position or order expires or a
+        fill comes in.
+        """
+        quiet_until = min(limit, self.__broker.next_fill())
+
+        for order in self.__trader.portfolio.orders.open_orders():
+            quiet_until = min(quiet_until, order.placed_at + ct.ORDER_MAX_AGE)
+
+        rules = self.__trader.watchdog.rules
+        for ticker in rules.tickers():
+            # expired rules that didn't sell are retried on the watchdog's schedule
+            deadline = rules.deadline(ticker)
+            if deadline > now:
+                quiet_until = min(quiet_until, deadline)
+            low, high = rules.bounds(ticker)
+            crossing = self.__crossing(ticker, low, high, now, quiet_until)
+            if crossing is not None:
+                quiet_until = min(quiet_until, max(now, crossing))
+                if quiet_until <= now:
+                    break
+        return quiet_until
+
+    def __crossing(self, ticker: str, low: float, high: float, now: float, limit: float) -> float:
+        """
+        Returns time of the first trade of ticker from now up to limit outside
+        low..high, or None. A scan holds until the band changes or the clock
+        reaches the crossing it found, so quiet tickers aren't scanned every cycle.
+        """
+        cached = self.__crossings.get(ticker)
+        if cached is not None and cached[0] == low and cached[1] == high and cached[2] <= now:
+            crossing, scanned_to = cached[3], cached[4]
+            if crossing is not None and now < crossing:
+                return crossing
+            if crossing is None and limit <= scanned_to:
+                return None
+
+        series = self.__history.series(ticker)
+        if series is None:
+            return None
+        timestamps, prices = series
+        start = max(0, np.searchsorted(timestamps, now, side='right') - 1)
+        stop = np.searchsorted(timestamps, limit, side='right')
+        i = first_outside(prices, start, stop, low, high)
+        crossing = float(timestamps[i]) if i >= 0 else None
+        self.__crossings[ticker] = (low, high, now, crossing, limit)
+        return crossing
+
+    def __summary(self, first: float, last: float, elapsed: float) -> dict:
+        """
+        Returns counts, money & per-trade returns of the run.
+        """
+        portfolio = self.__trader.portfolio
+        history = list(portfolio.orders.history) + portfolio.orders.open_orders()
+
+        # what each symbol's buys cost and its sells brought in
+        bought, sold = {}, {}
+        for order in history:
+            book = bought if order.action == 'BUY' else sold
+            book[order.symbol] = book.get(order.symbol, 0.0) + abs(order.value)
+
+        held = {ticker: row for ticker, row in portfolio.portfolio.items() if row['shares'] > 0}
+        market_value = sum(row['shares'] * self.__history.price_at(ticker, last) for ticker, row in held.items())
+        unrealized = market_value - sum(row['stake'] for row in held.values())
+
+        closed = [ticker for ticker in sold if ticker not in held and bought.get(ticker, 0) > 0]
+        costs = np.array([bought[ticker] for ticker in closed])
+        returns = np.array([sold[ticker] for ticker in closed]) / costs - 1 if len(closed) > 0 else np.zeros(0)
+
+        wallet = portfolio.get_wallet()
+        return {
+            'params': {name: value for name, value in self.__params.items() if name not in BACKTEST_CONSTANTS},
+            'days': (last - first) / 86400,
+            'messages': len(self.__messages),
+            'orders': self.__broker.placed,
+            'rejected': self.__broker.rejected,
+            'buys_filled': sum(1 for order in history if order.action == 'BUY' and order.filled > 0),
+            'sells_filled': sum(1 for order in history if order.action == 'SELL' and order.filled > 0),
+            'cancelled': sum(1 for order in history if order.state == 'CANCELLED'),
+            'round_trips': len(closed),
+            'win_rate': float((returns > 0).mean()) if len(returns) > 0 else 0.0,
+            'mean_return': float(returns.mean()) if len(returns) > 0 else 0.0,
+            'profit': wallet['out'],
+            'balance': portfolio.balance,
+            'open_positions': len(held),
+            'market_value': market_value,
+            'unrealized': unrealized,
+            # sold stakes aren't paid back into the balance, so go by profits
+            'equity': ct.DEFAULT_BALANCE_IN + wallet['out'] + unrealized,
+            'watchdog_cycles': self.ticks,
+            'elapsed': elapsed,
+        }
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    # usage: backtest.py <price csv or tick dir> <messages.jsonl> [NAME=value ...]
+    if len(sys.argv) < 3:
+        print('usage: backtest.py <price csv or tick dir> <messages.jsonl> [NAME=value ...]')
+        sys.exit(1)
+
+    os.makedirs(os.path.dirname(os.path.abspath(Logger.PATH)), exist_ok=True)
+    Logger.set_level('WARN')
+    # turned down signals are logged as errors; they are what we're measuring
+    Logger.set_level(Logger.LEVEL_ERROR + 1, 'trader')
+    params = {}
+    for arg in sys.argv[3:]:
+        name, value = arg.split('=', 1)
+        params[name] = json.loads(value)
+
+    backtest = Backtest(PriceHistory.load(sys.argv[1]), load_messages(sys.argv[2]), params)
+    with tempfile.TemporaryDirectory() as workdir:
+        print(json.dumps(backtest.run(workdir), indent=2))
@@ -0,0 +1,191 @@
+import json
+import time
+import traceback
+from collections import deque
+from threading import Thread, Condition, Lock
+
+from logger import Logger
+
+log = Logger.get('change_feed')
+
+
+def encode_event(name: str, data) -> str:
+    """
+    Returns a Server-Sent Events message.
+    """
+    return f'event: {name}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+def diff_rows(old: dict, new: dict) -> dict:
+    """
+    Returns {'upsert': [rows], 'delete': [keys]} between two key -> row dicts.
+    """
+    upsert = [row for key, row in new.items() if old.get(key) != row]
+    delete = [key for key in old if key not in new]
+    return {'upsert': upsert, 'delete': delete}
+
+
+class Subscription(object):
+    """
+    Bounded buffer of encoded events for one client. A client that falls
+    behind loses its backlog and gets a fresh snapshot instead.
+    """
+    __slots__ = ('events', 'overflowed', 'closed')
+
+    def __init__(self, size: int):
+        self.events = deque(maxlen=size)
+        self.overflowed = False
+        self.closed = False
+
+
+class ChangeFeed(object):
+    """
+    Single producer watching the stored tables. Each change is diffed against
+    the previous state, encoded once and handed to every subscriber.
+    """
+    def __init__(self, storage: 'JsonStorage | SqliteStorage', period: float = 0.5, buffer_size: int = 256):
+        self.__storage = storage
+        self.__period = period
+        self.__buffer_size = buffer_size
+        # guards subscribers & state; notified when events are published
+        self.__cond = Condition(Lock())
+        self.__subscribers = set()
+        # table -> version last read
+        self.__versions = {}
+        # table -> key -> row
+        self.__state = {'wallet': {}, 'portfolio': {}, 'watchlist': {}}
+        self.__snapshot = encode_event('snapshot', self.__snapshot_data())
+        self.published = 0
+
+    @property
+    def subscribers(self) -> int:
+        return len(self.__subscribers)
+
+    def start(self) -> None:
+        """
+        Starts watcher thread.
+        """
+        self.poll()
+        watcher = Thread(target=self.__run, name='change-feed')
+        watcher.daemon = True
+        watcher.start()
+
+    def __run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as ex:
+                log.error('Exception %s while watching storage', ex)
+                log.error(traceback.format_exc())
+            time.sleep(self.__period)
+
+    def poll(self) -> int:
+        """
+        Reads tables that changed and publishes their diffs.
+
+        :returns: number of events published
+        """
+        events = []
+        for table in ['wallet', 'portfolio', 'watchlist']:
+            version = self.__storage.version(table)
+            if table in self.__versions and version == self.__versions[table]:
+                continue
+
+            rows = self.__key_rows(table, self.__storage.read(table))
+            self.__versions[table] = version
+            old = self.__state[table]
+            self.__state[table] = rows
+
+            if table == 'wallet':
+                new_wallet = rows.get(0, {})
+                old_wallet = old.get(0, {})
+                changed = {field: value for field, value in new_wallet.items() if old_wallet.get(field) != value}
+                if len(changed) > 0:
+                    events.append(encode_event('wallet', changed))
+            else:
+                diff = diff_rows(old, rows)
+                if len(diff['upsert']) + len(diff['delete']) > 0:
+                    events.append(encode_event(table, diff))
+
+        if len(events) > 0:
+            self.__publish(events)
+        return len(events)
+
+    @staticmethod
+    def __key_rows(table: str, rows: list) -> dict:
+        if table == 'portfolio':
+            return {row['ticker']: row for row in rows}
+        if table == 'watchlist':
+            return {row['uuid']: {'uuid': row['uuid'], 'ticker': row['ticker'], 'kind': storage.rule_kind(row), 'threshold': row['threshold']} for row in rows}
+        return {i: row for i, row in enumerate(rows)}
+
+    def __snapshot_data(self) -> dict:
+        return {
+            'wallet': self.__state['wallet'].get(0, {}),
+            'portfolio': list(self.__state['portfolio'].values()),
+            'watchlist': list(self.__state['watchlist'].values()),
+        }
+
+    def __publish(self, events: list) -> None:
+        self.__cond.acquire()
+        self.__snapshot = encode_event('snapshot', self.__snapshot_data())
+        for subscription in self.__subscribers:
+            for event in events:
+                if len(subscription.events) == subscription.events.maxlen:
+                    subscription.overflowed = True
+                subscription.events.append(event)
+        self.published += len(events)
+        self.__cond.notify_all()
+        self.__cond.release()
+
+    def subscribe(self) -> Subscription:
+        """
+        Returns a new subscription; its first event is the current snapshot.
+        """
+        subscription = Subscription(self.__buffer_size)
+        self.__cond.acquire()
+        subscription.events.append(self.__snapshot)
+        self.__subscribers.add(subscription)
+        self.__cond.release()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.__cond.acquire()
+        subscription.closed = True
+        subscription.events.clear()
+        self.__subscribers.discard(subscription)
+        self.__cond.notify_all()
+        self.__cond.release()
+
+    def get(self, subscription: Subscription, timeout: float) -> list:
+        """
+        Waits for events of subscription.
+
+        :returns: list of encoded events, empty on timeout
+        """
+        self.__cond.acquire()
+        if len(subscription.events) == 0 and not subscription.closed:
+            self.__cond.wait(timeout)
+
+        if subscription.overflowed:
+            # backlog is incomplete: start the client over from current state
+            events = [self.__snapshot]
+            subscription.overflowed = False
+        else:
+            events = list(subscription.events)
+        subscription.events.clear()
+        self.__cond.release()
+        return events
+
+    def stream(self, subscription: Subscription, keepalive: float):
+        """
+        Yields events of subscription for a streaming response until the
+        client goes away.
+        """
+        try:
+            while not subscription.closed:
+                events = self.get(subscription, keepalive)
+                # comment line keeps proxies from closing an idle connection
+                yield ''.join(events) if len(events) > 0 else ': keepalive\n\n'
+        finally:
+            self.unsubscribe(subscription)
@@ -0,0 +1,54 @@
+import time as _time
+
+
+class SystemClock(object):
+    """
+    The real thing.
+    """
+    def time(self) -> float:
+        return _time.time()
+
+    def monotonic(self) -> float:
+        return _time.monotonic()
+
+
+class VirtualClock(object):
+    """
+    Clock that only moves when told to; wall and monotonic time are the
+    same number. Lets a backtest replay weeks of trading in seconds.
+    """
+    def __init__(self, start: float = 0.0):
+        self.now = start
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance_to(self, when: float) -> None:
+        if when > self.now:
+            self.now = when
+
+
+# clock trading decisions (schedules, quote freshness, order age) go by
+_clock = SystemClock()
+
+
+def install(clock) -> None:
+    """
+    Makes clock the time source of this process.
+    """
+    global _clock
+    _clock = clock
+
+
+def time() -> float:
+    """
+    Returns seconds since epoch.
+    """
+    return _clock.time()
+
+
+def monotonic() -> float:
+    return _clock.monotonic()
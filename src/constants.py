@@ -1,16 +1,115 @@
 # default amount of currency worth of stock to buy
 DEFAULT_BALANCE_IN=1000
 DEFAULT_CURRENCY_BUY_AMOUNT=1000
-WATCHDOG_UPDATE_PERIOD=30
+WATCHDOG_UPDATE_PERIOD=30 # longest a subscribed ticker goes unchecked; also fill sync period
+WATCHDOG_MIN_PERIOD=2 # shortest interval between checks of a ticker right at its threshold
+WATCHDOG_NEAR_THRESH=0.1 # checks speed up once price is within this fraction of a threshold
+# max symbols the broker accepts per quote request (25, or 50 with overrideSymbolCount)
+QUOTE_BATCH_SIZE=25
+# seconds a quote is reused before asking the broker again
+QUOTE_CACHE_TTL=2
+# max symbols kept in the quote cache
+QUOTE_CACHE_SIZE=512
 SELL_THRESH_MULTIPLIER=1.5 #i.e. 1.1 means we sell when we've made a profit 
                            # or taken a loss of at least 10%
+# sell when the price drops below this fraction of the price we bought at (None: no stop loss)
+STOP_LOSS_MULTIPLIER=0.8
+# sell when the price drops this fraction below its high since we bought (None: no trailing stop)
+TRAILING_STOP=None
+# sell positions held longer than this many seconds (None: hold until a price rule fires)
+MAX_HOLD_SECONDS=None
 MAX_TICKER_PRICE=0.002
 MAX_TICKER_NO_FILTER_PRICE=0.0009 # anything at this price or below will not be subject to word filter
 BUY_LIMIT_PRICE_MULTIPLIER=1.1
 SELL_LIMIT_PRICE_MULTIPLIER=0.95
 CURRENCY_SYMBOL='USD'
+# orders requested per page when syncing fills (broker max is 100)
+ORDERS_PAGE_SIZE=100
+# max orders previewed/placed concurrently
+ORDER_WORKERS=8
+# seconds after which an order that isn't fully filled is given up on (orders are good for the day)
+ORDER_MAX_AGE=86400
+# balance transactions the ledger keeps in memory (the balance is persisted, not its history)
+LEDGER_HISTORY=10000
 LIVE_TRADING=True
 
+# BROKER TRANSPORT
+# 'threads' (blocking ETrader) or 'asyncio' (AsyncETrader behind a blocking facade)
+BROKER_CLIENT='threads'
+# max broker requests the asyncio client has in flight at once
+ASYNC_MAX_CONCURRENCY=64
+# connections kept alive to the broker (cover ORDER_WORKERS plus quote & fill traffic)
+HTTP_POOL_SIZE=16
+# (connect, read) timeout in seconds per endpoint
+HTTP_TIMEOUTS={'quote': (3.05, 5), 'orders': (3.05, 15), 'preview': (3.05, 10), 'place': (3.05, 10)}
+# retries after a 5xx or connection error (placing an order is only retried if it never got sent)
+HTTP_RETRIES=3
+# seconds of the first backoff and the most any backoff waits; each retry waits a random
+# time up to base * 2^attempt
+HTTP_BACKOFF_BASE=0.25
+HTTP_BACKOFF_MAX=4
+# consecutive failed requests after which broker calls are short-circuited
+BREAKER_FAILURES=5
+# seconds before a single trial request is let through again
+BREAKER_COOLDOWN=30
+
+# PORTFOLIO PERSISTENCE
+# seconds between journal appends of in-memory portfolio changes
+PORTFOLIO_FLUSH_PERIOD=1
+# seconds between full portfolio/wallet snapshots
+PORTFOLIO_SNAPSHOT_PERIOD=30
+
+# TICK STORE
+# record every quote the watchdog fetches (price history for backtests & analysis)
+TICK_RECORDING=True
+# directory of per-day tick column files (relative to repo root)
+TICK_DIR='db/ticks'
+# seconds between appends of buffered ticks
+TICK_FLUSH_PERIOD=1
+# max ticks buffered between appends; ticks beyond it are dropped and counted
+TICK_BUFFER_SIZE=200000
+
+# SYMBOL VALIDATION
+# shouted words that look like tickers but never are
+TICKER_STOPWORDS=['BUY', 'SELL', 'HOLD', 'OTC', 'NEW', 'HOD', 'LOD', 'THE', 'AND', 'FOR', 'NOW', 'NEWS', 'ALERT',
+                  'PINK', 'LFG', 'WOW', 'YES', 'NICE', 'HUGE', 'LONG', 'SHORT', 'FDA', 'SEC', 'CEO', 'IPO', 'ATH',
+                  'EOD', 'EPS', 'GAP', 'MOON', 'LOAD', 'WATCH', 'HIGH', 'LOW', 'OPEN', 'NEXT', 'WEEK', 'TODAY',
+                  'BOOM', 'CHART', 'SPLIT']
+# seconds we stop quoting a symbol that came back without a price
+NEGATIVE_QUOTE_TTL=3600
+# price misses after which a symbol is denylisted for good
+DENYLIST_LEARN_MISSES=3
+
+# SIGNAL PIPELINE
+# max buy signals waiting for a worker
+SIGNAL_QUEUE_SIZE=64
+# number of tickers handled concurrently
+SIGNAL_WORKERS=4
+
+# STORAGE
+# 'sqlite' or 'json' (TinyDB-format files, for tests)
+STORAGE_BACKEND='sqlite'
+# SQLite database file inside db/; created from the json files if missing
+SQLITE_DB='plunder.db'
+
+# STATE SERVICE
+# unix socket the trader serves portfolio, wallet & watchlist on (relative to repo root)
+STATE_SOCKET='db/state.sock'
+
+# DASHBOARD
+# seconds between checks of the db files for changes to stream
+FEED_POLL_PERIOD=0.5
+# max events buffered per dashboard client before it gets a fresh snapshot instead
+FEED_CLIENT_BUFFER=256
+# seconds between keepalives on an idle event stream
+FEED_KEEPALIVE=15
+
+# LOGGING
+# messages below this level are dropped: 'DEBUG', 'INFO', 'WARN' or 'ERROR'
+LOG_LEVEL='DEBUG'
+# per-module overrides of LOG_LEVEL, e.g. {'watchdog': 'INFO'}
+LOG_MODULE_LEVELS={}
+
 # TELEGRAM SPECIFIC
 # only listen for messages from these user ids
 TG_USER_ID_FILTER=['813772733']
@@ -1,15 +1,95 @@
 from rauth import OAuth1Service
 import credentials as cd
+import constants as ct
 import webbrowser
 import random
 import json
 from logger import Logger
-from collections import defaultdict
-import numpy
+from collections import deque
+from datetime import datetime
+import time
+from fills import FillSync, parse_fill
+from transport import Transport
+
+log = Logger.get('etrader')
+
+
+# Order payload templates, kept free of indentation so requests stay small.
+ORDER_TEMPLATE = ('<Order><allOrNone>false</allOrNone><priceType>{price_type}</priceType>'
+                  '<orderTerm>{order_term}</orderTerm><marketSession>REGULAR</marketSession>'
+                  '<stopPrice></stopPrice><limitPrice>{limit_price}</limitPrice>'
+                  '<Instrument><Product><securityType>EQ</securityType><symbol>{symbol}</symbol></Product>'
+                  '<orderAction>{order_action}</orderAction><quantityType>QUANTITY</quantityType>'
+                  '<quantity>{quantity}</quantity></Instrument></Order>')
+
+PREVIEW_TEMPLATE = ('<PreviewOrderRequest><orderType>EQ</orderType>'
+                    '<clientOrderId>{client_order_id}</clientOrderId>{order_html}</PreviewOrderRequest>')
+
+PLACE_TEMPLATE = ('<PlaceOrderRequest><orderType>EQ</orderType><clientOrderId>{client_order_id}</clientOrderId>'
+                  '<PreviewIds><previewId>{preview_id}</previewId><cashMargin>CASH</cashMargin></PreviewIds>'
+                  '{order_html}</PlaceOrderRequest>')
+
+
+def parse_quotes(data: dict) -> dict:
+    """
+    Returns a dict of symbol -> last trade price from a quote response.
+    """
+    prices = {}
+
+    if data is not None and "QuoteResponse" in data and "QuoteData" in data["QuoteResponse"]:
+        for quote in data["QuoteResponse"]["QuoteData"]:
+            if quote is not None and "All" in quote and "lastTrade" in quote["All"]:
+                symbol = quote["Product"]["symbol"] if "Product" in quote else None
+                prices[symbol] = quote["All"]["lastTrade"]
+
+    return prices
+
+
+def parse_preview_id(parsed: dict) -> int:
+    """
+    Returns preview id of a preview order response or 0 if there is none.
+    """
+    # check integrity of json
+    if parsed is not None and 'PreviewOrderResponse' in parsed and 'PreviewIds' in parsed['PreviewOrderResponse']:
+        preview_ids = parsed['PreviewOrderResponse']['PreviewIds']
+
+        # make sure we got at least one preview id
+        if len(preview_ids) > 0 and 'previewId' in preview_ids[0]:
+            return preview_ids[0]['previewId']
+        log.error('No preview ids returned!')
+    else:
+        log.error('Malformed valid response!')
+    return 0
+
+
+def parse_place(parsed: dict) -> dict:
+    """
+    Returns the PlaceOrderResponse of a place order response or None if malformed.
+    """
+    if parsed is not None and 'PlaceOrderResponse' in parsed and 'Order' in parsed['PlaceOrderResponse']:
+        return parsed['PlaceOrderResponse']
+    log.error('Error: did not obtain place order response!')
+    return None
 
 
 class ETrader(object):
-    def __init__(self):
+    # dump order payloads & broker responses (costly on the order path)
+    DEBUG = False
+
+    def __init__(self, session=None):
+        # Add parameters and header information
+        self.__headers = {"Content-Type": "application/xml", "consumerKey": cd.CONSUMER_KEY}
+        # (symbol, preview seconds, preview->place seconds) of recent orders
+        self.order_timings = deque(maxlen=1000)
+        # fills seen so far, to report only what changed
+        self.__fill_sync = FillSync()
+
+        # an already authenticated session (e.g. one pointed at a stub broker) skips the OAuth flow
+        if session is not None:
+            self.__session = session
+            self.__transport = Transport(session)
+            return
+
         etrade = OAuth1Service(
             name="etrade",
             consumer_key=cd.CONSUMER_KEY,
@@ -27,176 +107,222 @@ class ETrader(object):
         # Step 2: Go through the authentication flow. Login to E*TRADE.
         # After you login, the page will provide a text code to enter.
         authorize_url = etrade.authorize_url.format(etrade.consumer_key, request_token)
-        Logger.debug(f'Go to {authorize_url} for token and enter it:')
+        log.debug('Go to %s for token and enter it:', authorize_url)
         text_code = input("Please accept agreement and enter text code from browser: ")
 
         # Step 3: Exchange the authorized request token for an authenticated OAuth 1 session
         self.__session = etrade.get_auth_session(request_token,
                                       request_token_secret,
                                       params={"oauth_verifier": text_code})
+        # pooled connections, timeouts, retries & circuit breaker for every call
+        self.__transport = Transport(self.__session)
 
-        # Add parameters and header information
-        self.__headers = {"Content-Type": "application/xml", "consumerKey": cd.CONSUMER_KEY}
-        Logger.info('Authenticated')
+        log.info('Authenticated')
+
+    @property
+    def transport(self) -> Transport:
+        return self.__transport
+
+    @property
+    def session(self):
+        """
+        Authenticated session (its tokens can sign requests of other clients).
+        """
+        return self.__session
 
     def get_ticker_price(self, ticker: str) -> float:
         """
-        Gets the latest price for the given ticker.
+        Gets the latest price for the given ticker: -1 if it has no quote,
+        None if the request failed.
         """
         # URL for the API endpoint
         url = cd.BASE_URL + "/v1/market/quote/" + ticker + ".json"
 
         # Make API call for GET request
-        response = self.__session.get(url)
+        response = self.__transport.get('quote', url)
 
         if response is not None and response.status_code == 200:
-            parsed = json.loads(response.text)
+            prices = parse_quotes(response.json())
 
-            # Handle and parse response
-            data = response.json()
-            if data is not None and "QuoteResponse" in data and "QuoteData" in data["QuoteResponse"]:
-                for quote in data["QuoteResponse"]["QuoteData"]:
-                    if quote is not None and "All" in quote and "lastTrade" in quote["All"]:
-                        return quote["All"]["lastTrade"]
+            if len(prices) > 0:
+                return next(iter(prices.values()))
 
-            Logger.warn(f'Could not retrive price for ticker {ticker}')
+            log.warn('Could not retrive price for ticker %s', ticker)
             return -1
 
-    def get_filled_orders(self, marker=None) -> dict:
+    def get_ticker_prices(self, tickers: list) -> dict:
+        """
+        Gets the latest prices for the given tickers, packing up to
+        QUOTE_BATCH_SIZE symbols into each quote request.
+
+        :returns: dict of ticker -> price (-1 for tickers without a quote, None for
+                  tickers whose request failed)
+        """
+        # keep order but drop duplicates so they don't eat up batch slots
+        tickers = list(dict.fromkeys(tickers))
+        prices = {}
+        # tickers of requests that failed; we don't know if they have a quote
+        failed = set()
+
+        for i in range(0, len(tickers), ct.QUOTE_BATCH_SIZE):
+            chunk = tickers[i:i + ct.QUOTE_BATCH_SIZE]
+            # URL for the API endpoint
+            url = cd.BASE_URL + "/v1/market/quote/" + ",".join(chunk) + ".json"
+            # above 25 symbols the broker wants us to acknowledge the larger batch
+            params = {"overrideSymbolCount": "true"} if len(chunk) > 25 else None
+
+            response = self.__transport.get('quote', url, params=params)
+
+            if response is not None and response.status_code == 200:
+                prices.update(parse_quotes(response.json()))
+            else:
+                log.warn('Could not retrieve quotes for %d tickers', len(chunk))
+                failed.update(chunk)
+
+        for ticker in tickers:
+            if ticker not in prices:
+                log.warn('Could not retrive price for ticker %s', ticker)
+                prices[ticker] = None if ticker in failed else -1
+
+        return prices
+
+    def __get_fills(self, from_date: str = None):
         """
-        Returns a dict of ticker -> (share no., value)
+        Yields Fill objects of INDIVIDUAL_FILLS orders page by page, newest first.
         """
         # Make up url
         url = cd.BASE_URL + "/v1/accounts/" + cd.ACCOUNT_ID_KEY + "/orders.json"
         # Make up headers
         headers = {"consumerkey": cd.CONSUMER_KEY}
 
-        # Make up client order id
-        params_indiv_fills = {"status": "INDIVIDUAL_FILLS"}
+        params_indiv_fills = {"status": "INDIVIDUAL_FILLS", "count": ct.ORDERS_PAGE_SIZE}
 
-        if marker is not None:
-            Logger.debug(f'Retrieving for marker {marker}')
-            params_indiv_fills['marker'] = marker
+        if from_date is not None:
+            params_indiv_fills['fromDate'] = from_date
+            params_indiv_fills['toDate'] = datetime.now().strftime('%m%d%Y')
 
-        response_indiv_fills = self.__session.get(url, header_auth=True, params=params_indiv_fills, headers=headers)
+        marker = None
+        while True:
+            if marker is not None:
+                log.debug('Retrieving for marker %s', marker)
+                params_indiv_fills['marker'] = marker
 
-        Logger.debug("Individual Fills Orders:")
-        # Handle and parse response
-        if response_indiv_fills.status_code == 204:
-            Logger.debug(f"Response Body: {response_executed}")
-            return {}
-        elif response_indiv_fills.status_code == 200:
-            parsed = json.loads(response_indiv_fills.text)
-            Logger.debug(f'Got 200 back {parsed}')
+            response_indiv_fills = self.__transport.get('orders', url, header_auth=True, params=params_indiv_fills, headers=headers)
 
-            # Initialize collection of ticker -> (no. of shares, total ticker value)
-            ticker_to_share_no = {}
-            ticker_to_share_no = defaultdict(lambda: (0, 0), ticker_to_share_no)
+            # Handle and parse response
+            if response_indiv_fills is None:
+                log.warn('No response for orders')
+                return
+            elif response_indiv_fills.status_code == 204:
+                return
+            elif response_indiv_fills.status_code != 200:
+                log.warn('Invalid status code; response: %s', response_indiv_fills.text)
+                return
+
+            parsed = response_indiv_fills.json()
+            if ETrader.DEBUG:
+                log.debug('Got 200 back %s', parsed)
 
             # Verify integrity of JSON
-            if parsed is not None and 'OrdersResponse' in parsed and 'Order' in parsed['OrdersResponse']:
-                orders = parsed['OrdersResponse']['Order']
-                marker = parsed['OrdersResponse']['marker'] if 'marker' in parsed['OrdersResponse'] else None
-
-                for order in orders:
-                    if 'OrderDetail' in order and len(order['OrderDetail']) > 0 and 'orderValue' in order['OrderDetail'][0] and 'Instrument' in order['OrderDetail'][0]:
-                        instrument = order['OrderDetail'][0]['Instrument']
-                        order_value = order['OrderDetail'][0]['orderValue']
-
-                        if len(instrument) < 1:
-                            Logger.warn('Less than one instrument in order detail. Skipping..')
-                            continue
-
-                        instrument = instrument[0]
-                        # extract operands for element-wise tuple addition
-                        x = ticker_to_share_no[instrument['Product']['symbol']]
-                        y = (instrument['filledQuantity'], order_value)
-                        order_action = instrument['orderAction']
-
-                        # update collection entry
-                        x = tuple(numpy.add(x, y)) if order_action == 'BUY' else tuple(numpy.subtract(x, y)) 
-                        x = (int(x[0]), x[1])
-                        ticker_to_share_no[instrument['Product']['symbol']] = x
-                    else:
-                        Logger.warn('Malformed order. Skipping...')
-                        continue
-
-                dict1 = dict(ticker_to_share_no)
-                if marker:
-                    dict2 = self.get_filled_orders(marker)
-                    return self.__merge_dicts(dict1, dict2)
-                return dict1
-        else:
-            Logger.warn(f'Invalid status code; response: {response_indiv_fills.text}')
-        
-        return {}
+            if parsed is None or 'OrdersResponse' not in parsed or 'Order' not in parsed['OrdersResponse']:
+                return
 
-    def __merge_dicts(self, dict1: dict, dict2: dict) -> dict:
-        if not isinstance(dict1, dict) or not isinstance(dict2, dict):
-            raise TypeError('Expected dicts for dict1 and dict2!')
+            for order in parsed['OrdersResponse']['Order']:
+                fill = parse_fill(order)
+                if fill is not None:
+                    yield fill
 
-        final_dict = {}
-        final_dict = defaultdict(lambda: (0, 0), final_dict)
-        # add elements in dict1
-        for key1 in dict1:
-            final_dict[key1] = tuple(numpy.add(final_dict[key1], dict1[key1]))
-            final_dict[key1] = (int(final_dict[key1][0]), final_dict[key1][1])
+            marker = parsed['OrdersResponse'].get('marker')
+            if not marker:
+                return
 
-        # add the elements particular to dict2
-        for key2 in dict2:
-            final_dict[key2] = tuple(numpy.add(final_dict[key2], dict2[key2]))
-            final_dict[key2] = (int(final_dict[key2][0]), final_dict[key2][1])
+    def get_filled_orders(self) -> dict:
+        """
+        Returns a dict of ticker -> (share no., value) over the whole order history.
+        """
+        # Initialize collection of ticker -> [no. of shares, total ticker value]
+        ticker_to_share_no = {}
 
-        return dict(final_dict)
+        for fill in self.__get_fills():
+            position = ticker_to_share_no.get(fill.symbol)
+            if position is None:
+                position = ticker_to_share_no[fill.symbol] = [0, 0.0]
+            position[0] += fill.shares
+            position[1] += fill.value
 
-    def place_order(self, price_type: str, order_term: str, limit_price: str, symbol: str, order_action: str, quantity: int) -> (bool, list):
+        return {ticker: (shares, value) for ticker, (shares, value) in ticker_to_share_no.items()}
+
+    def sync_filled_orders(self) -> (list, bool):
         """
-        Returns tuple of success_flag (bool) and order objects (list).
+        Fetches only fills newer than the last sync.
+
+        :returns: tuple of Fill deltas (what each order filled since it was last
+                  seen, oldest first) and whether they cover the whole order history
         """
+        synced_at = time.time()
+        complete = self.__fill_sync.from_date is None
+        deltas = []
 
-        preview_id, order_html = self.preview_order(price_type, order_term, limit_price, symbol, order_action, quantity)
+        for fill in self.__get_fills(self.__fill_sync.from_date):
+            delta = self.__fill_sync.apply(fill)
+            if delta is not None:
+                deltas.append(delta)
+
+        self.__fill_sync.advance(synced_at)
+
+        # pages come newest first
+        deltas.reverse()
+        return deltas, complete
+
+    def place_order(self, price_type: str, order_term: str, limit_price: str, symbol: str, order_action: str, quantity: int, client_order_id: int = None) -> (bool, dict):
+        """
+        Returns tuple of success_flag (bool) and place order response (dict;
+        holds the broker's OrderIds and the Order objects).
+        """
+        start = time.perf_counter()
+
+        # Make up client order id; preview and place must agree on it
+        if client_order_id is None:
+            client_order_id = random.randint(1000000000, 9999999999)
+
+        preview_id, order_html = self.preview_order(price_type, order_term, limit_price, symbol, order_action, quantity, client_order_id)
 
         if preview_id == 0 or len(order_html) <= 0:
-            Logger.error('Order preview was invalid. Not placing order!')
-            return False, []
+            log.error('Order preview was invalid. Not placing order!')
+            return False, {}
+
+        previewed = time.perf_counter()
 
         # Make up url
         url = cd.BASE_URL + "/v1/accounts/" + cd.ACCOUNT_ID_KEY + "/orders/place.json"
 
-        # Make up client order id
-        client_order_id = random.randint(1000000000, 9999999999)
-
         # Add payload for POST Request
-        payload = f"""<PlaceOrderRequest>
-                       <orderType>EQ</orderType>
-                       <clientOrderId>{client_order_id}</clientOrderId>
-                       <PreviewIds>
-                           <previewId>{preview_id}</previewId>
-                           <cashMargin>CASH</cashMargin>
-                       </PreviewIds>{order_html}
-                   </PlaceOrderRequest>"""
-
-        # print(f'posting payload {payload}')
+        payload = PLACE_TEMPLATE.format(client_order_id=client_order_id, preview_id=preview_id, order_html=order_html)
+
         # Make API call for POST request
-        response = self.__session.post(url, header_auth=True, headers=self.__headers, data=payload)
+        response = self.__transport.post('place', url, header_auth=True, headers=self.__headers, data=payload)
 
-        Logger.debug(f'place response {response.text}')
+        if ETrader.DEBUG and response is not None:
+            log.debug('place response %s', response.text)
 
-        if response is not None and response.status_code == 200:
-            parsed = response.json()
+        placed = time.perf_counter()
+        self.__record_timing(symbol, previewed - start, placed - previewed)
 
-            if parsed is not None and 'PlaceOrderResponse' in parsed and 'Order' in parsed['PlaceOrderResponse']:
-                order = parsed['PlaceOrderResponse']['Order']
+        if response is not None and response.status_code == 200:
+            placed_order = parse_place(response.json())
 
-                return True, order
-            else:
-                Logger.error('Error: did not obtain place order response!')
+            if placed_order is not None:
+                return True, placed_order
         else:
-            Logger.error('Error: place_order did not return valid status code')
+            log.error('Error: place_order did not return valid status code')
         
-        return False, []
+        return False, {}
 
-    def preview_order(self, price_type: str, order_term: str, limit_price: str, symbol: str, order_action: str, quantity: int) -> (int, str):
+    def __record_timing(self, symbol: str, preview_time: float, place_time: float) -> None:
+        self.order_timings.append((symbol, preview_time, place_time))
+        log.info('Order for %s: preview %.1f ms, preview->place %.1f ms, total %.1f ms', symbol, preview_time * 1000, place_time * 1000, (preview_time + place_time) * 1000)
+
+    def preview_order(self, price_type: str, order_term: str, limit_price: str, symbol: str, order_action: str, quantity: int, client_order_id: int = None) -> (int, str):
         """
         Returns preview_id and order_html if successful. Otherwise, it returns (0, '').
         """
@@ -205,59 +331,29 @@ class ETrader(object):
         url = cd.BASE_URL + "/v1/accounts/" + cd.ACCOUNT_ID_KEY + "/orders/preview.json"
 
         # Make up client order id
-        client_order_id = random.randint(1000000000, 9999999999)
-
-        preview_id = None
+        if client_order_id is None:
+            client_order_id = random.randint(1000000000, 9999999999)
 
         # Create order html
-        order_html = f"""
-                       <Order>
-                           <allOrNone>false</allOrNone>
-                           <priceType>{price_type}</priceType>
-                           <orderTerm>{order_term}</orderTerm>
-                           <marketSession>REGULAR</marketSession>
-                           <stopPrice></stopPrice>
-                           <limitPrice>{limit_price}</limitPrice>
-                           <Instrument>
-                               <Product>
-                                   <securityType>EQ</securityType>
-                                   <symbol>{symbol}</symbol>
-                               </Product>
-                               <orderAction>{order_action}</orderAction>
-                               <quantityType>QUANTITY</quantityType>
-                               <quantity>{quantity}</quantity>
-                           </Instrument>
-                       </Order>"""
+        order_html = ORDER_TEMPLATE.format(price_type=price_type, order_term=order_term, limit_price=limit_price, symbol=symbol, order_action=order_action, quantity=quantity)
 
         # Add payload for POST Request
-        payload = f"""<PreviewOrderRequest>
-                       <orderType>EQ</orderType>
-                       <clientOrderId>{client_order_id}</clientOrderId>{order_html}
-                   </PreviewOrderRequest>"""
+        payload = PREVIEW_TEMPLATE.format(client_order_id=client_order_id, order_html=order_html)
 
-        Logger.debug(f'posting payload {payload}')
+        if ETrader.DEBUG:
+            log.debug('posting payload %s', payload)
         # Make API call for POST request
-        response = self.__session.post(url, header_auth=True, headers=self.__headers, data=payload)
+        response = self.__transport.post('preview', url, header_auth=True, headers=self.__headers, data=payload)
 
-        Logger.debug(f'preview response {response.text}')
+        if ETrader.DEBUG and response is not None:
+            log.debug('preview response %s', response.text)
         
         # check if response returned valid status
         if response is not None and response.status_code == 200:
-            # deserialize json
-            parsed = response.json()
-
-            # check integrity of json
-            if parsed is not None and 'PreviewOrderResponse' in parsed and 'PreviewIds' in parsed['PreviewOrderResponse']:
-                preview_ids = parsed['PreviewOrderResponse']['PreviewIds']
-
-                # make sure we got at least one preview id
-                if len(preview_ids) > 0 and 'previewId' in preview_ids[0]:
-                    preview_id = preview_ids[0]['previewId']
-                    Logger.debug(f'Preview id: {preview_id}')
-                    return preview_id, order_html
-                else:
-                    Logger.error('No preview ids returned!')
-            else:
-                Logger.error('Malformed valid response!')
+            preview_id = parse_preview_id(response.json())
+            if preview_id != 0:
+                if ETrader.DEBUG:
+                    log.debug('Preview id: %s', preview_id)
+                return preview_id, order_html
 
         return 0, ''
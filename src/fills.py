@@ -0,0 +1,83 @@
+import time
+from datetime import datetime, timedelta
+
+from logger import Logger
+
+log = Logger.get('fills')
+
+
+class Fill(object):
+    __slots__ = ('order_id', 'symbol', 'shares', 'value', 'placed_at')
+
+    def __init__(self, order_id: int, symbol: str, shares: int, value: float, placed_at: float):
+        self.order_id = order_id
+        self.symbol = symbol
+        # signed: sells are negative
+        self.shares = shares
+        self.value = value
+        # seconds since epoch
+        self.placed_at = placed_at
+
+
+def parse_fill(order: dict) -> Fill:
+    """
+    Returns Fill for an order of an INDIVIDUAL_FILLS response or None if malformed.
+    """
+    if 'OrderDetail' in order and len(order['OrderDetail']) > 0 and 'orderValue' in order['OrderDetail'][0] and 'Instrument' in order['OrderDetail'][0]:
+        detail = order['OrderDetail'][0]
+        instrument = detail['Instrument']
+
+        if len(instrument) < 1:
+            log.warn('Less than one instrument in order detail. Skipping..')
+            return None
+
+        instrument = instrument[0]
+        sign = 1 if instrument['orderAction'] == 'BUY' else -1
+        placed_at = detail['placedTime'] / 1000 if 'placedTime' in detail else time.time()
+
+        return Fill(order.get('orderId'), instrument['Product']['symbol'], sign * int(instrument['filledQuantity']), sign * float(detail['orderValue']), placed_at)
+
+    log.warn('Malformed order. Skipping...')
+    return None
+
+
+class FillSync(object):
+    """
+    Turns order fills into per-order deltas across syncs. Only orders inside
+    the current time window are fetched again; an order that was already
+    counted only contributes the change in its fills.
+    """
+    def __init__(self):
+        # order id -> (symbol, shares, value, placed_at) as last counted
+        self.__counted = {}
+        # start of the window still worth refetching (MMDDYYYY) or None for all history
+        self.from_date = None
+        self.__window_start = 0.0
+
+    def apply(self, fill: Fill) -> Fill:
+        """
+        Counts fill. Returns a Fill holding only what changed since the
+        order was last counted, or None if nothing did.
+        """
+        previous = self.__counted.get(fill.order_id)
+        shares, value = fill.shares, fill.value
+        if previous is not None:
+            shares -= previous[1]
+            value -= previous[2]
+            if shares == 0 and value == 0:
+                return None
+
+        self.__counted[fill.order_id] = (fill.symbol, fill.shares, fill.value, fill.placed_at)
+        return Fill(fill.order_id, fill.symbol, shares, value, fill.placed_at)
+
+    def advance(self, synced_at: float) -> None:
+        """
+        Moves the window up to the sync that started at synced_at. Orders placed
+        before the window can't get new fills anymore (orders are good for the day)
+        so we forget them.
+        """
+        # a day of slack covers timezone differences with the broker
+        start = datetime.fromtimestamp(synced_at) - timedelta(days=1)
+        self.from_date = start.strftime('%m%d%Y')
+        self.__window_start = datetime(start.year, start.month, start.day).timestamp()
+        self.__counted = {order_id: entry for order_id, entry in self.__counted.items() if entry[3] >= self.__window_start}
@@ -0,0 +1,210 @@
+import itertools
+from collections import deque
+from threading import Lock
+
+import clock
+import constants as ct
+from logger import Logger
+
+log = Logger.get('ledger')
+
+
+class Transaction(object):
+    __slots__ = ('seq', 'kind', 'amount', 'ref', 'at')
+
+    DEPOSIT = 'deposit'
+    SPEND = 'spend'
+    SET = 'set'
+
+    def __init__(self, seq: int, kind: str, amount: float, ref: str, at: float):
+        self.seq = seq
+        self.kind = kind
+        # signed change of the balance
+        self.amount = amount
+        self.ref = ref
+        self.at = at
+
+    def as_dict(self) -> dict:
+        return {'seq': self.seq, 'kind': self.kind, 'amount': self.amount, 'ref': self.ref, 'at': self.at}
+
+
+class Reservation(object):
+    __slots__ = ('id', 'amount', 'ref', 'open')
+
+    def __init__(self, identifier: int, amount: float, ref: str):
+        self.id = identifier
+        self.amount = amount
+        self.ref = ref
+        self.open = True
+
+
+class Ledger(object):
+    """
+    Balance available for investing ('in' of the wallet). Every change is
+    an appended transaction and the running total lives in the store.
+    Orders first reserve what they may cost: a reservation only succeeds
+    if the balance not yet reserved covers it, so concurrent buys can't
+    spend the same money. Once the order is known to have filled (or
+    not), the reservation is settled for the actual cost and the rest
+    goes back. Reservations are only held in memory; the order book
+    restores those of open orders after a restart.
+    """
+    def __init__(self, store: 'PositionStore', field: str = 'in'):
+        self.__store = store
+        self.__field = field
+        self.__lock = Lock()
+        self.__ids = itertools.count(1)
+        self.__seqs = itertools.count(1)
+        # last LEDGER_HISTORY transactions; the balance itself is in the store
+        self.__transactions = deque(maxlen=ct.LEDGER_HISTORY)
+        # reservation id -> open Reservation
+        self.__reservations = {}
+        self.__reserved = 0.0
+
+    @property
+    def balance(self) -> float:
+        return self.__store.wallet(self.__field)
+
+    @property
+    def reserved(self) -> float:
+        return self.__reserved
+
+    @property
+    def available(self) -> float:
+        """
+        Balance not held by open reservations.
+        """
+        self.__lock.acquire()
+        result = self.__store.wallet(self.__field) - self.__reserved
+        self.__lock.release()
+        return result
+
+    def transactions(self) -> list:
+        """
+        Returns the last LEDGER_HISTORY transactions, oldest first.
+        """
+        self.__lock.acquire()
+        result = list(self.__transactions)
+        self.__lock.release()
+        return result
+
+    def reservations(self) -> list:
+        self.__lock.acquire()
+        result = list(self.__reservations.values())
+        self.__lock.release()
+        return result
+
+    def __post(self, kind: str, amount: float, ref: str) -> float:
+        # caller holds self.__lock
+        balance = self.__store.add_to_wallet(self.__field, amount)
+        self.__transactions.append(Transaction(next(self.__seqs), kind, amount, ref, clock.time()))
+        return balance
+
+    def reserve(self, amount: float, ref: str = None) -> Reservation:
+        """
+        Holds amount for an order if enough of the balance is unreserved.
+
+        :returns: Reservation or None if there isn't enough available
+        """
+        if amount < 0:
+            raise ValueError('Expected non-negative amount!')
+
+        self.__lock.acquire()
+        try:
+            if self.__store.wallet(self.__field) - self.__reserved < amount:
+                return None
+            reservation = Reservation(next(self.__ids), amount, ref)
+            self.__reservations[reservation.id] = reservation
+            self.__reserved += amount
+            return reservation
+        finally:
+            self.__lock.release()
+
+    def restore(self, amount: float, ref: str = None) -> Reservation:
+        """
+        Holds amount again for an order left open by a previous run. It was
+        covered when the order was placed, so availability isn't checked.
+        """
+        self.__lock.acquire()
+        try:
+            reservation = Reservation(next(self.__ids), amount, ref)
+            self.__reservations[reservation.id] = reservation
+            self.__reserved += amount
+            return reservation
+        finally:
+            self.__lock.release()
+
+    def settle(self, reservation: Reservation, amount: float = None) -> float:
+        """
+        Spends amount (at most what was reserved, all of it if omitted) and
+        releases the rest of reservation.
+
+        :returns: new balance
+        """
+        self.__lock.acquire()
+        try:
+            self.__close(reservation)
+            amount = reservation.amount if amount is None else min(amount, reservation.amount)
+            if amount > 0:
+                return self.__post(Transaction.SPEND, -amount, reservation.ref)
+            return self.__store.wallet(self.__field)
+        finally:
+            self.__lock.release()
+
+    def release(self, reservation: Reservation) -> None:
+        """
+        Gives back everything reservation holds (order rejected, cancelled or unfilled).
+        """
+        self.__lock.acquire()
+        try:
+            self.__close(reservation)
+        finally:
+            self.__lock.release()
+
+    def __close(self, reservation: Reservation) -> None:
+        # caller holds self.__lock
+        if not reservation.open:
+            raise ValueError(f'Reservation {reservation.id} is already closed!')
+        reservation.open = False
+        del self.__reservations[reservation.id]
+        self.__reserved -= reservation.amount
+        # keep float drift from piling up once nothing is reserved
+        if len(self.__reservations) == 0:
+            self.__reserved = 0.0
+
+    def spend(self, amount: float, ref: str = None) -> bool:
+        """
+        Spends amount right away if it's available. Returns False otherwise.
+        """
+        self.__lock.acquire()
+        try:
+            if self.__store.wallet(self.__field) - self.__reserved < amount:
+                return False
+            self.__post(Transaction.SPEND, -amount, ref)
+            return True
+        finally:
+            self.__lock.release()
+
+    def deposit(self, amount: float, ref: str = None) -> float:
+        """
+        Adds amount (negative to withdraw) to the balance. Returns new balance.
+        """
+        self.__lock.acquire()
+        try:
+            return self.__post(Transaction.DEPOSIT, amount, ref)
+        finally:
+            self.__lock.release()
+
+    def set_balance(self, value: float, ref: str = None) -> None:
+        """
+        Replaces the balance (budget set by hand); recorded as the difference.
+        """
+        self.__lock.acquire()
+        try:
+            amount = value - self.__store.wallet(self.__field)
+            self.__store.set_wallet(self.__field, value)
+            self.__transactions.append(Transaction(next(self.__seqs), Transaction.SET, amount, ref, clock.time()))
+            if value - self.__reserved < 0:
+                log.warn('Balance set to %s is below what open orders reserved (%s)', value, self.__reserved)
+        finally:
+            self.__lock.release()
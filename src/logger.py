@@ -1,5 +1,9 @@
+import os
+import sys
+import time
+import queue
 from datetime import datetime
-from threading import Lock
+from threading import Lock, Thread, Event
 
 class Logger(object):
     HEADER = '\033[95m'
@@ -14,38 +18,239 @@ class Logger(object):
     UNDERLINE = '\033[4m'
     _FILE_LOCK = Lock()
 
+    LEVEL_DEBUG = 10
+    LEVEL_INFO = 20
+    LEVEL_WARN = 30
+    LEVEL_ERROR = 40
+    # messages below this level are dropped before anything is formatted
+    LEVEL = LEVEL_DEBUG
+
+    PATH = 'logs/log.txt'
+    # rotate log file once it grows past this many bytes (0 disables rotation)
+    MAX_BYTES = 10 * 1024 * 1024
+    # rotated files kept around (log.txt.1 ... log.txt.N)
+    BACKUPS = 3
+
+    # module name -> level overriding LEVEL for that module's logger
+    _MODULE_LEVELS = {}
+
+    # set while the background writer is running
+    _QUEUE = None
+
     @staticmethod
     def _log_to_file(txt: str) -> None:
         Logger._FILE_LOCK.acquire()
-        with open('logs/log.txt', 'a') as fh:
+        with open(Logger.PATH, 'a') as fh:
             fh.write(txt + '\n')
         Logger._FILE_LOCK.release()
 
     @staticmethod
-    def debug(txt: str):
-        Logger._print('DEBUG', Logger.OKGRAY, txt)
+    def debug(txt, *args):
+        if Logger.LEVEL <= Logger.LEVEL_DEBUG:
+            Logger._print('DEBUG', Logger.OKGRAY, txt, False, args)
+
+    @staticmethod
+    def info(txt, *args):
+        if Logger.LEVEL <= Logger.LEVEL_INFO:
+            Logger._print('INFO', Logger.OKCYAN, txt, True, args)
 
     @staticmethod
-    def info(txt: str):
-        Logger._print('INFO', Logger.OKCYAN, txt, True)
+    def warn(txt, *args):
+        if Logger.LEVEL <= Logger.LEVEL_WARN:
+            Logger._print('WARN', Logger.WARNING, txt, True, args)
 
     @staticmethod
-    def warn(txt: str):
-        Logger._print('WARN', Logger.WARNING, txt, True)
+    def error(txt, *args):
+        if Logger.LEVEL <= Logger.LEVEL_ERROR:
+            Logger._print('ERROR', Logger.FAIL, txt, True, args)
 
     @staticmethod
-    def error(txt: str):
-        Logger._print('ERROR', Logger.FAIL, txt, True)
+    def _render(msg, args: tuple) -> str:
+        """
+        Returns the final message: msg % args, or msg() when msg is a callable.
+        """
+        if callable(msg):
+            return str(msg())
+        if len(args) > 0:
+            return msg % args
+        return msg
 
     @staticmethod
-    def _print(flag: str, color: str, msg: str, log_to_file: bool = False) -> None:
-        time = datetime.now()
-        time = time.strftime('%H:%M:%S')
+    def _print(flag: str, color: str, msg, log_to_file: bool = False, args: tuple = ()) -> None:
+        # async mode: hand the raw record to the writer thread, which formats it
+        if Logger._QUEUE is not None:
+            Logger._QUEUE.put((time.time(), flag, color, msg, args, log_to_file))
+            return
+
+        time_str = datetime.now().strftime('%H:%M:%S')
 
-        basic_string = f'[{time}][{flag}] -> {msg}{Logger.ENDC}'
+        basic_string = f'[{time_str}][{flag}] -> {Logger._render(msg, args)}{Logger.ENDC}'
         colored_string = color + basic_string
 
         print(colored_string)
 
         if log_to_file:
             Logger._log_to_file(basic_string)
+
+    @staticmethod
+    def parse_level(level) -> int:
+        """
+        Returns numeric level for 'DEBUG'/'INFO'/'WARN'/'ERROR' or a number.
+        """
+        if isinstance(level, str):
+            return getattr(Logger, f'LEVEL_{level.upper()}')
+        return level
+
+    @staticmethod
+    def set_level(level, module: str = None) -> None:
+        """
+        Sets the global level, or only the level of module's logger when given.
+        Takes effect immediately for every thread.
+        """
+        if module is None:
+            Logger.LEVEL = Logger.parse_level(level)
+        elif level is None:
+            Logger._MODULE_LEVELS.pop(module, None)
+        else:
+            Logger._MODULE_LEVELS[module] = Logger.parse_level(level)
+
+    @staticmethod
+    def configure(level, module_levels: dict) -> None:
+        """
+        Applies the global level and the per-module overrides.
+        """
+        Logger.set_level(level)
+        Logger._MODULE_LEVELS.clear()
+        for module, module_level in module_levels.items():
+            Logger.set_level(module_level, module)
+
+    @staticmethod
+    def get(module: str) -> 'ModuleLogger':
+        """
+        Returns a logger whose level can be controlled apart from the global one.
+        """
+        return ModuleLogger(module)
+
+    @staticmethod
+    def start_async() -> None:
+        """
+        Moves printing and file writes onto a background thread; callers only
+        pay for putting the record on a queue.
+        """
+        if Logger._QUEUE is not None:
+            return
+
+        Logger._QUEUE = queue.SimpleQueue()
+        writer = Thread(target=Logger._run_writer, args=(Logger._QUEUE,), name='log-writer')
+        writer.daemon = True
+        writer.start()
+
+    @staticmethod
+    def flush() -> None:
+        """
+        Blocks until every record logged so far has been written.
+        """
+        if Logger._QUEUE is not None:
+            done = Event()
+            Logger._QUEUE.put(done)
+            done.wait()
+
+    @staticmethod
+    def _run_writer(records: queue.SimpleQueue) -> None:
+        fh = open(Logger.PATH, 'a')
+        size = fh.tell()
+
+        while True:
+            batch = [records.get()]
+            # drain whatever else piled up so it goes out with one flush
+            while len(batch) < 1024:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+
+            console = []
+            lines = []
+            waiters = []
+            for record in batch:
+                if isinstance(record, Event):
+                    waiters.append(record)
+                    continue
+
+                timestamp, flag, color, msg, args, log_to_file = record
+                try:
+                    msg = Logger._render(msg, args)
+                except Exception as ex:
+                    msg = f'<unformattable log record {msg!r}: {ex}>'
+                time_str = datetime.fromtimestamp(timestamp).strftime('%H:%M:%S')
+                basic_string = f'[{time_str}][{flag}] -> {msg}{Logger.ENDC}'
+                console.append(color + basic_string)
+                if log_to_file:
+                    lines.append(basic_string)
+
+            try:
+                if len(console) > 0:
+                    sys.stdout.write('\n'.join(console) + '\n')
+                    sys.stdout.flush()
+
+                if len(lines) > 0:
+                    data = '\n'.join(lines) + '\n'
+                    fh.write(data)
+                    fh.flush()
+                    size += len(data)
+
+                    if Logger.MAX_BYTES > 0 and size >= Logger.MAX_BYTES:
+                        fh.close()
+                        Logger._rotate()
+                        fh = open(Logger.PATH, 'a')
+                        size = 0
+            except Exception as ex:
+                sys.stderr.write(f'Logger failed to write: {ex}\n')
+
+            for waiter in waiters:
+                waiter.set()
+
+    @staticmethod
+    def _rotate() -> None:
+        """
+        Shifts log.txt -> log.txt.1 -> ... -> log.txt.BACKUPS (dropping the oldest).
+        """
+        for i in range(Logger.BACKUPS - 1, 0, -1):
+            src = f'{Logger.PATH}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{Logger.PATH}.{i + 1}')
+
+        if Logger.BACKUPS > 0:
+            os.replace(Logger.PATH, f'{Logger.PATH}.1')
+        else:
+            os.remove(Logger.PATH)
+
+
+class ModuleLogger(object):
+    """
+    Logger of one module. Uses the module's level if one was set with
+    Logger.set_level(level, module), the global level otherwise.
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def enabled(self, level: int) -> bool:
+        return Logger._MODULE_LEVELS.get(self.name, Logger.LEVEL) <= level
+
+    def debug(self, txt, *args):
+        if Logger._MODULE_LEVELS.get(self.name, Logger.LEVEL) <= Logger.LEVEL_DEBUG:
+            Logger._print('DEBUG', Logger.OKGRAY, txt, False, args)
+
+    def info(self, txt, *args):
+        if Logger._MODULE_LEVELS.get(self.name, Logger.LEVEL) <= Logger.LEVEL_INFO:
+            Logger._print('INFO', Logger.OKCYAN, txt, True, args)
+
+    def warn(self, txt, *args):
+        if Logger._MODULE_LEVELS.get(self.name, Logger.LEVEL) <= Logger.LEVEL_WARN:
+            Logger._print('WARN', Logger.WARNING, txt, True, args)
+
+    def error(self, txt, *args):
+        if Logger._MODULE_LEVELS.get(self.name, Logger.LEVEL) <= Logger.LEVEL_ERROR:
+            Logger._print('ERROR', Logger.FAIL, txt, True, args)
@@ -0,0 +1,86 @@
+import re
+
+
+# 3-5 capitals; trailing punctuation is not part of the symbol
+TICKER_PATTERN = r'\b[A-Z]{3,5}\b'
+
+
+class WordHit(object):
+    __slots__ = ('word', 'start')
+
+    def __init__(self, word: str, start: int):
+        self.word = word
+        self.start = start
+
+    def __repr__(self):
+        return f'{self.word}@{self.start}'
+
+
+class MatchResult(object):
+    __slots__ = ('tickers', 'hits')
+
+    def __init__(self, tickers: list, hits: list):
+        self.tickers = tickers
+        self.hits = hits
+
+    @property
+    def negative_bias(self) -> bool:
+        return len(self.hits) > 0
+
+
+def _trie_pattern(words: list) -> str:
+    """
+    Returns a regex alternation of words factored by common prefix so each
+    position is matched in O(word length) instead of O(number of words).
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        # empty key marks the end of a word
+        node[''] = {}
+
+    def build(node: dict) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char != '']
+        if len(branches) == 0:
+            return ''
+        # greedy optional group so the longest word wins when one is a prefix of another
+        if '' in node:
+            return '(?:' + '|'.join(branches) + ')?'
+        if len(branches) == 1:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')'
+
+    return build(trie)
+
+
+class TextMatcher(object):
+    """
+    Finds ticker candidates and negative words in a message with two
+    precompiled scans: tickers over the raw text, words over its lowercase.
+    """
+    def __init__(self, words: list):
+        self.words = words
+        lowered = sorted(set(word.lower() for word in words if len(word) > 0))
+        # words are found anywhere in the lowercased text, like the old `word in text.lower()` checks
+        self.__word_regex = re.compile(_trie_pattern(lowered)) if len(lowered) > 0 else None
+        self.__ticker_regex = re.compile(TICKER_PATTERN)
+
+    def match(self, text: str) -> MatchResult:
+        """
+        Returns tickers (in order of appearance) and negative word hits in text.
+        """
+        if not isinstance(text, str):
+            raise TypeError('Expected str for text!')
+
+        tickers = self.__ticker_regex.findall(text)
+        hits = []
+        if self.__word_regex is not None:
+            low_text = text.lower()
+            # most messages have no hits; a plain search is cheaper than setting up finditer
+            first = self.__word_regex.search(low_text)
+            if first is not None:
+                hits = [WordHit(match.group(), match.start()) for match in self.__word_regex.finditer(low_text, first.start())]
+
+        return MatchResult(tickers, hits)
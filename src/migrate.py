@@ -0,0 +1,25 @@
+import os
+import sys
+
+import constants as ct
+from logger import Logger
+from storage import JsonStorage, SqliteStorage
+
+log = Logger.get('migrate')
+
+
+# Copies portfolio, wallet (journal included) & watchlist from the json
+# files in a db directory into its SQLite database. Run with the trader
+# stopped.
+#
+# usage: python migrate.py [db dir, default ../db]
+
+if __name__ == '__main__':
+    db_dir = sys.argv[1] if len(sys.argv) > 1 else '../db'
+    if not os.path.exists(os.path.join(db_dir, 'wallet.json')):
+        log.error('No wallet.json in %s; nothing to migrate', db_dir)
+        sys.exit(1)
+
+    path = os.path.join(db_dir, ct.SQLITE_DB)
+    copied = SqliteStorage(path).import_from(JsonStorage(db_dir))
+    log.info('Copied %s rows from %s to %s', copied, db_dir, path)
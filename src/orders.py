@@ -0,0 +1,242 @@
+import random
+from collections import deque
+from threading import Lock
+
+import clock
+import constants as ct
+from logger import Logger
+
+log = Logger.get('orders')
+
+
+def parse_order_id(response: dict) -> int:
+    """
+    Returns the broker's order id from a place order response or None.
+    """
+    if response is not None and len(response.get('OrderIds', [])) > 0:
+        return response['OrderIds'][0].get('orderId')
+    return None
+
+
+class Order(object):
+    __slots__ = ('client_id', 'symbol', 'action', 'quantity', 'limit_price', 'state', 'filled', 'value', 'order_id', 'placed_at', 'reservation')
+
+    NEW = 'NEW'
+    PARTIAL = 'PARTIAL'
+    FILLED = 'FILLED'
+    CANCELLED = 'CANCELLED'
+
+    BUY = 'BUY'
+    SELL = 'SELL'
+
+    def __init__(self, client_id: int, symbol: str, action: str, quantity: int, limit_price: float, reservation: 'Reservation' = None):
+        self.client_id = client_id
+        self.symbol = symbol
+        self.action = action
+        self.quantity = quantity
+        self.limit_price = limit_price
+        self.state = Order.NEW
+        # shares filled so far and what they cost (buys) or brought in (sells)
+        self.filled = 0
+        self.value = 0.0
+        # broker's id, known once placed
+        self.order_id = None
+        self.placed_at = clock.time()
+        # ledger reservation holding the cost of a buy
+        self.reservation = reservation
+
+    @property
+    def open(self) -> bool:
+        return self.state == Order.NEW or self.state == Order.PARTIAL
+
+    @property
+    def remaining(self) -> int:
+        return self.quantity - self.filled
+
+    def as_row(self) -> dict:
+        """
+        Returns what it takes to pick up the order again after a restart.
+        """
+        return {'client_id': self.client_id, 'order_id': self.order_id, 'symbol': self.symbol, 'action': self.action, 'quantity': self.quantity,
+                'limit_price': self.limit_price, 'placed_at': self.placed_at, 'reserved': None if self.reservation is None else self.reservation.amount}
+
+    def as_dict(self) -> dict:
+        return {'client_id': self.client_id, 'order_id': self.order_id, 'symbol': self.symbol, 'action': self.action, 'quantity': self.quantity,
+                'limit_price': self.limit_price, 'state': self.state, 'filled': self.filled, 'value': self.value, 'placed_at': self.placed_at}
+
+
+class OrderBook(object):
+    """
+    Orders we placed, tracked by client order id until they're done with.
+    Fills reported by the broker move them NEW -> PARTIAL -> FILLED; orders
+    that are rejected or outlive ORDER_MAX_AGE end up CANCELLED. The cost of
+    a buy stays reserved in the ledger until then and is settled for what
+    actually filled. Open orders are journaled with the portfolio, so after
+    a restart their reservations are held again and their fills still match.
+    """
+    def __init__(self, ledger: 'Ledger', store: 'PositionStore' = None):
+        self.__ledger = ledger
+        self.__store = store
+        self.__lock = Lock()
+        # client order id -> open Order
+        self.__orders = {}
+        # broker order id -> client order id
+        self.__by_order_id = {}
+        # recently closed orders, oldest first
+        self.history = deque(maxlen=1000)
+
+        if store is not None:
+            self.__restore(store.orders())
+
+    def __restore(self, rows: list) -> None:
+        for row in rows:
+            reservation = None if row['reserved'] is None else self.__ledger.restore(row['reserved'], row['symbol'])
+            order = Order(row['client_id'], row['symbol'], row['action'], row['quantity'], row['limit_price'], reservation)
+            # fills are counted again from scratch: the first sync after a
+            # restart covers the whole order history
+            order.order_id = row['order_id']
+            order.placed_at = row['placed_at']
+            self.__orders[order.client_id] = order
+            if order.order_id is not None:
+                self.__by_order_id[order.order_id] = order.client_id
+        if len(rows) > 0:
+            log.info('Restored %d open orders, %s reserved', len(rows), self.__ledger.reserved)
+
+    def __journal(self, order: Order) -> None:
+        # caller holds self.__lock
+        if self.__store is None:
+            return
+        if order.open:
+            self.__store.put_order(order.as_row())
+        else:
+            self.__store.drop_order(order.client_id)
+
+    def open(self, symbol: str, action: str, quantity: int, limit_price: float, reservation: 'Reservation' = None) -> Order:
+        """
+        Starts tracking an order about to be submitted.
+        """
+        self.__lock.acquire()
+        try:
+            client_id = random.randint(1000000000, 9999999999)
+            while client_id in self.__orders:
+                client_id = random.randint(1000000000, 9999999999)
+            order = self.__orders[client_id] = Order(client_id, symbol, action, quantity, limit_price, reservation)
+            self.__journal(order)
+            return order
+        finally:
+            self.__lock.release()
+
+    def placed(self, order: Order, order_id: int) -> None:
+        """
+        Records the broker's id of a submitted order so its fills can be told apart.
+        """
+        self.__lock.acquire()
+        try:
+            if order_id is None:
+                log.warn('No order id for %s order of %s; matching fills by symbol', order.action, order.symbol)
+            elif order.order_id is None:
+                order.order_id = order_id
+                self.__by_order_id[order_id] = order.client_id
+                if order.open:
+                    self.__journal(order)
+        finally:
+            self.__lock.release()
+
+    def cancel(self, order: Order) -> None:
+        """
+        Gives up on order (rejected, cancelled or expired); whatever filled still counts.
+        """
+        self.__lock.acquire()
+        try:
+            if order.open:
+                self.__close(order, Order.CANCELLED)
+        finally:
+            self.__lock.release()
+
+    def apply(self, fill: 'Fill') -> Order:
+        """
+        Counts a fill delta against the order it belongs to.
+
+        :returns: that order or None if it isn't one of ours (placed by hand or before a restart)
+        """
+        self.__lock.acquire()
+        try:
+            client_id = self.__by_order_id.get(fill.order_id)
+            order = self.__orders.get(client_id) if client_id is not None else self.__match(fill)
+            if order is None:
+                return None
+
+            order.filled += abs(fill.shares)
+            order.value += abs(fill.value)
+
+            if order.filled >= order.quantity:
+                self.__close(order, Order.FILLED)
+            elif order.filled > 0:
+                order.state = Order.PARTIAL
+            return order
+        finally:
+            self.__lock.release()
+
+    def __match(self, fill: 'Fill') -> Order:
+        # caller holds self.__lock
+        # fills can show up before placed() had the broker id; take the oldest
+        # open order that could be it. Orders placed before it was opened (a
+        # minute of slack for the broker's clock) can't be: the sync after a
+        # restart brings all of them.
+        action = Order.BUY if fill.shares >= 0 else Order.SELL
+        for order in self.__orders.values():
+            if order.order_id is None and order.symbol == fill.symbol and order.action == action and fill.placed_at >= order.placed_at - 60:
+                order.order_id = fill.order_id
+                self.__by_order_id[fill.order_id] = order.client_id
+                self.__journal(order)
+                return order
+        return None
+
+    def __close(self, order: Order, state: str) -> None:
+        # caller holds self.__lock
+        order.state = state
+        del self.__orders[order.client_id]
+        self.__by_order_id.pop(order.order_id, None)
+        self.history.append(order)
+        self.__journal(order)
+
+        if order.reservation is not None and order.reservation.open:
+            if order.value > 0:
+                self.__ledger.settle(order.reservation, order.value)
+            else:
+                self.__ledger.release(order.reservation)
+
+    def expire(self, now: float = None) -> list:
+        """
+        Cancels open orders older than ORDER_MAX_AGE. Returns them.
+        """
+        now = clock.time() if now is None else now
+        self.__lock.acquire()
+        try:
+            expired = [order for order in self.__orders.values() if now - order.placed_at > ct.ORDER_MAX_AGE]
+            for order in expired:
+                self.__close(order, Order.CANCELLED)
+            return expired
+        finally:
+            self.__lock.release()
+
+    def get(self, client_id: int) -> Order:
+        return self.__orders.get(client_id)
+
+    def open_orders(self, symbol: str = None) -> list:
+        """
+        Returns open orders, of symbol only if given.
+        """
+        self.__lock.acquire()
+        result = [order for order in self.__orders.values() if symbol is None or order.symbol == symbol]
+        self.__lock.release()
+        return result
+
+    def pending(self, symbol: str, action: str) -> int:
+        """
+        Returns shares of symbol still to be bought/sold by open orders.
+        """
+        self.__lock.acquire()
+        result = sum(order.remaining for order in self.__orders.values() if order.symbol == symbol and order.action == action)
+        self.__lock.release()
+        return result
@@ -1,21 +1,29 @@
 import math
-import os
 
-from tinydb import TinyDB, Query
 import constants as ct
 from logger import Logger
-from threading import Lock
+from position_store import PositionStore
+from ledger import Ledger, Reservation
+from orders import OrderBook, Order
+from storage import open_storage
+
+log = Logger.get('portfolio')
+
 
 class Portfolio(object):
     DEBUG=True
     def __init__(self):
-        # initialize portfolio db which holds our current stakes
-        self.__portfolio = TinyDB('db/portfolio.json')
-        self.__portfolio_lock = Lock()
-        # initialize db which holds how much money we
-        # have left to spend and how much we have made
-        self.__wallet = TinyDB('db/wallet.json')
-        self.__wallet_lock = Lock()
+        # initialize in-memory store which holds our current stakes and
+        # how much money we have left to spend and how much we have made
+        self.__store = PositionStore(open_storage())
+        self.__store.start()
+        # balance changes and reservations of pending orders
+        self.__ledger = Ledger(self.__store)
+        # orders in flight, until fills (or the lack of them) settle them;
+        # those left open by the last run are picked up again
+        self.__orders = OrderBook(self.__ledger, self.__store)
+        # set by set_watchdog
+        self.__watchdog = None
 
     @staticmethod
     def initialize_wallet(balance_in: int) -> None:
@@ -25,39 +33,40 @@ class Portfolio(object):
         :param balance_in: amount of capital available for investment
         :return: None
         """
-        # Check if wallet is already initialized
-        if os.path.exists('db/wallet.json'):
+        # Initialize wallet unless it already is
+        if not open_storage().initialize_wallet(balance_in):
             if Portfolio.DEBUG:
-                Logger.warn('Wallet already initialized')
+                log.warn('Wallet already initialized')
             return
 
-        # Initialize wallet
-        with TinyDB('db/wallet.json') as db:
-            db.insert({'in': balance_in, 'out': 0})
-
         if Portfolio.DEBUG:
-            Logger.debug('Wallet initialized!')
+            log.debug('Wallet initialized!')
 
     def set_watchdog(self, wd):
         self.__watchdog = wd
 
+    @property
+    def store(self) -> PositionStore:
+        return self.__store
+
+    @property
+    def ledger(self) -> Ledger:
+        return self.__ledger
+
+    @property
+    def orders(self) -> OrderBook:
+        return self.__orders
+
     @property
     def balance(self):
-        self.__wallet_lock.acquire()
-        result = self.__wallet.all()[0]['in']
-        self.__wallet_lock.release()
-        return result
-        
-    def __subtract_from_balance(self, amount: int):
-        """
-        Subtracts given currency amount from balance
+        return self.__ledger.balance
 
-        :returns: None
+    @property
+    def available(self):
+        """
+        Balance not reserved by orders in flight.
         """
-        balance = self.balance
-        self.__wallet_lock.acquire()
-        self.__wallet.update({'in': balance - amount})
-        self.__wallet_lock.release()
+        return self.__ledger.available
 
     @property
     def portfolio(self):
@@ -65,51 +74,66 @@ class Portfolio(object):
         Returns portfolio in the shape of a dict indexed by
         ticker containing properties corresponding to each ticker.
         """
-        self.__portfolio_lock.acquire()
-        obj = {}
-        for k in self.__portfolio:
-            obj[k['ticker']] = k
-        self.__portfolio_lock.release()
-        return obj
+        return self.__store.rows()
 
-    def sync_order_fills(self, orders: dict):
+    def sync_order_fills(self, fills: list, complete: bool = False):
         """
-        Synchronizes order fills to portfolio db.
+        Applies order fills to portfolio as deltas and moves the orders they
+        belong to along.
 
-        :param orders: dict from ticker (str) to tuple of (share_no (int), total_value (float))
+        :param fills: Fill objects holding what each order filled since last sync, oldest first
+        :param complete: fills cover the whole order history; positions they touch are rebuilt from them
         :return: None
         """
-        self.__portfolio_lock.acquire()
-        # cycle over each entry in dict and update share no. in db for ticker
-        for ticker, info in orders.items():
-            Logger.debug(f'Info for ticker {ticker}: {info}')
-            share_no, total_value = info
-            if self.__portfolio.contains(Query().ticker == ticker):
-                self.__portfolio.update({'shares': share_no, 'stake': total_value}, Query().ticker == ticker)
-            else:
-                # create new row
-                row = self.__get_empty_portfolio_entry(ticker)
-                row['shares'] = share_no
-                row['stake'] = total_value
-                # insert said row
-                self.__portfolio.insert(row)
-        self.__portfolio_lock.release()
-        Logger.debug('Synchronized portfolio')
+        if complete:
+            for ticker in {fill.symbol for fill in fills}:
+                self.__store.put(ticker, 0, 0)
+
+        for fill in fills:
+            log.debug('Fill of order %s for %s: %s shares, %s', fill.order_id, fill.symbol, fill.shares, fill.value)
+            # profits of history were accounted for back then
+            self.__apply_fill(fill, not complete)
+            order = self.__orders.apply(fill)
+            if order is not None:
+                log.info('%s order %s of %s: %s %s/%s', order.action, order.client_id, order.symbol, order.state, order.filled, order.quantity)
+
+        for order in self.__orders.expire():
+            log.warn('Gave up on %s order %s of %s after %s/%s filled', order.action, order.client_id, order.symbol, order.filled, order.quantity)
+            # exit rules of a position that never opened would fire on nothing to sell
+            if order.action == Order.BUY and self.__orders.pending(order.symbol, Order.BUY) == 0:
+                row = self.__store.get(order.symbol)
+                if (row is None or row['shares'] <= 0) and self.__watchdog is not None:
+                    log.info('Dropping exit rules of %s: none of it was bought', order.symbol)
+                    self.__watchdog.unsubscribe_all(order.symbol)
+
+        log.debug('Synchronized portfolio')
+
+    def __apply_fill(self, fill: 'Fill', book_profit: bool) -> None:
+        """
+        Adds a fill delta to its position. Buys add their cost to the stake;
+        sells take out the stake of the shares sold, and the rest of what
+        they brought in is profit.
+        """
+        if fill.shares >= 0:
+            self.__store.add_to_position(fill.symbol, fill.shares, fill.value)
+            return
+
+        row = self.__store.get(fill.symbol)
+        held = row['shares'] if row else 0
+        stake = row['stake'] if row else 0
+        basis = stake * min(-fill.shares, held) / held if held > 0 else 0
+        self.__store.add_to_position(fill.symbol, fill.shares, -basis)
+
+        if book_profit:
+            profit = self.__store.add_to_wallet('out', -fill.value - basis)
+            log.info('Running profit: %s', profit)
 
     def get_asset(self, ticker: str) -> dict:
         """
         Returns row associated with ticker or None.
         """
-        query = Query()
-        self.__portfolio_lock.acquire()
-        records = self.__portfolio.search(query.ticker == ticker)
-        self.__portfolio_lock.release()
-
         # no hit must mean we have zero shares for this ticker
-        if len(records) == 0:
-            return None
-
-        return records[0]
+        return self.__store.get(ticker)
 
     def usd_to_shares(self, ticker: str, currency_am: int) -> int:
         """
@@ -129,82 +153,58 @@ class Portfolio(object):
         """
         Returns tickers in portfolio.
         """
-        return list(self.portfolio.keys())
-
-    def __update_ticker(self, ticker: str, properties: dict) -> None:
-        """
-        Updates given ticker with given properties.
-        """
-        self.__portfolio_lock.acquire()
-        self.__portfolio.update(properties, Query().ticker == ticker)
-        self.__portfolio_lock.release()
+        return self.__store.tickers()
 
     def get_wallet(self) -> dict:
         """
         Retrieves wallet.
         """
-        self.__wallet_lock.acquire()
-        result = self.__wallet.all()[0]
-        self.__wallet_lock.release()
-        return result
+        return self.__store.wallet_row()
 
-    def sell_all_shares(self, ticker: str, asset: dict):
+    def sell_all_shares(self, ticker: str, asset: dict, price: float = None):
         """
-        doc
+        Sells position right away at price, the current one if omitted (paper
+        trading; live sells are accounted for as their fills come in).
         """
         # asset = self.get_asset(ticker)
+        if price is None:
+            price = self.__watchdog.get_price(ticker)
 
         # Update wallet to reflect sale
-        profit = -asset['stake'] + asset['shares'] * self.__watchdog.get_price(ticker)
-        profit += self.get_wallet()['out']
-
-        self.__wallet_lock.acquire()
-        self.__wallet.update({'out': profit})
-        self.__wallet_lock.release()
+        profit = -asset['stake'] + asset['shares'] * price
+        profit = self.__store.add_to_wallet('out', profit)
 
         # Set shares and stake for ticker to  0
-        self.__portfolio_lock.acquire()
-        self.__portfolio.update({'shares': 0, 'stake':0}, Query().ticker == ticker)
-        self.__portfolio_lock.release()
+        self.__store.put(ticker, 0, 0)
 
-        Logger.info(f'Running profit estimate: {profit}')
+        log.info('Running profit estimate: %s', profit)
 
     def add_ticker_if_inexistent(self, ticker: str) -> dict:
         """
         Adds ticker if it does not exist already to portfolio 
         and returns corresponding row.
         """
-        # get ticker
-        row = self.get_asset(ticker)
-
-        if row is None:
-            row = self.__get_empty_portfolio_entry(ticker)
-            self.__portfolio_lock.acquire()
-            self.__portfolio.insert(row)
-            self.__portfolio_lock.release()
+        return self.__store.insert_if_absent(ticker)
 
-        return row
-
-    def __get_empty_portfolio_entry(self, ticker: str) -> dict:
-        return {'shares': 0, 'ticker': ticker, 'stake':0}
-
-    def buy_shares(self, ticker: str, shares_no: int, currency_amount: int = -1):
+    def buy_shares(self, ticker: str, shares_no: int, currency_amount: int = -1, reservation: Reservation = None):
         """
-        Buys given amount of shares.
+        Buys given amount of shares right away (paper trading; live buys are
+        accounted for as their fills come in).
+
+        :param reservation: ledger reservation made for this order; settled for currency_amount
         """
         if currency_amount == -1:
             currency_amount = self.__watchdog.get_price(ticker) * shares_no
 
-        if self.balance < currency_amount:
-            Logger.error(f'Not enough balance to buy shares!')
+        # take cost out of balance
+        if reservation is not None:
+            self.__ledger.settle(reservation, currency_amount)
+        elif not self.__ledger.spend(currency_amount, ticker):
+            log.error('Not enough balance to buy shares!')
             return
 
-        row = self.add_ticker_if_inexistent(ticker)
-        # run update query
-        self.__update_ticker(ticker, {'shares': 0 if ct.LIVE_TRADING else shares_no, 'stake': 0 if ct.LIVE_TRADING else (row['stake'] + currency_amount)})
-        # recalculate outstanding balance
-        self.__subtract_from_balance(currency_amount)
+        self.__store.add_to_position(ticker, shares_no, currency_amount)
 
-        Logger.info(f'Bought {shares_no} shares of {ticker}')
-        Logger.info(f'Purchasing balance {self.balance} {ct.CURRENCY_SYMBOL}')
+        log.info('Bought %s shares of %s', shares_no, ticker)
+        log.info('Purchasing balance %s %s', self.balance, ct.CURRENCY_SYMBOL)
 
@@ -0,0 +1,279 @@
+import time
+import traceback
+from threading import Thread, Lock, Event
+
+import constants as ct
+from logger import Logger
+
+log = Logger.get('position_store')
+
+
+class Position(object):
+    __slots__ = ('ticker', 'shares', 'stake')
+
+    def __init__(self, ticker: str, shares: int = 0, stake: float = 0):
+        self.ticker = ticker
+        self.shares = shares
+        self.stake = stake
+
+    def as_dict(self) -> dict:
+        return {'shares': self.shares, 'ticker': self.ticker, 'stake': self.stake}
+
+
+class PositionStore(object):
+    """
+    Ticker-indexed positions, wallet and open orders kept in memory. Changes
+    are handed to the storage backend in the background (see storage.py).
+    """
+    def __init__(self, storage: 'JsonStorage | SqliteStorage'):
+        self.__storage = storage
+        self.__lock = Lock()
+        # serializes storage writes
+        self.__io_lock = Lock()
+        # ticker -> Position
+        self.__positions = {}
+        self.__wallet = {'in': 0, 'out': 0}
+        # client order id -> row of an order still open at the broker
+        self.__orders = {}
+        # ops not yet written to storage
+        self.__pending = []
+        self.__journal_ops = 0
+        # sequence number of the last op applied
+        self.__seq = 0
+        self.__stopped = Event()
+        self.__writer = None
+
+        self.__recover()
+
+    def __recover(self) -> None:
+        """
+        Loads last snapshot, replays journaled ops on top of it and compacts.
+        """
+        rows, wallet, seq, ops = self.__storage.load()
+        for row in rows:
+            self.__positions[row['ticker']] = Position(row['ticker'], row['shares'], row['stake'])
+        self.__wallet = wallet
+        self.__seq = seq
+        for row in self.__storage.load_orders():
+            self.__orders[row['client_id']] = row
+
+        for op in ops:
+            self.__apply(op)
+            self.__seq = max(self.__seq, op['seq'])
+
+        if len(ops) > 0:
+            log.info('Replayed %s portfolio journal entries', len(ops))
+
+        self.snapshot()
+
+    def __apply(self, op: dict) -> None:
+        if op['t'] == 'pos':
+            position = self.__positions.get(op['ticker'])
+            if position is None:
+                position = self.__positions[op['ticker']] = Position(op['ticker'])
+            position.shares = op['shares']
+            position.stake = op['stake']
+        elif op['t'] == 'wallet':
+            if 'delta' in op:
+                self.__wallet[op['field']] += op['delta']
+            else:
+                self.__wallet[op['field']] = op['value']
+        elif op['t'] == 'order':
+            if op['order'] is None:
+                self.__orders.pop(op['client_id'], None)
+            else:
+                self.__orders[op['client_id']] = op['order']
+
+    def __log(self, op: dict) -> None:
+        # caller holds self.__lock
+        self.__seq += 1
+        op['seq'] = self.__seq
+        self.__pending.append(op)
+
+    def start(self) -> None:
+        """
+        Starts background writer.
+        """
+        self.__writer = Thread(target=self.__run, name='position-store-writer')
+        self.__writer.daemon = True
+        self.__writer.start()
+
+    def stop(self) -> None:
+        """
+        Stops background writer after writing out what is pending.
+        """
+        self.__stopped.set()
+        if self.__writer is not None:
+            self.__writer.join()
+        self.flush()
+
+    def __run(self):
+        last_snapshot = time.monotonic()
+        while not self.__stopped.wait(ct.PORTFOLIO_FLUSH_PERIOD):
+            try:
+                self.flush()
+                if time.monotonic() - last_snapshot >= ct.PORTFOLIO_SNAPSHOT_PERIOD and self.__journal_ops > 0:
+                    self.snapshot()
+                    last_snapshot = time.monotonic()
+            except Exception as ex:
+                log.error('Exception %s while persisting portfolio', ex)
+                log.error(traceback.format_exc())
+
+    def flush(self) -> None:
+        """
+        Writes pending ops to storage.
+        """
+        self.__io_lock.acquire()
+        try:
+            self.__flush()
+        finally:
+            self.__io_lock.release()
+
+    def __flush(self) -> None:
+        # caller holds self.__io_lock
+        self.__lock.acquire()
+        ops = self.__pending
+        self.__pending = []
+        self.__lock.release()
+
+        if len(ops) > 0:
+            self.__storage.write(ops)
+            self.__journal_ops += len(ops)
+
+    def snapshot(self) -> None:
+        """
+        Writes pending ops and lets storage compact them into a full snapshot.
+        """
+        self.__io_lock.acquire()
+        try:
+            self.__flush()
+            self.__lock.acquire()
+            rows = [position.as_dict() for position in self.__positions.values()]
+            wallet = dict(self.__wallet)
+            orders = list(self.__orders.values())
+            seq = self.__seq
+            self.__lock.release()
+
+            self.__storage.compact(rows, wallet, seq, orders)
+            self.__journal_ops = 0
+        finally:
+            self.__io_lock.release()
+
+    def get(self, ticker: str) -> dict:
+        """
+        Returns row associated with ticker or None.
+        """
+        position = self.__positions.get(ticker)
+        return None if position is None else position.as_dict()
+
+    def __contains__(self, ticker: str) -> bool:
+        return ticker in self.__positions
+
+    def tickers(self) -> list:
+        return list(self.__positions.keys())
+
+    def rows(self) -> dict:
+        """
+        Returns dict of ticker -> row.
+        """
+        self.__lock.acquire()
+        result = {ticker: position.as_dict() for ticker, position in self.__positions.items()}
+        self.__lock.release()
+        return result
+
+    def put(self, ticker: str, shares: int, stake: float) -> None:
+        """
+        Creates or overwrites position for ticker.
+        """
+        self.__lock.acquire()
+        op = {'t': 'pos', 'ticker': ticker, 'shares': shares, 'stake': stake}
+        self.__apply(op)
+        self.__log(op)
+        self.__lock.release()
+
+    def add_to_position(self, ticker: str, shares: int, stake: float) -> dict:
+        """
+        Atomically adds shares and stake to position of ticker (created if
+        needed) and returns the new row.
+        """
+        self.__lock.acquire()
+        position = self.__positions.get(ticker)
+        current = (0, 0) if position is None else (position.shares, position.stake)
+        op = {'t': 'pos', 'ticker': ticker, 'shares': current[0] + shares, 'stake': current[1] + stake}
+        self.__apply(op)
+        self.__log(op)
+        row = self.__positions[ticker].as_dict()
+        self.__lock.release()
+        return row
+
+    def insert_if_absent(self, ticker: str) -> dict:
+        """
+        Adds an empty position for ticker if needed and returns its row.
+        """
+        self.__lock.acquire()
+        position = self.__positions.get(ticker)
+        if position is None:
+            op = {'t': 'pos', 'ticker': ticker, 'shares': 0, 'stake': 0}
+            self.__apply(op)
+            self.__log(op)
+            position = self.__positions[ticker]
+        row = position.as_dict()
+        self.__lock.release()
+        return row
+
+    def wallet(self, field: str):
+        return self.__wallet[field]
+
+    def wallet_row(self) -> dict:
+        self.__lock.acquire()
+        result = dict(self.__wallet)
+        self.__lock.release()
+        return result
+
+    def add_to_wallet(self, field: str, delta: float):
+        """
+        Atomically adds delta to wallet field and returns the new value.
+        """
+        self.__lock.acquire()
+        op = {'t': 'wallet', 'field': field, 'delta': delta}
+        self.__apply(op)
+        self.__log(op)
+        result = self.__wallet[field]
+        self.__lock.release()
+        return result
+
+    def set_wallet(self, field: str, value: float) -> None:
+        self.__lock.acquire()
+        op = {'t': 'wallet', 'field': field, 'value': value}
+        self.__apply(op)
+        self.__log(op)
+        self.__lock.release()
+
+    def orders(self) -> list:
+        """
+        Returns rows of open orders.
+        """
+        self.__lock.acquire()
+        result = [dict(row) for row in self.__orders.values()]
+        self.__lock.release()
+        return result
+
+    def put_order(self, row: dict) -> None:
+        """
+        Creates or overwrites the row of an open order.
+        """
+        self.__lock.acquire()
+        op = {'t': 'order', 'client_id': row['client_id'], 'order': row}
+        self.__apply(op)
+        self.__log(op)
+        self.__lock.release()
+
+    def drop_order(self, client_id: int) -> None:
+        """
+        Forgets an order that is done with.
+        """
+        self.__lock.acquire()
+        op = {'t': 'order', 'client_id': client_id, 'order': None}
+        self.__apply(op)
+        self.__log(op)
+        self.__lock.release()
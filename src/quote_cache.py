@@ -0,0 +1,125 @@
+from collections import OrderedDict
+from threading import Lock, Event
+
+import clock
+
+
+class _Flight(object):
+    __slots__ = ('done', 'price', 'error')
+
+    def __init__(self):
+        self.done = Event()
+        self.price = None
+        self.error = None
+
+
+class QuoteCache(object):
+    """
+    Short-lived, size-bounded (LRU) cache of quotes keyed by symbol.
+    Concurrent requests for a symbol that is already being fetched wait
+    for that request instead of issuing their own.
+    """
+    def __init__(self, fetch: 'callable', fetch_many: 'callable', ttl: float, max_size: int):
+        self.__fetch = fetch
+        self.__fetch_many = fetch_many
+        self.__ttl = ttl
+        self.__max_size = max_size
+        self.__lock = Lock()
+        # symbol -> (price, monotonic fetch time)
+        self.__entries = OrderedDict()
+        # symbol -> _Flight of the outstanding request
+        self.__in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __lookup(self, ticker: str, now: float):
+        # caller holds self.__lock
+        entry = self.__entries.get(ticker)
+        if entry is None:
+            return None
+        if now - entry[1] > self.__ttl:
+            del self.__entries[ticker]
+            return None
+        self.__entries.move_to_end(ticker)
+        return entry[0]
+
+    def __store(self, ticker: str, price: float, fetched_at: float) -> None:
+        # caller holds self.__lock; prices we couldn't get are not worth keeping
+        if price is None or price <= 0:
+            return
+        self.__entries[ticker] = (price, fetched_at)
+        self.__entries.move_to_end(ticker)
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last=False)
+
+    def get(self, ticker: str) -> float:
+        """
+        Returns price of ticker, fetching it if we don't have a fresh one.
+        """
+        return self.get_many([ticker])[ticker]
+
+    def get_many(self, tickers: list) -> dict:
+        """
+        Returns dict of ticker -> price, fetching every stale ticker in one batch.
+        """
+        prices = {}
+        waiting = {}
+        leading = {}
+
+        self.__lock.acquire()
+        now = clock.monotonic()
+        for ticker in tickers:
+            if ticker in prices or ticker in waiting or ticker in leading:
+                continue
+
+            price = self.__lookup(ticker, now)
+            if price is not None:
+                self.hits += 1
+                prices[ticker] = price
+            elif ticker in self.__in_flight:
+                self.coalesced += 1
+                waiting[ticker] = self.__in_flight[ticker]
+            else:
+                self.misses += 1
+                leading[ticker] = self.__in_flight[ticker] = _Flight()
+        self.__lock.release()
+
+        if len(leading) > 0:
+            fetched = {}
+            error = None
+            try:
+                if len(leading) == 1:
+                    ticker = next(iter(leading))
+                    fetched[ticker] = self.__fetch(ticker)
+                else:
+                    fetched = self.__fetch_many(list(leading))
+            except Exception as ex:
+                error = ex
+
+            self.__lock.acquire()
+            fetched_at = clock.monotonic()
+            for ticker, flight in leading.items():
+                flight.price = fetched.get(ticker)
+                flight.error = error
+                self.__store(ticker, flight.price, fetched_at)
+                del self.__in_flight[ticker]
+                flight.done.set()
+            self.__lock.release()
+
+            if error is not None:
+                raise error
+
+            for ticker in leading:
+                prices[ticker] = leading[ticker].price
+
+        for ticker, flight in waiting.items():
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            prices[ticker] = flight.price
+
+        return prices
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'size': len(self.__entries)}
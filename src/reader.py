@@ -1,10 +1,11 @@
 from telegram.client import Telegram
 from trader import Trader
-import re
 from logger import Logger
-import credentials as cd
 import constants as ct
 import traceback
+import time
+from signal_queue import SignalPipeline
+from matcher import TextMatcher
 
 # Author: drw
 # Date:   Jan 2021
@@ -12,16 +13,27 @@ import traceback
 # debug flag
 DEBUG = True
 
+log = Logger.get('reader')
+
 class Reader(object):
-    def __init__(self):
+    def __init__(self, trader: Trader = None):
         # initialize trader
-        self.__trader = Trader()
+        self.__trader = Trader() if trader is None else trader
+        # buy signals are handed off to workers so telegram callbacks never wait on the broker
+        self.__pipeline = SignalPipeline(self.__trader.handle_buy_sig, ct.SIGNAL_WORKERS, ct.SIGNAL_QUEUE_SIZE)
+        # compile ticker & negative word matcher once
+        self.__matcher = TextMatcher(ct.NEGATIVE_WORDS)
+
+    @property
+    def pipeline(self) -> SignalPipeline:
+        return self.__pipeline
 
     def __payload_contract(self, payload: dict):
         if not isinstance(payload, dict):
             raise TypeError('Expected dict for payload!')
 
     def __new_msg_handler(self, payload: dict) -> None:
+        received_at = time.perf_counter()
         self.__payload_contract(payload)
         # validate packet
         if 'message' not in payload or 'chat_id' not in payload['message']:
@@ -32,47 +44,46 @@ class Reader(object):
         # filter if filter is enabled
         if ct.TG_FILTER_ENABLED and chat_id not in ct.TG_CHAT_ID_FILTER:
             if DEBUG:
-                Logger.debug(f'Ignoring messages from: {chat_id}')
+                log.debug('Ignoring messages from: %s', chat_id)
             return
 
         if DEBUG:
-            Logger.debug(f'payload: {payload}')
+            log.debug('payload: %s', payload)
 
         # handle by type
         if payload['@type'] == 'updateNewMessage':
-            self._handle_update_new_message(payload['message']['content'])
+            self._handle_update_new_message(payload['message']['content'], received_at)
 
-    def _handle_update_new_message(self, payload: dict) -> None:
+    def _handle_update_new_message(self, payload: dict, received_at: float = None) -> None:
         self.__payload_contract(payload)
         # handle by type
         if payload['@type'] == 'messageText' and ('text' in payload):
-            self._handle_message_text(payload['text'])
+            self._handle_message_text(payload['text'], received_at)
 
-    def _handle_message_text(self, payload: dict) -> None:
+    def _handle_message_text(self, payload: dict, received_at: float = None) -> None:
         self.__payload_contract(payload)
         # handle by type
         if payload['@type'] == 'formattedText' and 'text' in payload:
             actual_text = payload['text']
 
+            # rebuild matcher if the word list was swapped out
+            if self.__matcher.words is not ct.NEGATIVE_WORDS:
+                self.__matcher = TextMatcher(ct.NEGATIVE_WORDS)
 
-            tickers = self._make_out_tickers(actual_text)
+            # find tickers and negative bias in one pass
+            result = self.__matcher.match(actual_text)
+            tickers = result.tickers
+            negative_bias = result.negative_bias
 
             if DEBUG:
-                Logger.debug(f'Text received {actual_text}')
-
-            negative_bias = False
-            # get lowercase text
-            low_actual_text = actual_text.lower()
-            # see if we can find any negative bias
-            for negative_word in ct.NEGATIVE_WORDS:
-                if negative_word in low_actual_text:
-                    negative_bias = True
-                    break
-
-            # buy each ticker
+                log.debug('Text received %s', actual_text)
+                if negative_bias:
+                    log.debug('Negative words: %s', result.hits)
+
+            # queue up each ticker for buying
             for ticker in tickers:
-                Logger.debug(f'>> TICKER: {ticker}')
-                self.__trader.handle_buy_sig(ticker, negative_bias=negative_bias)
+                log.debug('>> TICKER: %s', ticker)
+                self.__pipeline.submit(ticker, negative_bias, received_at)
         
     def _make_out_tickers(self, txt: str) -> [str]:
         """
@@ -81,21 +92,33 @@ class Reader(object):
         if not isinstance(txt, str):
             raise TypeError('Expected str for txt!')
 
-        return re.findall(r'\b[A-Z]{3,5}\b[.!?]?', txt) 
+        return self.__matcher.match(txt).tickers
+
+    def handle_payload(self, payload: dict) -> None:
+        """
+        Entry point for raw TDLib payloads (telegram callback & replays).
+        """
+        self.__new_msg_handler(payload)
 
     def run(self):
+        import credentials as cd
+
         # authenticate
         tg = Telegram(api_id=cd.TG_API_ID, api_hash=cd.TG_API_HASH, phone=cd.TG_PHONE_NO, database_encryption_key=cd.TG_DB_KEY)
         tg.login()
         # setup handlers 
-        tg.add_message_handler(self.__new_msg_handler)
+        tg.add_message_handler(self.handle_payload)
         # wait for async callbacks
         tg.idle()
 
 if __name__ == '__main__':
+    # keep file & console writes off the telegram, watchdog and order threads
+    Logger.configure(ct.LOG_LEVEL, ct.LOG_MODULE_LEVELS)
+    Logger.start_async()
     try:
         reader = Reader()
         reader.run()
     except Exception as e:
-        Logger.error(f'Exception happened: {e}')
-        Logger.error(traceback.format_exc())
+        log.error('Exception happened: %s', e)
+        log.error(traceback.format_exc())
+    Logger.flush()
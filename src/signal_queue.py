@@ -0,0 +1,204 @@
+import heapq
+import time
+import traceback
+from collections import deque
+from threading import Thread, Condition, Lock
+
+from logger import Logger
+
+log = Logger.get('signal_queue')
+
+
+class Signal(object):
+    __slots__ = ('priority', 'seq', 'ticker', 'negative_bias', 'received_at')
+
+    def __init__(self, priority: int, seq: int, ticker: str, negative_bias: bool, received_at: float):
+        self.priority = priority
+        self.seq = seq
+        self.ticker = ticker
+        self.negative_bias = negative_bias
+        self.received_at = received_at
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class SignalQueue(object):
+    """
+    Bounded priority queue of buy signals. A ticker is only accepted once
+    until the signal holding it has been marked done.
+    """
+    # signals without negative bias are worth more to us so they go first
+    PRIORITY_NORMAL = 0
+    PRIORITY_NEGATIVE_BIAS = 1
+
+    def __init__(self, max_size: int):
+        self.__heap = []
+        self.__max_size = max_size
+        lock = Lock()
+        self.__cond = Condition(lock)
+        # notified when the last pending signal is done
+        self.__idle = Condition(lock)
+        # tickers queued or being worked on
+        self.__pending = set()
+        self.__seq = 0
+        self.__closed = False
+        self.max_depth = 0
+        self.dropped = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self.__heap)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.__pending) - len(self.__heap)
+
+    def put(self, ticker: str, negative_bias: bool = False, received_at: float = None) -> bool:
+        """
+        Enqueues signal for ticker.
+
+        :returns: False if ticker is already pending or the queue is full
+        """
+        priority = SignalQueue.PRIORITY_NEGATIVE_BIAS if negative_bias else SignalQueue.PRIORITY_NORMAL
+        received_at = time.perf_counter() if received_at is None else received_at
+
+        with self.__cond:
+            if ticker in self.__pending:
+                log.debug('Signal for %s already in flight. Dropping duplicate', ticker)
+                return False
+
+            if len(self.__heap) >= self.__max_size:
+                self.dropped += 1
+                log.error('Signal queue full. Dropping signal for %s', ticker)
+                return False
+
+            self.__seq += 1
+            heapq.heappush(self.__heap, Signal(priority, self.__seq, ticker, negative_bias, received_at))
+            self.__pending.add(ticker)
+            self.max_depth = max(self.max_depth, len(self.__heap))
+            self.__cond.notify()
+
+        return True
+
+    def get(self) -> Signal:
+        """
+        Blocks until a signal is available and returns the most urgent one,
+        or None once the queue is closed and empty.
+        """
+        with self.__cond:
+            while len(self.__heap) == 0 and not self.__closed:
+                self.__cond.wait()
+            if len(self.__heap) == 0:
+                return None
+            return heapq.heappop(self.__heap)
+
+    def close(self) -> None:
+        """
+        Wakes up every getter; they get None once the queue is empty.
+        """
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+
+    def done(self, signal: Signal) -> None:
+        """
+        Releases the ticker of a processed signal.
+        """
+        with self.__cond:
+            self.__pending.discard(signal.ticker)
+            if len(self.__pending) == 0:
+                self.__idle.notify_all()
+
+    def join(self) -> None:
+        """
+        Blocks until every signal put so far has been processed.
+        """
+        with self.__idle:
+            while len(self.__pending) > 0:
+                self.__idle.wait()
+
+
+class SignalPipeline(object):
+    """
+    Worker pool draining a SignalQueue into a buy handler.
+    """
+    def __init__(self, handler: 'callable', workers: int, max_size: int):
+        self.__handler = handler
+        self.__queue = SignalQueue(max_size)
+        # signal receipt -> order submission latencies (seconds)
+        self.__latencies = deque(maxlen=1000)
+        self.__latency_lock = Lock()
+        self.processed = 0
+        self.__workers = []
+
+        for i in range(workers):
+            worker = Thread(target=self.__work, name=f'signal-worker-{i}')
+            worker.daemon = True
+            worker.start()
+            self.__workers.append(worker)
+
+    def submit(self, ticker: str, negative_bias: bool = False, received_at: float = None) -> bool:
+        """
+        Hands signal off to the worker pool without waiting on it.
+        """
+        return self.__queue.put(ticker, negative_bias, received_at)
+
+    def join(self) -> None:
+        """
+        Waits for the workers to finish every signal submitted so far.
+        """
+        self.__queue.join()
+
+    def close(self) -> None:
+        """
+        Lets the workers finish what is queued and stops them.
+        """
+        self.__queue.close()
+        for worker in self.__workers:
+            worker.join()
+
+    def __work(self):
+        while True:
+            signal = self.__queue.get()
+            if signal is None:
+                return
+
+            try:
+                ordered = self.__handler(signal.ticker, negative_bias=signal.negative_bias)
+
+                if ordered:
+                    latency = time.perf_counter() - signal.received_at
+                    self.__latency_lock.acquire()
+                    self.__latencies.append(latency)
+                    self.processed += 1
+                    self.__latency_lock.release()
+                    log.info('Order for %s submitted %.1f ms after signal (queue depth: %s)', signal.ticker, latency * 1000, self.__queue.depth)
+            except Exception as ex:
+                log.error('Exception %s while handling signal for %s', ex, signal.ticker)
+                log.error(traceback.format_exc())
+            finally:
+                self.__queue.done(signal)
+
+    def metrics(self) -> dict:
+        """
+        Returns queue depth and signal-to-order latency figures (ms).
+        """
+        self.__latency_lock.acquire()
+        latencies = sorted(self.__latencies)
+        self.__latency_lock.release()
+
+        def percentile(p: float) -> float:
+            if len(latencies) == 0:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+
+        return {
+            'depth': self.__queue.depth,
+            'in_flight': self.__queue.in_flight,
+            'max_depth': self.__queue.max_depth,
+            'dropped': self.__queue.dropped,
+            'processed': self.processed,
+            'p50_ms': percentile(0.5),
+            'p99_ms': percentile(0.99),
+        }
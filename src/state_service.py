@@ -0,0 +1,176 @@
+import json
+import os
+import socket
+import socketserver
+import threading
+import traceback
+from threading import Thread
+
+from logger import Logger
+
+log = Logger.get('state_service')
+
+
+class StateService(object):
+    """
+    Serves the trader's in-memory portfolio, wallet & watchlist to other
+    processes (i.e. the webserver) over a unix socket, so every write goes
+    through the one process that owns the data.
+
+    Requests and responses are json lines: {"m": method, "a": [args]} ->
+    {"r": result} or {"e": error}.
+    """
+    def __init__(self, store: 'PositionStore', ledger: 'Ledger', rules: 'ThresholdIndex', path: str):
+        self.__store = store
+        # balance ('in') changes are recorded by the ledger
+        self.__ledger = ledger
+        self.__rules = rules
+        self.__path = path
+        self.__server = None
+        self.__methods = {
+            'wallet': self.__wallet,
+            'set_wallet': self.__set_wallet,
+            'add_to_wallet': self.__add_to_wallet,
+            'positions': self.__positions,
+            'watchlist': self.__watchlist,
+            'set_threshold': self.__set_threshold,
+        }
+
+    def start(self) -> None:
+        """
+        Starts serving on the socket; a stale socket of a previous run is replaced.
+        """
+        if os.path.exists(self.__path):
+            os.remove(self.__path)
+
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    self.wfile.write(service.handle(line))
+                    self.wfile.flush()
+
+        self.__server = socketserver.ThreadingUnixStreamServer(self.__path, Handler)
+        self.__server.daemon_threads = True
+        server = Thread(target=self.__server.serve_forever, name='state-service')
+        server.daemon = True
+        server.start()
+        log.info('State service listening on %s', self.__path)
+
+    def stop(self) -> None:
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+        if os.path.exists(self.__path):
+            os.remove(self.__path)
+
+    def handle(self, line: bytes) -> bytes:
+        """
+        Executes one request line and returns the response line.
+        """
+        try:
+            request = json.loads(line)
+            method = self.__methods.get(request.get('m'))
+            if method is None:
+                raise Exception(f'Unknown method {request.get("m")}')
+            response = {'r': method(*request.get('a', []))}
+        except Exception as ex:
+            log.error('State service request failed: %s', ex)
+            log.error(traceback.format_exc())
+            response = {'e': str(ex)}
+        return (json.dumps(response) + '\n').encode()
+
+    def __wallet(self) -> dict:
+        return self.__store.wallet_row()
+
+    def __set_wallet(self, field: str, value: float) -> None:
+        if field == 'in':
+            self.__ledger.set_balance(value, 'state service')
+        else:
+            self.__store.set_wallet(field, value)
+        # readers of the snapshot files (status page) should see this right away
+        self.__store.snapshot()
+
+    def __add_to_wallet(self, field: str, delta: float) -> float:
+        if field == 'in':
+            return self.__ledger.deposit(delta, 'state service')
+        return self.__store.add_to_wallet(field, delta)
+
+    def __positions(self) -> list:
+        return list(self.__store.rows().values())
+
+    def __watchlist(self) -> list:
+        return [rule.as_dict() for ticker in self.__rules.tickers() for rule in self.__rules.rules(ticker)]
+
+    def __set_threshold(self, ticker: str, identifier: str, threshold: float) -> bool:
+        """
+        Moves one take-profit or stop-loss rule of ticker. Returns True if it was moved.
+        """
+        return self.__rules.set_threshold(ticker, identifier, threshold)
+
+
+class StateClient(object):
+    """
+    Thin client of StateService; each thread keeps its own connection.
+    Raises ConnectionError if no service is listening.
+    """
+    def __init__(self, path: str):
+        self.__path = path
+        self.__local = threading.local()
+
+    def __connection(self):
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.__path)
+            except (FileNotFoundError, ConnectionRefusedError) as ex:
+                sock.close()
+                raise ConnectionError(f'State service not running at {self.__path}') from ex
+            connection = self.__local.connection = (sock, sock.makefile('rb'))
+        return connection
+
+    def call(self, method: str, *args):
+        sock, reader = self.__connection()
+        try:
+            sock.sendall((json.dumps({'m': method, 'a': args}) + '\n').encode())
+            line = reader.readline()
+        except OSError as ex:
+            self.close()
+            raise ConnectionError('Lost connection to state service') from ex
+
+        if not line:
+            self.close()
+            raise ConnectionError('State service closed the connection')
+
+        response = json.loads(line)
+        if 'e' in response:
+            raise Exception(f'State service error: {response["e"]}')
+        return response['r']
+
+    def close(self) -> None:
+        connection = getattr(self.__local, 'connection', None)
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+            self.__local.connection = None
+
+    def wallet(self) -> dict:
+        return self.call('wallet')
+
+    def set_wallet(self, field: str, value: float) -> None:
+        self.call('set_wallet', field, value)
+
+    def add_to_wallet(self, field: str, delta: float) -> float:
+        return self.call('add_to_wallet', field, delta)
+
+    def positions(self) -> list:
+        return self.call('positions')
+
+    def watchlist(self) -> list:
+        return self.call('watchlist')
+
+    def set_threshold(self, ticker: str, identifier: str, threshold: float) -> bool:
+        return self.call('set_threshold', ticker, identifier, threshold)
@@ -0,0 +1,418 @@
+import json
+import os
+import sqlite3
+import threading
+from threading import Lock
+
+import constants as ct
+from logger import Logger
+
+log = Logger.get('storage')
+
+# Persistence of portfolio, wallet, open orders & watchlist. Two interchangeable backends:
+#
+#   JsonStorage    TinyDB-format json files + an append-only journal of ops
+#   SqliteStorage  one SQLite database in WAL mode
+#
+# Both take the ops PositionStore produces ({'t': 'pos', ...},
+# {'t': 'wallet', 'field', 'delta' | 'value'} and {'t': 'order', 'client_id',
+# 'order': row | None}) and serve the rows the webserver reads.
+
+TABLES = ('wallet', 'portfolio', 'watchlist')
+# kinds of watchlist rules (see thresholds.Rule)
+TAKE_PROFIT = 'take_profit'
+STOP_LOSS = 'stop_loss'
+TRAILING = 'trailing'
+EXPIRY = 'expiry'
+# kinds whose threshold a user may move by hand; a trailing rule's follows
+# its peak and an expiry rule's is a time
+EDITABLE_KINDS = (TAKE_PROFIT, STOP_LOSS)
+
+
+def rule_kind(row: dict) -> str:
+    """
+    Returns kind of a watchlist row; rows written before rule kinds existed
+    only carry an operator.
+    """
+    return row.get('kind', TAKE_PROFIT if row['op'] == '>' else STOP_LOSS)
+
+
+def read_table(path: str) -> list:
+    """
+    Returns rows of the default table of a TinyDB json file.
+    """
+    return list(_read_file(path).get('_default', {}).values())
+
+
+def read_seq(path: str) -> int:
+    """
+    Returns sequence number of the last journal op folded into the file.
+    """
+    meta = _read_file(path).get('_meta', {})
+    return meta['1']['seq'] if '1' in meta else 0
+
+
+def _read_file(path: str) -> dict:
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return {}
+
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def write_table(path: str, rows: list, seq: int = None) -> None:
+    """
+    Atomically replaces a TinyDB json file with given rows so TinyDB readers
+    keep working.
+    """
+    data = {'_default': {str(i + 1): row for i, row in enumerate(rows)}}
+    if seq is not None:
+        data['_meta'] = {'1': {'seq': seq}}
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(data, fh)
+    os.replace(tmp_path, path)
+
+
+class JsonStorage(object):
+    """
+    Snapshots in TinyDB-format json files; ops between snapshots go to a
+    journal. Kept for tests and for reading databases of older versions.
+    """
+    def __init__(self, db_dir: str = 'db'):
+        self.__paths = {table: os.path.join(db_dir, f'{table}.json') for table in TABLES}
+        self.__journal_path = os.path.join(db_dir, 'portfolio.journal')
+        # open orders are the trader's own; the webserver doesn't read them
+        self.__orders_path = os.path.join(db_dir, 'orders.json')
+
+    def load(self) -> (list, dict, int, list):
+        """
+        Returns position rows, wallet, seq of the snapshot and journal ops newer
+        than the snapshot (to be replayed).
+        """
+        rows = read_table(self.__paths['portfolio'])
+        wallet = read_table(self.__paths['wallet'])
+        wallet = {'in': wallet[0]['in'], 'out': wallet[0]['out']} if len(wallet) > 0 else {'in': 0, 'out': 0}
+
+        # a crash mid-snapshot can leave one file newer than the others
+        seqs = {'pos': read_seq(self.__paths['portfolio']), 'wallet': read_seq(self.__paths['wallet']), 'order': read_seq(self.__orders_path)}
+
+        ops = []
+        if os.path.exists(self.__journal_path):
+            with open(self.__journal_path) as fh:
+                for line in fh:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        # torn write at the end of the journal
+                        log.warn('Skipping malformed journal entry')
+                        continue
+
+                    if op['seq'] > seqs[op['t']]:
+                        ops.append(op)
+
+        return rows, wallet, max(seqs.values()), ops
+
+    def load_orders(self) -> list:
+        """
+        Returns rows of open orders in the snapshot (the journal holds later changes).
+        """
+        return read_table(self.__orders_path)
+
+    def write(self, ops: list) -> None:
+        """
+        Appends ops to the journal.
+        """
+        with open(self.__journal_path, 'a') as fh:
+            fh.write(''.join(json.dumps(op) + '\n' for op in ops))
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def compact(self, rows: list, wallet: dict, seq: int, orders: list) -> None:
+        """
+        Writes full snapshots and truncates the journal.
+        """
+        write_table(self.__paths['portfolio'], rows, seq)
+        write_table(self.__paths['wallet'], [wallet], seq)
+        write_table(self.__orders_path, orders, seq)
+        if os.path.exists(self.__journal_path):
+            os.remove(self.__journal_path)
+
+    def load_watchlist(self) -> list:
+        return read_table(self.__paths['watchlist'])
+
+    def write_watchlist(self, rows: list) -> None:
+        write_table(self.__paths['watchlist'], rows)
+
+    def initialize_wallet(self, balance_in: float) -> bool:
+        """
+        Creates the wallet unless there is one. Returns True if created.
+        """
+        if os.path.exists(self.__paths['wallet']):
+            return False
+        write_table(self.__paths['wallet'], [{'in': balance_in, 'out': 0}])
+        return True
+
+    def version(self, table: str):
+        """
+        Returns a value that changes whenever table changes.
+        """
+        try:
+            st = os.stat(self.__paths[table])
+            return st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            return None
+
+    def read(self, table: str) -> list:
+        return read_table(self.__paths[table])
+
+    def set_wallet(self, field: str, value: float) -> None:
+        """
+        Sets wallet field in the snapshot. Only for when no trader is running.
+        """
+        path = self.__paths['wallet']
+        rows = read_table(path)
+        for row in rows:
+            row[field] = value
+        write_table(path, rows, read_seq(path))
+
+    def set_threshold(self, ticker: str, identifier: str, threshold: float) -> bool:
+        """
+        Moves one take-profit or stop-loss rule of ticker. Only for when no
+        trader is running. Returns True if the rule was moved.
+        """
+        path = self.__paths['watchlist']
+        rows = read_table(path)
+        for row in rows:
+            if row['uuid'] == identifier and row['ticker'] == ticker and rule_kind(row) in EDITABLE_KINDS:
+                row['threshold'] = threshold
+                write_table(path, rows)
+                return True
+        return False
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS portfolio (ticker TEXT PRIMARY KEY, shares INTEGER NOT NULL, stake NUMERIC NOT NULL);
+CREATE TABLE IF NOT EXISTS wallet (field TEXT PRIMARY KEY, value NUMERIC NOT NULL);
+CREATE TABLE IF NOT EXISTS orders (client_id INTEGER PRIMARY KEY, order_id INTEGER, symbol TEXT NOT NULL, action TEXT NOT NULL, quantity INTEGER NOT NULL, limit_price REAL, placed_at REAL NOT NULL, reserved REAL);
+CREATE TABLE IF NOT EXISTS watchlist (uuid TEXT PRIMARY KEY, ticker TEXT NOT NULL, kind TEXT NOT NULL, threshold REAL NOT NULL, trail REAL, peak REAL);
+CREATE INDEX IF NOT EXISTS watchlist_ticker ON watchlist (ticker);
+CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL);
+INSERT OR IGNORE INTO versions VALUES ('portfolio', 0), ('wallet', 0), ('watchlist', 0);
+'''
+
+# bump a table's version on every change so other processes can cache reads
+VERSION_TRIGGER = '''
+CREATE TRIGGER IF NOT EXISTS {table}_{event} AFTER {event} ON {table}
+BEGIN UPDATE versions SET version = version + 1 WHERE name = '{table}'; END;
+'''
+
+ORDER_COLUMNS = ('client_id', 'order_id', 'symbol', 'action', 'quantity', 'limit_price', 'placed_at', 'reserved')
+
+
+def order_statements(op: dict) -> list:
+    """
+    Returns (sql, params) statements applying an order op to the orders table.
+    """
+    if op['order'] is None:
+        return [('DELETE FROM orders WHERE client_id = ?', (op['client_id'],))]
+    return [(f'INSERT OR REPLACE INTO orders ({", ".join(ORDER_COLUMNS)}) VALUES ({", ".join("?" * len(ORDER_COLUMNS))})',
+             tuple(op['order'][column] for column in ORDER_COLUMNS))]
+
+
+class SqliteStorage(object):
+    """
+    Portfolio, wallet, open orders & watchlist in one SQLite database in WAL mode, so
+    readers in other processes never block the writer. Each op is applied
+    in place (balance updates are `value = value + ?`), so there is nothing
+    to compact.
+    """
+    def __init__(self, path: str):
+        self.__path = path
+        # each thread gets its own connection
+        self.__local = threading.local()
+
+        db = self.__connection()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(SCHEMA)
+        for table in TABLES:
+            for event in ['INSERT', 'UPDATE', 'DELETE']:
+                db.executescript(VERSION_TRIGGER.format(table=table, event=event))
+
+    def __connection(self) -> sqlite3.Connection:
+        db = getattr(self.__local, 'db', None)
+        if db is None:
+            # autocommit; writes open their own transactions
+            db = self.__local.db = sqlite3.connect(self.__path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def __transaction(self, statements: list) -> None:
+        """
+        Runs (sql, params) statements in one write transaction.
+        """
+        db = self.__connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for sql, params in statements:
+                db.execute(sql, params)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def load(self) -> (list, dict, int, list):
+        """
+        Returns position rows, wallet, seq (always 0) and ops to replay (none).
+        """
+        return self.read('portfolio'), self.__wallet(), 0, []
+
+    def __wallet(self) -> dict:
+        wallet = {'in': 0, 'out': 0}
+        for field, value in self.__connection().execute('SELECT field, value FROM wallet'):
+            wallet[field] = value
+        return wallet
+
+    def write(self, ops: list) -> None:
+        statements = []
+        for op in ops:
+            if op['t'] == 'pos':
+                statements.append(('INSERT INTO portfolio (ticker, shares, stake) VALUES (?, ?, ?) '
+                                   'ON CONFLICT(ticker) DO UPDATE SET shares = excluded.shares, stake = excluded.stake',
+                                   (op['ticker'], op['shares'], op['stake'])))
+            elif op['t'] == 'order':
+                statements += order_statements(op)
+            elif 'delta' in op:
+                statements.append(('UPDATE wallet SET value = value + ? WHERE field = ?', (op['delta'], op['field'])))
+            else:
+                statements.append(('INSERT INTO wallet (field, value) VALUES (?, ?) '
+                                   'ON CONFLICT(field) DO UPDATE SET value = excluded.value', (op['field'], op['value'])))
+        self.__transaction(statements)
+
+    def load_orders(self) -> list:
+        return [dict(zip(ORDER_COLUMNS, row)) for row in self.__connection().execute(f'SELECT {", ".join(ORDER_COLUMNS)} FROM orders')]
+
+    def compact(self, rows: list, wallet: dict, seq: int, orders: list) -> None:
+        # ops are already in place; just keep the WAL file from growing
+        self.__connection().execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def load_watchlist(self) -> list:
+        return self.read('watchlist')
+
+    def write_watchlist(self, rows: list) -> None:
+        """
+        Makes the watchlist table match rows; unchanged rules are not touched.
+        """
+        uuids = set(row['uuid'] for row in rows)
+        stale = [(identifier,) for (identifier,) in self.__connection().execute('SELECT uuid FROM watchlist') if identifier not in uuids]
+
+        statements = [('DELETE FROM watchlist WHERE uuid = ?', params) for params in stale]
+        for row in rows:
+            statements.append(('INSERT INTO watchlist (uuid, ticker, kind, threshold, trail, peak) VALUES (?, ?, ?, ?, ?, ?) '
+                               'ON CONFLICT(uuid) DO UPDATE SET threshold = excluded.threshold, peak = excluded.peak '
+                               'WHERE threshold != excluded.threshold OR peak IS NOT excluded.peak',
+                               (row['uuid'], row['ticker'], row['kind'], row['threshold'], row.get('trail'), row.get('peak'))))
+        self.__transaction(statements)
+
+    def initialize_wallet(self, balance_in: float) -> bool:
+        db = self.__connection()
+        cursor = db.execute("INSERT OR IGNORE INTO wallet (field, value) VALUES ('in', ?), ('out', 0)", (balance_in,))
+        return cursor.rowcount > 0
+
+    def version(self, table: str):
+        return self.__connection().execute('SELECT version FROM versions WHERE name = ?', (table,)).fetchone()[0]
+
+    def read(self, table: str) -> list:
+        db = self.__connection()
+        if table == 'wallet':
+            return [self.__wallet()] if db.execute('SELECT 1 FROM wallet LIMIT 1').fetchone() else []
+        if table == 'portfolio':
+            return [{'shares': shares, 'ticker': ticker, 'stake': stake} for ticker, shares, stake in db.execute('SELECT ticker, shares, stake FROM portfolio')]
+
+        rows = []
+        for identifier, ticker, kind, threshold, trail, peak in db.execute('SELECT uuid, ticker, kind, threshold, trail, peak FROM watchlist'):
+            row = {'uuid': identifier, 'ticker': ticker, 'threshold': threshold, 'op': '>' if kind == TAKE_PROFIT else '<', 'kind': kind}
+            if trail is not None:
+                row['trail'] = trail
+                row['peak'] = peak
+            rows.append(row)
+        return rows
+
+    def get_position(self, ticker: str) -> dict:
+        """
+        Returns row of ticker or None (indexed lookup).
+        """
+        row = self.__connection().execute('SELECT shares, stake FROM portfolio WHERE ticker = ?', (ticker,)).fetchone()
+        return None if row is None else {'shares': row[0], 'ticker': ticker, 'stake': row[1]}
+
+    def set_wallet(self, field: str, value: float) -> None:
+        self.write([{'t': 'wallet', 'field': field, 'value': value}])
+
+    def set_threshold(self, ticker: str, identifier: str, threshold: float) -> bool:
+        cursor = self.__connection().execute('UPDATE watchlist SET threshold = ? WHERE uuid = ? AND ticker = ? AND kind IN (?, ?)',
+                                             (threshold, identifier, ticker) + EDITABLE_KINDS)
+        return cursor.rowcount > 0
+
+    def import_from(self, source: JsonStorage) -> int:
+        """
+        Copies everything source holds (journal included) into this database.
+        Returns number of rows copied.
+        """
+        rows, wallet, seq, ops = source.load()
+        positions = {row['ticker']: row for row in rows}
+        orders = {row['client_id']: {'t': 'order', 'client_id': row['client_id'], 'order': row} for row in source.load_orders()}
+        for op in ops:
+            if op['t'] == 'pos':
+                positions[op['ticker']] = {'ticker': op['ticker'], 'shares': op['shares'], 'stake': op['stake']}
+            elif op['t'] == 'order':
+                orders[op['client_id']] = op
+            elif 'delta' in op:
+                wallet[op['field']] += op['delta']
+            else:
+                wallet[op['field']] = op['value']
+
+        statements = [('INSERT OR REPLACE INTO portfolio (ticker, shares, stake) VALUES (?, ?, ?)', (row['ticker'], row['shares'], row['stake'])) for row in positions.values()]
+        statements += [('INSERT OR REPLACE INTO wallet (field, value) VALUES (?, ?)', (field, value)) for field, value in wallet.items()]
+        for op in orders.values():
+            statements += order_statements(op)
+        self.__transaction(statements)
+
+        watchlist = source.load_watchlist()
+        for row in watchlist:
+            row['kind'] = rule_kind(row)
+        self.write_watchlist(watchlist)
+        return len(positions) + len(wallet) + len([op for op in orders.values() if op['order'] is not None]) + len(watchlist)
+
+
+_STORAGES = {}
+_STORAGES_LOCK = Lock()
+
+
+def open_storage(backend: str = None, db_dir: str = 'db'):
+    """
+    Returns the (per process shared) storage of db_dir. A new SQLite database
+    is filled from json files found next to it.
+    """
+    backend = ct.STORAGE_BACKEND if backend is None else backend
+    key = (backend, os.path.abspath(db_dir))
+
+    _STORAGES_LOCK.acquire()
+    try:
+        storage = _STORAGES.get(key)
+        if storage is None:
+            if backend == 'json':
+                storage = JsonStorage(db_dir)
+            elif backend == 'sqlite':
+                path = os.path.join(db_dir, ct.SQLITE_DB)
+                is_new = not os.path.exists(path)
+                storage = SqliteStorage(path)
+                if is_new and os.path.exists(os.path.join(db_dir, 'wallet.json')):
+                    copied = storage.import_from(JsonStorage(db_dir))
+                    log.info('Migrated %s rows from json files in %s to %s', copied, db_dir, path)
+            else:
+                raise ValueError(f'Unknown storage backend {backend}')
+            _STORAGES[key] = storage
+        return storage
+    finally:
+        _STORAGES_LOCK.release()
@@ -0,0 +1,174 @@
+import csv
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from backtest import Backtest, PriceHistory, load_messages
+from logger import Logger
+
+log = Logger.get('sweep')
+
+# summary figures written for every run, after the parameters
+COLUMNS = ['orders', 'rejected', 'buys_filled', 'sells_filled', 'cancelled', 'round_trips', 'win_rate', 'mean_return',
+           'profit', 'unrealized', 'equity', 'open_positions', 'watchdog_cycles', 'elapsed']
+
+# loaded once per worker process by _init_worker
+_history = None
+_messages = None
+
+
+def grid(values: dict) -> list:
+    """
+    Returns every combination of a dict of constant name -> values to try,
+    as dicts of name -> value.
+    """
+    names = sorted(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*(values[name] for name in names))]
+
+
+def run_key(params: dict) -> str:
+    """
+    Returns the text a run of params is recognized by in the results.
+    """
+    return json.dumps(params, sort_keys=True)
+
+
+def _init_worker(history_dir: str, messages_path: str, log_path: str) -> None:
+    global _history, _messages
+    Logger.PATH = log_path
+    Logger.set_level('ERROR')
+    # turned down signals are logged as errors; they are what we're measuring
+    Logger.set_level(Logger.LEVEL_ERROR + 1, 'trader')
+    _history = PriceHistory.open(history_dir)
+    _messages = load_messages(messages_path)
+
+
+def _run(params: dict) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        return Backtest(_history, _messages, params).run(workdir)
+
+
+class Sweep(object):
+    """
+    Backtests every combination of a parameter grid on a process pool.
+    Each worker maps the price history from .npy files once and runs
+    combinations as they are handed out. Results are appended to a CSV
+    file as they complete; combinations already in it are not run again,
+    so an interrupted sweep picks up where it stopped.
+    """
+    def __init__(self, history_dir: str, messages_path: str, results_path: str, workers: int = None):
+        """
+        :param history_dir: directory PriceHistory.save() wrote to
+        :param workers: processes to run (CPU count if omitted)
+        """
+        self.__history_dir = history_dir
+        self.__messages_path = messages_path
+        self.__results_path = results_path
+        self.__workers = os.cpu_count() if workers is None else workers
+
+    def completed(self) -> set:
+        """
+        Returns keys of the runs already in the results file.
+        """
+        if not os.path.exists(self.__results_path):
+            return set()
+
+        done = set()
+        with open(self.__results_path, newline='') as fh:
+            for row in csv.DictReader(fh):
+                if row.get('key'):
+                    done.add(row['key'])
+        return done
+
+    def __prepare(self, fieldnames: list) -> bool:
+        """
+        Cuts off a row a crash left half written. Returns True if the results
+        file has no header yet.
+        """
+        if not os.path.exists(self.__results_path) or os.path.getsize(self.__results_path) == 0:
+            return True
+
+        with open(self.__results_path, 'rb+') as fh:
+            content = fh.read()
+            if not content.endswith(b'\n'):
+                fh.truncate(content.rfind(b'\n') + 1)
+
+        with open(self.__results_path, newline='') as fh:
+            header = next(csv.reader(fh), None)
+        if header is None:
+            return True
+        if header != fieldnames:
+            raise ValueError(f'{self.__results_path} holds results of other parameters: {header}')
+        return False
+
+    def run(self, combinations: list) -> int:
+        """
+        Runs the combinations not in the results file yet. Returns how many ran.
+        """
+        names = sorted({name for params in combinations for name in params})
+        fieldnames = names + COLUMNS + ['key']
+        is_new = self.__prepare(fieldnames)
+
+        done = self.completed()
+        todo = [params for params in combinations if run_key(params) not in done]
+        log.info('%d of %d combinations left to run on %d workers', len(todo), len(combinations), self.__workers)
+        if len(todo) == 0:
+            return 0
+
+        start = time.perf_counter()
+        ran = 0
+
+        with open(self.__results_path, 'a', newline='') as fh:
+            writer = csv.DictWriter(fh, fieldnames=fieldnames, extrasaction='ignore')
+            if is_new:
+                writer.writeheader()
+
+            with ProcessPoolExecutor(max_workers=self.__workers, initializer=_init_worker,
+                                     initargs=(self.__history_dir, self.__messages_path, os.path.abspath(Logger.PATH))) as pool:
+                futures = {pool.submit(_run, params): params for params in todo}
+                for future in as_completed(futures):
+                    params = futures[future]
+                    try:
+                        summary = future.result()
+                    except Exception as ex:
+                        log.error('Run of %s failed: %s', params, ex)
+                        continue
+
+                    writer.writerow(dict(params, **{column: summary[column] for column in COLUMNS}, key=run_key(params)))
+                    # a killed sweep keeps every row written so far
+                    fh.flush()
+                    ran += 1
+
+        elapsed = time.perf_counter() - start
+        log.info('Ran %d combinations in %.1f s (%.2f runs/s)', ran, elapsed, ran / elapsed)
+        return ran
+
+
+if __name__ == '__main__':
+    # usage: sweep.py <price csv or tick dir> <messages.jsonl> <results.csv> NAME=v1,v2,... [...] [workers=N]
+    if len(sys.argv) < 5:
+        print('usage: sweep.py <price csv or tick dir> <messages.jsonl> <results.csv> NAME=v1,v2,... [...] [workers=N]')
+        sys.exit(1)
+
+    os.makedirs(os.path.dirname(os.path.abspath(Logger.PATH)), exist_ok=True)
+    Logger.set_level('INFO')
+    price_dir, messages_path, results_path = sys.argv[1:4]
+    values = {}
+    workers = None
+    for arg in sys.argv[4:]:
+        name, value = arg.split('=', 1)
+        if name == 'workers':
+            workers = int(value)
+        else:
+            values[name] = [json.loads(v) for v in value.split(',')]
+
+    # csv prices & recorded ticks are converted once; every worker maps the .npy files
+    history_dir = results_path + '.prices'
+    if not os.path.exists(os.path.join(history_dir, 'symbols.txt')):
+        PriceHistory.load(price_dir).save(history_dir)
+
+    Sweep(history_dir, messages_path, results_path, workers).run(grid(values))
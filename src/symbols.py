@@ -0,0 +1,124 @@
+import json
+import os
+import time
+from threading import Lock
+
+import clock
+import constants as ct
+from logger import Logger
+
+log = Logger.get('symbols')
+
+
+class SymbolIndex(object):
+    """
+    Validates ticker candidates in memory so shouted words and dead symbols
+    never cost a quote call.
+    """
+    def __init__(self, universe_path: str = 'db/symbols.txt', denylist_path: str = 'db/denylist.json'):
+        self.__denylist_path = denylist_path
+        self.__lock = Lock()
+        # known tradable symbols (None accepts anything not denied)
+        self.__universe = self.__load_universe(universe_path)
+        self.__stopwords = frozenset(ct.TICKER_STOPWORDS)
+        # symbols that kept coming back without a price
+        self.__learned = self.__load_denylist()
+        # ticker -> monotonic time until which we don't ask for a quote again
+        self.__negative_cache = {}
+        # ticker -> consecutive quote misses
+        self.__misses = {}
+        # quote calls avoided in the current hour
+        self.__hour = int(time.time() // 3600)
+        self.__avoided = 0
+
+    @staticmethod
+    def __load_universe(path: str) -> frozenset:
+        if not os.path.exists(path):
+            log.warn('No symbol file at %s. Accepting any symbol not on a denylist', path)
+            return None
+
+        with open(path) as fh:
+            universe = frozenset(line.strip().upper() for line in fh if line.strip())
+
+        log.info('Loaded %s symbols', len(universe))
+        return universe
+
+    def __load_denylist(self) -> set:
+        if not os.path.exists(self.__denylist_path):
+            return set()
+
+        with open(self.__denylist_path) as fh:
+            return set(json.load(fh))
+
+    def __save_denylist(self) -> None:
+        tmp_path = self.__denylist_path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(sorted(self.__learned), fh)
+        os.replace(tmp_path, self.__denylist_path)
+
+    def allow(self, ticker: str) -> bool:
+        """
+        Returns True if ticker is worth a quote call.
+        """
+        reason = None
+        if ticker in self.__stopwords or ticker in self.__learned:
+            reason = 'denylisted'
+        elif self.__universe is not None and ticker not in self.__universe:
+            reason = 'not in symbol universe'
+        elif self.__negative_cache.get(ticker, 0) > clock.monotonic():
+            reason = 'recently had no price'
+
+        if reason is None:
+            return True
+
+        self.__lock.acquire()
+        self.__roll_hour()
+        self.__avoided += 1
+        self.__lock.release()
+        log.debug('Not quoting %s: %s', ticker, reason)
+        return False
+
+    def report_price(self, ticker: str, price: float) -> None:
+        """
+        Feeds back the result of a quote call for ticker: a price, -1 if the
+        broker has no quote for it or None if the call itself failed (which
+        says nothing about the symbol).
+        """
+        if price is None:
+            return
+
+        self.__lock.acquire()
+        if price > 0:
+            self.__misses.pop(ticker, None)
+            self.__negative_cache.pop(ticker, None)
+            self.__lock.release()
+            return
+
+        self.__negative_cache[ticker] = clock.monotonic() + ct.NEGATIVE_QUOTE_TTL
+        self.__misses[ticker] = self.__misses.get(ticker, 0) + 1
+
+        if self.__misses[ticker] >= ct.DENYLIST_LEARN_MISSES:
+            log.info('Denylisting %s after %s quote misses', ticker, self.__misses[ticker])
+            del self.__misses[ticker]
+            self.__learned.add(ticker)
+            self.__save_denylist()
+        self.__lock.release()
+
+    def __roll_hour(self) -> None:
+        # caller holds self.__lock
+        hour = int(time.time() // 3600)
+        if hour != self.__hour:
+            log.info('Avoided %s quote calls in the last hour', self.__avoided)
+            self.__hour = hour
+            self.__avoided = 0
+            # drop expired negative cache entries
+            now = clock.monotonic()
+            self.__negative_cache = {t: until for t, until in self.__negative_cache.items() if until > now}
+
+    @property
+    def avoided_this_hour(self) -> int:
+        self.__lock.acquire()
+        self.__roll_hour()
+        result = self.__avoided
+        self.__lock.release()
+        return result
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import asyncio
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import BaseAdapter
+
+sys.path.append('../')
+
+from logger import Logger
+from stub_broker import StubBroker, StubSession, install_credentials
+
+# N quote requests at once (10, 100, 500) against a stub broker with a
+# fixed latency, running in a process of its own so it doesn't share our
+# GIL:
+#
+#   threads   blocking ETrader, one thread per request in flight
+#   asyncio   AsyncETrader, one event loop, ASYNC_MAX_CONCURRENCY in flight
+#
+# Also checks the async client's OAuth1 header against rauth's and that
+# the blocking facade returns the same prices.
+#
+# usage: ./async_bench.py [latency seconds]
+
+LATENCY = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+
+
+def serve(latency: float, conn) -> None:
+    broker = StubBroker(latency).start()
+    conn.send(broker.url)
+    conn.recv()
+
+
+class CaptureAdapter(BaseAdapter):
+    """
+    Answers every request with an empty 200 and remembers the last one.
+    """
+    def send(self, request, **kwargs):
+        self.request = request
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b''
+        return response
+
+    def close(self):
+        pass
+
+
+def check_signature() -> None:
+    import rauth.session
+    from rauth import OAuth1Session
+    from async_etrader import OAuth1Signer
+    import async_etrader
+
+    # same nonce & timestamp on both sides
+    rauth.session.random = lambda: 0.5
+    rauth.session.time = lambda: 1700000000
+    async_etrader.random.random, real_random = (lambda: 0.5), async_etrader.random.random
+    async_etrader.time.time, real_time = (lambda: 1700000000), async_etrader.time.time
+    try:
+        session = OAuth1Session('ckey', 'csecret', 'token', 'tsecret')
+        adapter = CaptureAdapter()
+        session.mount('https://', adapter)
+        url = 'https://api.etrade.com/v1/accounts/abc/orders.json'
+        params = {'status': 'INDIVIDUAL_FILLS', 'count': '100', 'marker': 'a b/c'}
+        session.get(url, header_auth=True, params=params)
+        expected = adapter.request.headers['Authorization']
+        actual = OAuth1Signer('ckey', 'csecret', 'token', 'tsecret').header('GET', url, params)
+    finally:
+        async_etrader.random.random = real_random
+        async_etrader.time.time = real_time
+
+    assert sorted(expected.split(',')) == sorted(actual.split(',')), f'{expected} != {actual}'
+    print('OAuth1 header matches rauth')
+
+
+def percentiles(latencies: list) -> (float, float):
+    latencies = sorted(latencies)
+    return latencies[len(latencies) // 2], latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+
+
+def run_threads(etrader, n: int) -> (float, list):
+    def timed(symbol: str) -> float:
+        start = time.perf_counter()
+        assert etrader.get_ticker_price(symbol) > 0
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        start = time.perf_counter()
+        latencies = list(pool.map(timed, [f'S{i}' for i in range(n)]))
+        return time.perf_counter() - start, latencies
+
+
+async def run_async(n: int) -> (float, list):
+    from async_etrader import AsyncETrader
+
+    client = AsyncETrader()
+    await client.start()
+
+    async def timed(symbol: str) -> float:
+        start = time.perf_counter()
+        assert await client.get_ticker_price(symbol) > 0
+        return time.perf_counter() - start
+
+    try:
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*[timed(f'S{i}') for i in range(n)])
+        return time.perf_counter() - start, latencies
+    finally:
+        await client.close()
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        Logger.PATH = os.path.join(tmp, 'log.txt')
+        Logger.set_level('WARN')
+        # requests complains about every connection beyond its pool
+        logging.getLogger('urllib3').setLevel(logging.ERROR)
+
+        ours, theirs = multiprocessing.Pipe()
+        broker = multiprocessing.Process(target=serve, args=(LATENCY, theirs), daemon=True)
+        broker.start()
+        url = ours.recv()
+        install_credentials(url)
+
+        import constants as ct
+        from etrader import ETrader
+        from async_etrader import AsyncETrader, BlockingETrader
+
+        check_signature()
+
+        facade = BlockingETrader(AsyncETrader())
+        tickers = [f'S{i}' for i in range(60)]
+        assert facade.get_ticker_prices(tickers) == ETrader(session=StubSession()).get_ticker_prices(tickers)
+        facade.close()
+        print('blocking facade agrees with ETrader')
+
+        print(f'\nstub latency {LATENCY * 1000:.0f} ms, HTTP_POOL_SIZE {ct.HTTP_POOL_SIZE}, ASYNC_MAX_CONCURRENCY {ct.ASYNC_MAX_CONCURRENCY}')
+        print(f'{"requests":>8} {"client":>8} {"wall (s)":>9} {"req/s":>7} {"p50 (ms)":>9} {"p99 (ms)":>9}')
+        for n in [10, 100, 500]:
+            results = {
+                'threads': run_threads(ETrader(session=StubSession()), n),
+                'asyncio': asyncio.run(run_async(n)),
+            }
+            for client, (wall, latencies) in results.items():
+                p50, p99 = percentiles(latencies)
+                print(f'{n:>8} {client:>8} {wall:>9.3f} {n / wall:>7.0f} {p50 * 1000:>9.1f} {p99 * 1000:>9.1f}')
+
+        ours.send('stop')
+        broker.join()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+import sys
+import os
+import math
+import random
+import tempfile
+
+import numpy as np
+
+sys.path.append('../')
+
+from logger import Logger
+
+# Backtests the strategy offline:
+#
+#   pump    one signal, price runs 60% an hour later; the position must be
+#           bought at the quote, sold once the take-profit fires, and the
+#           profit booked must match the fills exactly
+#   month   30 days of minute prices for 60 symbols and 600 recorded
+#           messages, replayed with two SELL_THRESH_MULTIPLIER values
+#
+# usage: ./backtest_replay.py [symbols] [days]
+
+START = 1700000000.0
+STEP = 60.0
+
+
+def message(when: float, text: str) -> tuple:
+    import constants as ct
+    return when, {
+        '@type': 'updateNewMessage',
+        'message': {
+            'chat_id': ct.TG_CHAT_ID_FILTER[0],
+            'date': int(when),
+            'content': {'@type': 'messageText', 'text': {'@type': 'formattedText', 'text': text}},
+        },
+    }
+
+
+def random_walks(symbols: list, days: int, rng: np.random.Generator) -> dict:
+    """
+    Returns symbol -> (timestamps, prices) of minute prices between 0.0002 and 0.003,
+    with a few pumps thrown in.
+    """
+    n = int(days * 86400 / STEP)
+    timestamps = START + np.arange(n) * STEP
+    series = {}
+    for symbol in symbols:
+        steps = rng.normal(0, 0.004, n)
+        for start in rng.integers(0, n, 3):
+            steps[start:start + 120] += rng.uniform(0.002, 0.006)
+        prices = rng.uniform(0.0004, 0.0018) * np.exp(np.cumsum(steps))
+        series[symbol] = (timestamps, np.clip(np.round(prices, 6), 0.0002, 0.003))
+    return series
+
+
+def write_csv(directory: str, series: dict) -> None:
+    for symbol, (timestamps, prices) in series.items():
+        np.savetxt(os.path.join(directory, f'{symbol}.csv'), np.column_stack([timestamps, prices]), delimiter=',', fmt=['%.0f', '%.6f'], header='timestamp,price', comments='')
+
+
+def run(history, messages, params: dict) -> dict:
+    from backtest import Backtest
+
+    with tempfile.TemporaryDirectory() as workdir:
+        return Backtest(history, messages, params).run(workdir)
+
+
+if __name__ == '__main__':
+    SYMBOLS = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    DAYS = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+
+    with tempfile.TemporaryDirectory() as tmp:
+        Logger.PATH = os.path.join(tmp, 'log.txt')
+        Logger.set_level('ERROR')
+        # turned down signals are logged as errors; they are what we're measuring
+        Logger.set_level(Logger.LEVEL_ERROR + 1, 'trader')
+
+        import constants as ct
+        from backtest import PriceHistory, load_messages
+
+        # pump: flat at 0.001, 0.0016 from an hour after the signal on
+        timestamps = START + np.arange(0, 86400, STEP)
+        prices = np.where(timestamps < START + 7200, 0.001, 0.0016)
+        history = PriceHistory.from_series({'PUMP': (timestamps, prices), 'FLAT': (timestamps, np.full(len(timestamps), 0.001))})
+        summary = run(history, [message(START + 3600, 'PUMP loading, FLAT too')], {'DEFAULT_BALANCE_IN': 10000})
+
+        shares = math.floor(1000 / 0.001)
+        expected = shares * 0.0016 - shares * 0.001
+        print(f'pump:  {summary["orders"]} orders, {summary["round_trips"]} round trip, profit {summary["profit"]:.4f} (expected {expected:.4f}), '
+              f'{summary["open_positions"]} still held, {summary["watchdog_cycles"]} watchdog cycles')
+        assert summary['buys_filled'] == 2 and summary['sells_filled'] == 1 and summary['round_trips'] == 1
+        assert abs(summary['profit'] - expected) < 1e-6 and summary['open_positions'] == 1
+        assert abs(summary['equity'] - (10000 + expected)) < 1e-6
+
+        # month: random walks & messages written to disk like recorded data
+        rng = np.random.default_rng(7)
+        random.seed(7)
+        symbols = [''.join(random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(4)) for _ in range(SYMBOLS)]
+        prices_dir = os.path.join(tmp, 'prices')
+        os.mkdir(prices_dir)
+        write_csv(prices_dir, random_walks(symbols, DAYS, rng))
+
+        words = ['gap up', 'watch', 'loading', 'runner', 'chart', 'nice', 'new high', 'hod', 'boom']
+        messages_path = os.path.join(tmp, 'messages.jsonl')
+        with open(messages_path, 'w') as fh:
+            import json
+            for when in sorted(rng.uniform(START, START + DAYS * 86400, DAYS * 20)):
+                tickers = ' '.join(random.sample(symbols, random.randint(1, 3)))
+                fh.write(json.dumps(message(when, f'{random.choice(words)} {tickers} {random.choice(words)}')[1]) + '\n')
+
+        history = PriceHistory.load_csv(prices_dir)
+        messages = load_messages(messages_path)
+        print(f'\nmonth: {len(history.symbols)} symbols, {len(history.prices)} ticks, {len(messages)} messages over {DAYS} days')
+        print(f'{"SELL_THRESH":>11} {"orders":>7} {"trips":>6} {"win %":>6} {"mean ret":>9} {"profit":>9} {"equity":>10} {"held":>5} {"cycles":>7} {"replay s":>9}')
+        for multiplier in [1.2, 1.5]:
+            summary = run(history, messages, {'DEFAULT_BALANCE_IN': 200000, 'SELL_THRESH_MULTIPLIER': multiplier})
+            print(f'{multiplier:>11} {summary["orders"]:>7} {summary["round_trips"]:>6} {summary["win_rate"] * 100:>6.1f} {summary["mean_return"]:>9.3f} '
+                  f'{summary["profit"]:>9.2f} {summary["equity"]:>10.2f} {summary["open_positions"]:>5} {summary["watchdog_cycles"]:>7} {summary["elapsed"]:>9.2f}')
+            assert summary['orders'] > 0 and summary['elapsed'] < 60
+            assert ct.SELL_THRESH_MULTIPLIER == 1.5 and ct.LIVE_TRADING, 'constants not restored'
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import tempfile
+
+import numpy as np
+
+sys.path.append('../')
+
+from logger import Logger
+from stub_broker import StubBroker, make_etrader
+
+# Liquidates positions whose stop losses all fire in the same watch cycle,
+# against the stub broker answering each preview & place after a delay:
+#
+#   one by one   handle_sell_sig per position, as the watchdog used to call it
+#   bulk         one watchdog cycle hands every fired position to
+#                handle_sell_sigs; orders go out ORDER_WORKERS at a time
+#
+# Every position must end up with one open SELL order and no rules left.
+#
+# usage: ./bulk_exit_bench.py [positions] [broker latency ms]
+
+
+def open_positions(trader, tickers: list) -> None:
+    for ticker in tickers:
+        trader.portfolio.store.add_to_position(ticker, 1000, 1.0)
+        price = trader.watchdog.get_price(ticker)
+        # stop loss above the price: fires on the next check
+        trader.watchdog.subscribe(ticker, price * 1.1, '<')
+
+
+def check(trader, tickers: list) -> None:
+    from orders import Order
+
+    for ticker in tickers:
+        orders = trader.portfolio.orders.open_orders(ticker)
+        assert len(orders) == 1 and orders[0].action == Order.SELL and orders[0].quantity == 1000, orders
+        assert ticker not in trader.watchdog.rules, f'{ticker} still watched'
+
+
+if __name__ == '__main__':
+    POSITIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    LATENCY = (float(sys.argv[2]) if len(sys.argv) > 2 else 30) / 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        Logger.PATH = os.path.join(tmp, 'log.txt')
+        Logger.set_level('ERROR')
+        os.chdir(tmp)
+        os.mkdir('db')
+
+        import clock
+        import constants as ct
+        from trader import Trader
+
+        ct.STORAGE_BACKEND = 'json'
+        ct.TICK_RECORDING = False
+        broker = StubBroker().start()
+        trader = Trader(make_etrader(broker), background=False)
+        # quotes are fetched for free; orders pay the latency
+        broker.latency = 0
+
+        one_by_one = [f'S{i:03d}' for i in range(POSITIONS)]
+        bulk = [f'B{i:03d}' for i in range(POSITIONS)]
+        open_positions(trader, one_by_one + bulk)
+        broker.latency = LATENCY
+
+        # one by one
+        start = time.perf_counter()
+        sequential = []
+        for ticker in one_by_one:
+            trader.handle_sell_sig(ticker)
+            sequential.append(time.perf_counter() - start)
+        check(trader, one_by_one)
+
+        # bulk: the cycle that sees every stop loss crossed sells them all
+        trader.watchdog.tick(clock.monotonic())
+        check(trader, bulk)
+        positions, total = trader.liquidation_latencies[-1]
+        latencies = np.array(trader.exit_latencies)[-POSITIONS:]
+
+        print(f'{POSITIONS} positions, {LATENCY * 1000:.0f} ms per broker request, {ct.ORDER_WORKERS} order workers')
+        print(f'{"":>11} {"first ms":>9} {"median ms":>10} {"last ms":>8} {"total ms":>9}')
+        print(f'{"one by one":>11} {sequential[0] * 1000:>9.0f} {np.median(sequential) * 1000:>10.0f} {sequential[-1] * 1000:>8.0f} {sequential[-1] * 1000:>9.0f}')
+        print(f'{"bulk":>11} {latencies.min() * 1000:>9.0f} {np.median(latencies) * 1000:>10.0f} {latencies.max() * 1000:>8.0f} {total * 1000:>9.0f}')
+        print(f'speedup of the last order placed: {sequential[-1] / latencies.max():.1f}x')
+        assert positions == POSITIONS and len(trader.exit_latencies) == 2 * POSITIONS
+        assert latencies.max() < sequential[-1] / 2
+
+        trader.watchdog.rules.stop()
+        trader.portfolio.store.stop()
+        broker.stop()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import tempfile
+
+import numpy as np
+
+sys.path.append('../')
+
+from logger import Logger
+
+# Exit rules of open positions fed one batch price snapshot per tick:
+#
+#   parity    500 positions with take-profit, stop-loss, trailing stop & time
+#             exit over 300 ticks; the index must fire exactly what recomputing
+#             every rule from the full price history fires
+#   10k       10k positions (fired ones sold & replaced) for 1000 ticks; cost per
+#             tick must stay flat as history grows
+#   replay    a backtest position is sold by the stop loss after a drop, and by
+#             MAX_HOLD_SECONDS once it's held that long
+#
+# usage: ./exit_rules_bench.py [positions] [ticks]
+
+TAKE_PROFIT = 1.5
+STOP_LOSS = 0.8
+TRAIL = 0.15
+HOLD = 200
+
+
+def walk(prices: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    return prices * np.exp(rng.normal(0, 0.02, len(prices)))
+
+
+def open_position(index, ticker: str, price: float, now: float) -> None:
+    from thresholds import Rule
+    index.add(ticker, Rule.TAKE_PROFIT, price * TAKE_PROFIT)
+    index.add(ticker, Rule.STOP_LOSS, price * STOP_LOSS)
+    index.add(ticker, Rule.TRAILING, price, TRAIL)
+    index.add(ticker, Rule.EXPIRY, now + HOLD)
+
+
+def rescan(history: list, entry: float, opened: float, now: float) -> bool:
+    """
+    Returns True if any rule of a position fires, recomputed from its whole price history.
+    """
+    price = history[-1]
+    peak = max([entry] + history[:-1])
+    peak = max(peak, price)
+    return price > entry * TAKE_PROFIT or price < entry * STOP_LOSS or price < peak * (1 - TRAIL) or now >= opened + HOLD
+
+
+if __name__ == '__main__':
+    POSITIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    TICKS = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        Logger.PATH = os.path.join(tmp, 'log.txt')
+        Logger.set_level('ERROR')
+        Logger.set_level(Logger.LEVEL_ERROR + 1, 'trader')
+
+        from thresholds import ThresholdIndex
+        from storage import JsonStorage
+
+        # parity
+        rng = np.random.default_rng(3)
+        index = ThresholdIndex(JsonStorage(tmp))
+        tickers = [f'P{i:03d}' for i in range(500)]
+        prices = rng.uniform(0.0005, 0.002, len(tickers))
+        # ticker -> (entry price, opened at, prices since)
+        positions = {}
+        for ticker, price in zip(tickers, prices):
+            open_position(index, ticker, price, 0)
+            positions[ticker] = (price, 0, [])
+
+        rescan_times = []
+        mismatches = fired_total = 0
+        for tick in range(1, 301):
+            prices = walk(prices, rng)
+            snapshot = dict(zip(tickers, prices.tolist()))
+            fired = set(index.evaluate_many(snapshot, tick))
+
+            start = time.perf_counter()
+            expected = set()
+            for ticker, price in snapshot.items():
+                entry, opened, history = positions[ticker]
+                history.append(price)
+                if rescan(history, entry, opened, tick):
+                    expected.add(ticker)
+            rescan_times.append(time.perf_counter() - start)
+
+            mismatches += len(fired ^ expected)
+            fired_total += len(fired)
+            # sold; a new position takes its place
+            for ticker in fired:
+                index.remove_ticker(ticker)
+                open_position(index, ticker, snapshot[ticker], tick)
+                positions[ticker] = (snapshot[ticker], tick, [])
+        print(f'parity: {fired_total} exits over 300 ticks of 500 positions, {mismatches} differ from rescanning history '
+              f'(rescan {np.mean(rescan_times[:50]) * 1e3:.2f} ms/tick over the first 50 ticks, {np.mean(rescan_times[-50:]) * 1e3:.2f} ms over the last 50)')
+        assert mismatches == 0 and fired_total > 0
+        index.stop()
+
+        # 10k
+        index = ThresholdIndex(JsonStorage(tmp))
+        tickers = [f'T{i:05d}' for i in range(POSITIONS)]
+        prices = rng.uniform(0.0005, 0.002, POSITIONS)
+        for ticker, price in zip(tickers, prices):
+            open_position(index, ticker, price, 0)
+
+        times = []
+        exits = 0
+        for tick in range(1, TICKS + 1):
+            prices = walk(prices, rng)
+            snapshot = dict(zip(tickers, prices.tolist()))
+            start = time.perf_counter()
+            fired = index.evaluate_many(snapshot, tick)
+            times.append(time.perf_counter() - start)
+            exits += len(fired)
+            for ticker in fired:
+                index.remove_ticker(ticker)
+                open_position(index, ticker, snapshot[ticker], tick)
+
+        times = np.array(times) * 1e3
+        print(f'\n10k:    {POSITIONS} positions x 4 rules, {TICKS} ticks, {exits} exits ({exits / TICKS:.0f}/tick)')
+        print(f'{"ticks":>12} {"ms/tick":>8} {"us/position":>12}')
+        for first in [0, TICKS // 2, TICKS - TICKS // 10]:
+            window = times[first:first + TICKS // 10]
+            print(f'{first + 1:>5}-{first + len(window):<6} {window.mean():>8.2f} {window.mean() * 1e3 / POSITIONS:>12.3f}')
+        assert times[-TICKS // 10:].mean() < 2 * times[:TICKS // 10].mean()
+        index.stop()
+
+        # replay
+        import constants as ct
+        from backtest import PriceHistory
+        from backtest_replay import START, STEP, message, run
+
+        timestamps = START + np.arange(0, 86400, STEP)
+        drop = np.where(timestamps < START + 7200, 0.001, 0.0007)
+        flat = np.full(len(timestamps), 0.001)
+        history = PriceHistory.from_series({'DROP': (timestamps, drop), 'FLAT': (timestamps, flat)})
+        messages = [message(START + 3600, 'DROP loading, FLAT too')]
+
+        held = run(history, messages, {'DEFAULT_BALANCE_IN': 10000})
+        timed = run(history, messages, {'DEFAULT_BALANCE_IN': 10000, 'MAX_HOLD_SECONDS': 4 * 3600})
+        print(f'\nreplay: stop loss only: {held["round_trips"]} round trip, {held["open_positions"]} held; '
+              f'with MAX_HOLD_SECONDS: {timed["round_trips"]} round trips, {timed["open_positions"]} held')
+        assert held['round_trips'] == 1 and held['open_positions'] == 1 and held['profit'] < 0
+        assert timed['round_trips'] == 2 and timed['open_positions'] == 0
+        assert ct.STOP_LOSS_MULTIPLIER == 0.8 and ct.MAX_HOLD_SECONDS is None, 'constants not restored'
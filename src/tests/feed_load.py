@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import random
+import tempfile
+import tracemalloc
+from threading import Thread
+
+sys.path.append('../')
+
+from change_feed import ChangeFeed
+from storage import JsonStorage, write_table
+
+# Fans portfolio changes out to growing numbers of dashboard clients and
+# reports memory held by the feed (clients that never read included) and
+# the time from a change being picked up to every reading client having it.
+
+CHANGES = 500
+POSITIONS = 200
+BUFFER = 256
+
+
+def make_files(tmp: str) -> (str, str, str, list):
+    paths = [os.path.join(tmp, name) for name in ['wallet.json', 'portfolio.json', 'watchlist.json']]
+    portfolio = [{'ticker': f'T{i:04d}', 'shares': 100, 'stake': 10.0} for i in range(POSITIONS)]
+    write_table(paths[0], [{'in': 1000, 'out': 0}])
+    write_table(paths[1], portfolio)
+    write_table(paths[2], [])
+    return paths + [portfolio]
+
+
+def change(path: str, portfolio: list) -> None:
+    portfolio[random.randrange(len(portfolio))]['shares'] += 1
+    write_table(path, portfolio)
+
+
+def idle_clients(clients: int) -> float:
+    """
+    Returns KiB held by the feed after CHANGES with clients that never read.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        wallet_path, portfolio_path, watchlist_path, portfolio = make_files(tmp)
+        feed = ChangeFeed(JsonStorage(tmp), buffer_size=BUFFER)
+        feed.poll()
+
+        tracemalloc.start()
+        subscriptions = [feed.subscribe() for _ in range(clients)]
+        for _ in range(CHANGES):
+            change(portfolio_path, portfolio)
+            feed.poll()
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        assert all(len(s.events) <= BUFFER for s in subscriptions)
+        return held / 1024
+
+
+def reading_clients(clients: int) -> float:
+    """
+    Returns avg ms from poll() publishing a change to the last client reading it.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        wallet_path, portfolio_path, watchlist_path, portfolio = make_files(tmp)
+        feed = ChangeFeed(JsonStorage(tmp), buffer_size=BUFFER)
+        feed.poll()
+
+        received = [0.0] * clients
+        counts = [0] * clients
+        rounds = 50
+
+        def client(i: int):
+            subscription = feed.subscribe()
+            while counts[i] < rounds + 1:
+                events = feed.get(subscription, 1)
+                if len(events) > 0:
+                    counts[i] += len(events)
+                    received[i] = time.perf_counter()
+            feed.unsubscribe(subscription)
+
+        workers = [Thread(target=client, args=(i,)) for i in range(clients)]
+        for worker in workers:
+            worker.start()
+        while feed.subscribers < clients:
+            time.sleep(0.01)
+
+        total = 0.0
+        for r in range(rounds):
+            target = r + 2
+            change(portfolio_path, portfolio)
+            published = time.perf_counter()
+            feed.poll()
+            while min(counts) < target:
+                time.sleep(0.0005)
+            total += max(received) - published
+        for worker in workers:
+            worker.join()
+        return total / rounds * 1000
+
+
+if __name__ == '__main__':
+    print(f'{CHANGES} changes, buffer {BUFFER} events per client')
+    print(f'{"clients":>8} {"feed memory (KiB)":>18} {"KiB/client":>11} {"fan-out (ms)":>13}')
+    for clients in [1, 10, 100, 1000]:
+        held = idle_clients(clients)
+        fan_out = reading_clients(clients) if clients <= 100 else float('nan')
+        print(f'{clients:>8} {held:>18.0f} {held / clients:>11.1f} {fan_out:>13.2f}')
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+import sys
+import time
+import random
+
+sys.path.append('../')
+
+from stub_broker import StubBroker, make_etrader
+
+# A stub account holds 10k historical filled orders. Each watchdog cycle a
+# few new fills come in; compare refetching the full history against the
+# incremental sync.
+
+LATENCY = 0.005
+HISTORY = 10000
+CYCLES = 5
+NEW_PER_CYCLE = 3
+
+random.seed(3)
+broker = StubBroker(latency=LATENCY).start()
+etrader = make_etrader(broker)
+symbols = [f'S{i:03d}' for i in range(300)]
+
+now = time.time()
+for i in range(HISTORY):
+    # spread history over the last 200 days
+    placed_at = now - (HISTORY - i) / HISTORY * 200 * 86400 - 86400 * 2
+    broker.add_fill(random.choice(symbols), random.choice(['BUY', 'SELL']), random.randint(1, 1000), random.random() * 10, placed_at)
+
+# first incremental sync loads the whole history once
+positions = {}
+
+
+def accumulate(fills: list) -> set:
+    for fill in fills:
+        position = positions.setdefault(fill.symbol, [0, 0.0])
+        position[0] += fill.shares
+        position[1] += fill.value
+    return {fill.symbol for fill in fills}
+
+
+start = time.perf_counter()
+accumulate(etrader.sync_filled_orders()[0])
+print(f'initial sync of {HISTORY} orders: {time.perf_counter() - start:.2f} s')
+
+full_time = incr_time = 0.0
+full_requests = incr_requests = 0
+for cycle in range(CYCLES):
+    for _ in range(NEW_PER_CYCLE):
+        broker.add_fill(random.choice(symbols), 'BUY', random.randint(1, 1000), random.random() * 10)
+
+    before = broker.requests
+    start = time.perf_counter()
+    full = etrader.get_filled_orders()
+    full_time += time.perf_counter() - start
+    full_requests += broker.requests - before
+
+    before = broker.requests
+    start = time.perf_counter()
+    fills, _ = etrader.sync_filled_orders()
+    incr_time += time.perf_counter() - start
+    incr_requests += broker.requests - before
+
+    # deltas added up must match the full recount
+    for ticker in accumulate(fills):
+        assert positions[ticker][0] == full[ticker][0] and abs(positions[ticker][1] - full[ticker][1]) < 1e-6
+
+print(f'{"":>12} {"per cycle (s)":>14} {"requests/cycle":>15}')
+print(f'{"full":>12} {full_time / CYCLES:>14.3f} {full_requests / CYCLES:>15.1f}')
+print(f'{"incremental":>12} {incr_time / CYCLES:>14.3f} {incr_requests / CYCLES:>15.1f}')
+
+broker.stop()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import random
+import tempfile
+from threading import Thread, Event
+
+sys.path.append('../')
+
+from logger import Logger
+from position_store import PositionStore
+from storage import JsonStorage
+from ledger import Ledger
+
+# Buy workers race for a balance that covers only some of their orders.
+# Each one reserves the order's cost, "waits for the broker", then settles
+# for a random fill (partial fills included) or releases on rejection,
+# while other threads deposit. A checker thread watches the invariants the
+# whole time:
+#
+#   reserved >= 0, available >= 0 (nothing is ever overspent)
+#   balance == start + sum of all transactions
+#
+# and at the end nothing is left reserved and the persisted balance matches.
+# The same workload with check-then-subtract (as the buy path did before)
+# is run for comparison.
+
+WORKERS = 16
+ORDERS = 300
+START = 1000.0
+COST = 7.5
+
+
+def naive_run(store: PositionStore) -> float:
+    def work():
+        for _ in range(ORDERS):
+            if store.wallet('in') >= COST:
+                # broker round trip between the check and the write
+                time.sleep(0)
+                store.add_to_wallet('in', -COST)
+
+    threads = [Thread(target=work) for _ in range(WORKERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return store.wallet('in')
+
+
+def ledger_run(store: PositionStore, ledger: Ledger) -> dict:
+    stats = {'filled': 0, 'partial': 0, 'rejected': 0, 'no_funds': 0, 'deposited': 0.0, 'violations': 0}
+    stop = Event()
+
+    def check():
+        while not stop.is_set():
+            if ledger.reserved < -1e-9 or ledger.available < -1e-9:
+                stats['violations'] += 1
+
+    def buy():
+        for _ in range(ORDERS):
+            reservation = ledger.reserve(COST, 'TEST')
+            if reservation is None:
+                stats['no_funds'] += 1
+                continue
+            time.sleep(0)
+            outcome = random.random()
+            if outcome < 0.2:
+                ledger.release(reservation)
+                stats['rejected'] += 1
+            elif outcome < 0.4:
+                ledger.settle(reservation, COST * random.random())
+                stats['partial'] += 1
+            else:
+                ledger.settle(reservation)
+                stats['filled'] += 1
+
+    def deposit():
+        for _ in range(ORDERS // 10):
+            ledger.deposit(COST, 'TOPUP')
+            stats['deposited'] += COST
+            time.sleep(0.001)
+
+    checker = Thread(target=check)
+    checker.start()
+    threads = [Thread(target=buy) for _ in range(WORKERS)] + [Thread(target=deposit) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    checker.join()
+    return stats
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        Logger.PATH = os.path.join(tmp, 'log.txt')
+        Logger.set_level('WARN')
+
+        naive_dir = os.path.join(tmp, 'naive')
+        os.mkdir(naive_dir)
+        storage = JsonStorage(naive_dir)
+        storage.initialize_wallet(START)
+        balance = naive_run(PositionStore(storage))
+        print(f'check-then-subtract: balance {balance:.2f} ({"OVERSPENT" if balance < 0 else "ok"})')
+
+        ledger_dir = os.path.join(tmp, 'ledger')
+        os.mkdir(ledger_dir)
+        storage = JsonStorage(ledger_dir)
+        storage.initialize_wallet(START)
+        store = PositionStore(storage)
+        ledger = Ledger(store)
+        start = time.perf_counter()
+        stats = ledger_run(store, ledger)
+        elapsed = time.perf_counter() - start
+
+        transactions = ledger.transactions()
+        total = START + sum(t.amount for t in transactions)
+        store.snapshot()
+        reloaded = PositionStore(JsonStorage(ledger_dir)).wallet('in')
+
+        print(f'ledger: {stats["filled"]} filled, {stats["partial"]} partial, {stats["rejected"]} released, {stats["no_funds"]} refused, deposited {stats["deposited"]:.2f} ({elapsed:.2f} s)')
+        print(f'ledger: balance {ledger.balance:.4f}  start + transactions {total:.4f}  reloaded {reloaded:.4f}  reserved {ledger.reserved}  invariant violations {stats["violations"]}')
+
+        assert stats['violations'] == 0, 'available or reserved went negative'
+        assert ledger.reserved == 0 and len(ledger.reservations()) == 0, 'reservations left open'
+        assert abs(ledger.balance - total) < 1e-6, 'balance does not match transactions'
+        assert abs(reloaded - ledger.balance) < 1e-6, 'persisted balance differs'
+        assert ledger.balance >= -1e-9, 'overspent'
+        print('invariants hold')
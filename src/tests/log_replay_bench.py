@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import sys
+import io
+import os
+import time
+import tempfile
+
+sys.path.append('../')
+
+import signal_replay
+from signal_replay import ReplayTrader, synthesize_payloads, load_payloads
+
+from logger import Logger
+from reader import Reader
+
+# Replays payloads through Reader.handle_payload and reports time spent per
+# payload with debug logging on and off, and what the debug lines of the
+# hot path cost when their message is built eagerly (f-strings) vs deferred.
+#
+# usage: ./log_replay_bench.py [payloads.jsonl]
+
+ROUNDS = 5
+
+
+def replay(reader: Reader, payloads: list) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for payload in payloads:
+            reader.handle_payload(payload)
+    return (time.perf_counter() - start) / (ROUNDS * len(payloads)) * 1e6
+
+
+def debug_lines(payloads: list, lazy: bool) -> float:
+    log = Logger.get('reader')
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for payload in payloads:
+            text = payload['message']['content']['text']['text']
+            if lazy:
+                log.debug('payload: %s', payload)
+                log.debug('Text received %s', text)
+            else:
+                Logger.debug(f'payload: {payload}')
+                Logger.debug(f'Text received {text}')
+    return (time.perf_counter() - start) / (ROUNDS * len(payloads)) * 1e6
+
+
+if __name__ == '__main__':
+    payloads = load_payloads(sys.argv[1]) if len(sys.argv) > 1 else synthesize_payloads(2000)
+    # no broker round trips: only the callback path is measured
+    signal_replay.ROUND_TRIP = 0
+
+    stdout = sys.stdout
+    path = Logger.PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        Logger.PATH = os.path.join(tmp, 'log.txt')
+        sys.stdout = io.StringIO()
+        reader = Reader(trader=ReplayTrader())
+
+        results = []
+        for level in ['DEBUG', 'INFO']:
+            Logger.set_level(level)
+            results.append((f'handle_payload, level {level}', replay(reader, payloads)))
+
+        # production setting: debug off, only the format string & args are passed around
+        Logger.set_level('INFO')
+        results.append(('debug lines, eager f-strings', debug_lines(payloads, False)))
+        results.append(('debug lines, deferred', debug_lines(payloads, True)))
+
+        # per-module switch: only the reader logs debug
+        Logger.set_level('DEBUG', 'reader')
+        results.append(('debug lines, deferred, reader at DEBUG', debug_lines(payloads, True)))
+        Logger.set_level(None, 'reader')
+
+        # signal workers are still logging submitted orders: stop them and
+        # get their lines out before the temp dir goes away
+        reader.pipeline.close()
+        Logger.flush()
+        Logger.PATH = path
+        sys.stdout = stdout
+
+    print(f'payloads: {len(payloads)} x {ROUNDS}')
+    for name, per_payload in results:
+        print(f'{name:<42} {per_payload:>8.2f} us/payload')
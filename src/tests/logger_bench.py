@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+import sys
+import os
+import io
+import time
+import tempfile
+from threading import Thread
+
+sys.path.append('../')
+
+from logger import Logger
+
+# Measures per-call overhead of Logger.info with 1, 4 and 16 threads logging
+# at once, writing synchronously vs through the background writer.
+
+CALLS = 2000
+
+
+def run(threads: int) -> float:
+    def work():
+        for i in range(CALLS):
+            Logger.info(f'order update {i}')
+
+    workers = [Thread(target=work) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (threads * CALLS) * 1e6
+
+
+if __name__ == '__main__':
+    stdout = sys.stdout
+    with tempfile.TemporaryDirectory() as tmp:
+        Logger.PATH = os.path.join(tmp, 'log.txt')
+        # console output goes nowhere so we only measure the logger
+        sys.stdout = io.StringIO()
+
+        results = {}
+        for threads in [1, 4, 16]:
+            sync = run(threads)
+            results[threads] = [sync]
+
+        Logger.start_async()
+        for threads in [1, 4, 16]:
+            start = time.perf_counter()
+            results[threads].append(run(threads))
+            Logger.flush()
+            results[threads].append((time.perf_counter() - start) / (threads * CALLS) * 1e6)
+
+        sys.stdout = stdout
+        print(f'{"threads":>8} {"sync (us/call)":>15} {"async (us/call)":>16} {"async incl. drain":>18}')
+        for threads, (sync, async_call, drained) in results.items():
+            print(f'{threads:>8} {sync:>15.1f} {async_call:>16.1f} {drained:>18.1f}')
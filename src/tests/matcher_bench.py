@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+import sys
+import re
+import time
+import random
+
+sys.path.append('../')
+
+import constants as ct
+from matcher import TextMatcher, TICKER_PATTERN
+
+# Compares the old per-word substring loop + re.findall against the
+# compiled TextMatcher over channel-sized messages.
+
+random.seed(7)
+
+FILLER = ['gap up', 'loading', 'watch this one', 'chart looks great', 'otc', 'sub penny', 'volume coming in',
+          'bid whacked', 'holding', 'dip buy', 'news out', 'filings current', 'reverse split', 'runner', 'lfg']
+
+
+def ticker() -> str:
+    return ''.join(random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(random.randint(3, 5)))
+
+
+def message() -> str:
+    parts = []
+    # typical alert: a couple hundred characters, 1-5 tickers
+    while sum(len(p) for p in parts) < random.randint(80, 400):
+        parts.append(random.choice(FILLER + [ticker(), ticker() + '!', '$' + ticker()]))
+    if random.random() < 0.2:
+        parts.insert(random.randint(0, len(parts)), random.choice(ct.NEGATIVE_WORDS))
+    return ' '.join(parts)
+
+
+def word_list(n: int) -> list:
+    words = list(ct.NEGATIVE_WORDS)
+    while len(words) < n:
+        words.append(''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(random.randint(4, 10))))
+    return words
+
+
+def old_match(text: str, words: list):
+    tickers = re.findall(TICKER_PATTERN, text)
+    low = text.lower()
+    negative_bias = False
+    for word in words:
+        if word in low:
+            negative_bias = True
+            break
+    return tickers, negative_bias
+
+
+if __name__ == '__main__':
+    corpus = [message() for _ in range(2000)]
+    print(f'{len(corpus)} messages, avg {sum(map(len, corpus)) / len(corpus):.0f} chars')
+    print(f'{"words":>6} {"build (ms)":>11} {"loop (us/msg)":>14} {"matcher (us/msg)":>17}')
+
+    for n in [14, 500, 5000]:
+        words = word_list(n)
+
+        start = time.perf_counter()
+        matcher = TextMatcher(words)
+        build = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        old = [old_match(text, words) for text in corpus]
+        old_time = (time.perf_counter() - start) / len(corpus) * 1e6
+
+        start = time.perf_counter()
+        new = [matcher.match(text) for text in corpus]
+        new_time = (time.perf_counter() - start) / len(corpus) * 1e6
+
+        # both approaches must agree
+        assert all(o == (r.tickers, r.negative_bias) for o, r in zip(old, new))
+        print(f'{n:>6} {build:>11.1f} {old_time:>14.1f} {new_time:>17.1f}')
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append('../')
+
+from stub_broker import StubBroker, make_etrader
+
+# Submits the orders of one multi-ticker message against a mock broker,
+# one after the other with payload dumps (old behaviour) and on
+# ORDER_WORKERS threads with dumps off, the way Trader.handle_sell_sigs does.
+#
+# usage: ./order_bench.py [latency seconds]
+
+LATENCY = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+
+broker = StubBroker(latency=LATENCY).start()
+etrader = make_etrader(broker)
+
+import constants as ct
+from etrader import ETrader
+
+pool = ThreadPoolExecutor(max_workers=ct.ORDER_WORKERS)
+
+
+def orders(n: int) -> list:
+    return [dict(price_type='LIMIT', order_term='GOOD_FOR_DAY', limit_price=0.0011, symbol=f'T{i:03d}', order_action='BUY', quantity=900000) for i in range(n)]
+
+
+print(f'mock broker latency: {LATENCY * 1000:.0f} ms')
+print(f'{"orders":>7} {"sequential (s)":>15} {"fast path (s)":>14} {"p2p avg (ms)":>13}')
+
+for n in [1, 5, 20]:
+    ETrader.DEBUG = True
+    start = time.perf_counter()
+    for order in orders(n):
+        etrader.place_order(**order)
+    sequential = time.perf_counter() - start
+
+    ETrader.DEBUG = False
+    etrader.order_timings.clear()
+    start = time.perf_counter()
+    results = list(pool.map(lambda order: etrader.place_order(**order), orders(n)))
+    fast = time.perf_counter() - start
+    assert all(valid for valid, _ in results)
+
+    preview_to_place = sum(t[2] for t in etrader.order_timings) / len(etrader.order_timings)
+    print(f'{n:>7} {sequential:>15.3f} {fast:>14.3f} {preview_to_place * 1000:>13.1f}')
+
+broker.stop()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import tempfile
+
+sys.path.append('../')
+
+from logger import Logger
+from stub_broker import StubBroker, make_etrader
+
+# Walks orders through their states against the stub broker, syncing fills
+# the way the watchdog does: history loaded on the first sync, then a buy
+# filling in two parts, a sell filling in two parts, a buy that never
+# fills and one whose fills arrive before we knew its broker id. Positions,
+# profit and ledger reservations must follow the fills exactly. Then the
+# trader restarts with two buys open: their reservations must be held again
+# and their fills still settle them.
+#
+# usage: ./order_replay.py [json|sqlite]
+
+
+def sync(etrader, portfolio) -> None:
+    fills, complete = etrader.sync_filled_orders()
+    portfolio.sync_order_fills(fills, complete)
+
+
+def place(etrader, portfolio, symbol: str, action: str, quantity: int, limit_price: float, reservation=None, known_id: bool = True):
+    from orders import parse_order_id
+
+    order = portfolio.orders.open(symbol, action, quantity, limit_price, reservation)
+    valid, response = etrader.place_order(price_type='LIMIT', order_term='GOOD_FOR_DAY', limit_price=limit_price, symbol=symbol, order_action=action, quantity=quantity, client_order_id=order.client_id)
+    assert valid
+    if known_id:
+        portfolio.orders.placed(order, parse_order_id(response))
+    return order, parse_order_id(response)
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        Logger.PATH = os.path.join(tmp, 'log.txt')
+        Logger.set_level('WARN')
+        os.chdir(tmp)
+        os.mkdir('db')
+
+        import constants as ct
+        from portfolio import Portfolio
+        from orders import Order
+
+        ct.STORAGE_BACKEND = sys.argv[1] if len(sys.argv) > 1 else 'json'
+        broker = StubBroker().start()
+        etrader = make_etrader(broker)
+
+        # history from before this run
+        broker.add_fill('OLD', 'BUY', 100, 10.0, time.time() - 86400 * 30)
+        broker.add_fill('OLD', 'SELL', 40, 6.0, time.time() - 86400 * 20)
+
+        Portfolio.initialize_wallet(1000)
+        portfolio = Portfolio()
+        sync(etrader, portfolio)
+        old = portfolio.get_asset('OLD')
+        assert old['shares'] == 60 and abs(old['stake'] - 6.0) < 1e-9, old
+        assert portfolio.get_wallet()['out'] == 0, 'history booked as profit again'
+
+        # buy 100 at a limit of 0.5; fills come in at a better price, in two parts
+        reservation = portfolio.ledger.reserve(50.0, 'ABC')
+        buy, buy_id = place(etrader, portfolio, 'ABC', Order.BUY, 100, 0.5, reservation)
+        assert buy.state == Order.NEW and portfolio.available == 950
+
+        broker.add_fill('ABC', 'BUY', 40, 16.0, order_id=buy_id)
+        sync(etrader, portfolio)
+        assert buy.state == Order.PARTIAL and portfolio.get_asset('ABC')['shares'] == 40
+        assert portfolio.balance == 1000 and portfolio.available == 950, 'partial fill settled early'
+
+        broker.add_fill('ABC', 'BUY', 100, 40.0, order_id=buy_id)
+        sync(etrader, portfolio)
+        abc = portfolio.get_asset('ABC')
+        assert buy.state == Order.FILLED and abc['shares'] == 100 and abs(abc['stake'] - 40.0) < 1e-9, abc
+        assert portfolio.balance == 960 and portfolio.available == 960 and portfolio.ledger.reserved == 0
+
+        # sell everything; while the sell is open there is nothing left to sell
+        sell, sell_id = place(etrader, portfolio, 'ABC', Order.SELL, 100, 0.6)
+        assert 100 - portfolio.orders.pending('ABC', Order.SELL) == 0
+
+        broker.add_fill('ABC', 'SELL', 60, 36.0, order_id=sell_id)
+        sync(etrader, portfolio)
+        abc = portfolio.get_asset('ABC')
+        assert sell.state == Order.PARTIAL and abc['shares'] == 40 and abs(abc['stake'] - 16.0) < 1e-9, abc
+        assert abs(portfolio.get_wallet()['out'] - 12.0) < 1e-9
+
+        broker.add_fill('ABC', 'SELL', 100, 60.0, order_id=sell_id)
+        sync(etrader, portfolio)
+        abc = portfolio.get_asset('ABC')
+        assert sell.state == Order.FILLED and abc['shares'] == 0 and abs(abc['stake']) < 1e-9, abc
+        assert abs(portfolio.get_wallet()['out'] - 20.0) < 1e-9
+
+        # fills that show up before we learned the broker id still find their order
+        reservation = portfolio.ledger.reserve(10.0, 'XYZ')
+        early, early_id = place(etrader, portfolio, 'XYZ', Order.BUY, 10, 1.0, reservation, known_id=False)
+        broker.add_fill('XYZ', 'BUY', 10, 9.0, order_id=early_id)
+        sync(etrader, portfolio)
+        assert early.state == Order.FILLED and early.order_id == early_id and portfolio.balance == 951
+
+        # a buy that never fills gives its reservation back once it expires
+        reservation = portfolio.ledger.reserve(100.0, 'NOP')
+        stale, _ = place(etrader, portfolio, 'NOP', Order.BUY, 100, 1.0, reservation)
+        assert portfolio.available == 851
+        portfolio.orders.expire(time.time() + ct.ORDER_MAX_AGE + 1)
+        assert stale.state == Order.CANCELLED and portfolio.available == 951 and portfolio.ledger.reserved == 0
+        assert len(portfolio.orders.open_orders()) == 0
+
+        # restart with a partly filled buy in the snapshot and one without a
+        # broker id in the journal; an old fill of its symbol isn't it
+        reservation = portfolio.ledger.reserve(50.0, 'RST')
+        partial, partial_id = place(etrader, portfolio, 'RST', Order.BUY, 100, 0.5, reservation)
+        broker.add_fill('RST', 'BUY', 40, 16.0, order_id=partial_id)
+        sync(etrader, portfolio)
+        portfolio.store.snapshot()
+        broker.add_fill('LATE', 'BUY', 5, 1.0, time.time() - 86400 * 10)
+        reservation = portfolio.ledger.reserve(20.0, 'LATE')
+        unknown, unknown_id = place(etrader, portfolio, 'LATE', Order.BUY, 20, 1.0, reservation, known_id=False)
+        assert portfolio.available == 881
+        portfolio.store.stop()
+
+        etrader = make_etrader(broker)
+        restarted = Portfolio()
+        restored = {order.client_id: order for order in restarted.orders.open_orders()}
+        assert set(restored) == {partial.client_id, unknown.client_id} and restored[partial.client_id].order_id == partial_id
+        assert restarted.balance == 951 and restarted.ledger.reserved == 70 and restarted.available == 881
+
+        broker.add_fill('RST', 'BUY', 100, 40.0, order_id=partial_id)
+        broker.add_fill('LATE', 'BUY', 20, 18.0, order_id=unknown_id)
+        sync(etrader, restarted)
+        assert restored[partial.client_id].state == Order.FILLED and restored[unknown.client_id].order_id == unknown_id
+        assert restarted.get_asset('RST')['shares'] == 100 and restarted.get_asset('LATE')['shares'] == 25
+        assert restarted.balance == 893 and restarted.ledger.reserved == 0 and len(restarted.orders.open_orders()) == 0
+        restarted.store.stop()
+        assert len(Portfolio().orders.open_orders()) == 0, 'closed orders restored'
+
+        for order in list(portfolio.orders.history) + list(restarted.orders.history):
+            print(f'{order.action:>4} {order.symbol:>4} {order.state:>9} {order.filled:>4}/{order.quantity:<4} value {order.value:>6.2f}')
+        print(f'balance {restarted.balance}  profit {restarted.get_wallet()["out"]}  positions {restarted.portfolio}')
+        print('order states, positions & reservations follow the fills')
+        broker.stop()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import tempfile
+
+sys.path.append('../')
+
+from tinydb import TinyDB, Query
+from position_store import PositionStore
+from storage import JsonStorage, write_table
+
+# Compares per-operation latency of TinyDB-backed portfolio reads/writes
+# (as Portfolio did them before) against the in-memory PositionStore.
+
+OPS = 50
+
+
+def timed(fn, n: int = OPS) -> float:
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def bench(rows: int, tmp: str) -> dict:
+    db_dir = os.path.join(tmp, str(rows))
+    os.mkdir(db_dir)
+    portfolio_path = os.path.join(db_dir, 'portfolio.json')
+    wallet_path = os.path.join(db_dir, 'wallet.json')
+    tickers = [f'T{i:05d}' for i in range(rows)]
+    write_table(portfolio_path, [{'shares': 10, 'ticker': t, 'stake': 1.0} for t in tickers])
+    write_table(wallet_path, [{'in': 1000, 'out': 0}])
+
+    results = {}
+
+    portfolio = TinyDB(portfolio_path)
+    wallet = TinyDB(wallet_path)
+    results['tinydb'] = {
+        'get_asset': timed(lambda i: portfolio.search(Query().ticker == tickers[i * 7 % rows])),
+        'balance': timed(lambda i: wallet.all()[0]['in']),
+        'get_tickers': timed(lambda i: [row['ticker'] for row in portfolio]),
+        'update': timed(lambda i: portfolio.update({'shares': i, 'stake': 2.0}, Query().ticker == tickers[i * 7 % rows]), 10),
+    }
+    portfolio.close()
+    wallet.close()
+
+    store = PositionStore(JsonStorage(db_dir))
+    results['store'] = {
+        'get_asset': timed(lambda i: store.get(tickers[i * 7 % rows]), 10000),
+        'balance': timed(lambda i: store.wallet('in'), 10000),
+        'get_tickers': timed(lambda i: store.tickers(), 1000),
+        'update': timed(lambda i: store.put(tickers[i * 7 % rows], i, 2.0), 10000),
+    }
+
+    return results
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f'{"rows":>6} {"op":>12} {"tinydb (us)":>12} {"store (us)":>11} {"speedup":>8}')
+        for rows in [100, 1000, 10000]:
+            results = bench(rows, tmp)
+            for op in results['tinydb']:
+                old, new = results['tinydb'][op], results['store'][op]
+                print(f'{rows:>6} {op:>12} {old:>12.1f} {new:>11.2f} {old / new:>7.0f}x')
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+import sys
+import time
+
+sys.path.append('../')
+
+from stub_broker import StubBroker, make_etrader
+
+# simulated broker round trip in seconds
+LATENCY = 0.02
+
+broker = StubBroker(latency=LATENCY).start()
+etrader = make_etrader(broker)
+
+print(f'stub latency: {LATENCY * 1000:.0f} ms')
+print(f'{"tickers":>8} {"per-symbol (s)":>15} {"batched (s)":>12} {"requests":>9}')
+
+for n in [1, 10, 50, 200]:
+    tickers = [f'T{i:04d}' for i in range(n)]
+
+    start = time.perf_counter()
+    for ticker in tickers:
+        etrader.get_ticker_price(ticker)
+    single = time.perf_counter() - start
+
+    before = broker.requests
+    start = time.perf_counter()
+    etrader.get_ticker_prices(tickers)
+    batched = time.perf_counter() - start
+
+    print(f'{n:>8} {single:>15.3f} {batched:>12.3f} {broker.requests - before:>9}')
+
+broker.stop()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+import sys
+import json
+import time
+import random
+from threading import Lock
+
+sys.path.append('../')
+
+from stub_broker import install_credentials
+
+install_credentials()
+
+import constants as ct
+from reader import Reader
+
+# Replays recorded TDLib payloads (one JSON object per line) through the
+# Reader's signal pipeline and reports receipt -> order submission latency.
+#
+# usage: ./signal_replay.py [payloads.jsonl]
+
+# simulated broker round trip in seconds (quote, preview & place each cost one)
+ROUND_TRIP = 0.05
+# gap between consecutive channel messages in seconds
+MESSAGE_GAP = 0.1
+
+
+class ReplayTrader(object):
+    """
+    Stands in for Trader: pays three broker round trips per ticker.
+    """
+    def __init__(self):
+        self.__lock = Lock()
+        self.orders = 0
+
+    def handle_buy_sig(self, ticker: str, negative_bias: bool = False) -> bool:
+        for _ in range(3):
+            time.sleep(ROUND_TRIP)
+        self.__lock.acquire()
+        self.orders += 1
+        self.__lock.release()
+        return True
+
+
+def synthesize_payloads(n: int) -> list:
+    words = ['gap up', 'watch', 'loading', 'runner', 'otc', 'chart', 'nice']
+    payloads = []
+    for i in range(n):
+        tickers = ' '.join(''.join(random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(4)) for _ in range(5))
+        text = f'{random.choice(words)} {tickers} {random.choice(words)}'
+        payloads.append({
+            '@type': 'updateNewMessage',
+            'message': {
+                'chat_id': ct.TG_CHAT_ID_FILTER[0],
+                'content': {'@type': 'messageText', 'text': {'@type': 'formattedText', 'text': text}},
+            },
+        })
+    return payloads
+
+
+def load_payloads(path: str) -> list:
+    with open(path) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+if __name__ == '__main__':
+    payloads = load_payloads(sys.argv[1]) if len(sys.argv) > 1 else synthesize_payloads(20)
+
+    trader = ReplayTrader()
+    reader = Reader(trader=trader)
+
+    callback_time = 0.0
+    start = time.perf_counter()
+    for payload in payloads:
+        received = time.perf_counter()
+        reader.handle_payload(payload)
+        callback_time += time.perf_counter() - received
+        time.sleep(MESSAGE_GAP)
+    total_time = time.perf_counter() - start
+
+    # wait for workers to drain the queue
+    time.sleep(ROUND_TRIP)
+    while reader.pipeline.metrics()['depth'] + reader.pipeline.metrics()['in_flight'] > 0:
+        time.sleep(0.01)
+
+    metrics = reader.pipeline.metrics()
+    print(f'payloads: {len(payloads)}  time spent in callbacks: {callback_time * 1000:.1f} ms  replay: {total_time:.1f} s')
+    print(f'orders: {metrics["processed"]}  max queue depth: {metrics["max_depth"]}  dropped: {metrics["dropped"]}')
+    print(f'signal -> order p50: {metrics["p50_ms"]:.1f} ms  p99: {metrics["p99_ms"]:.1f} ms')
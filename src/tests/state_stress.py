@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import tempfile
+import multiprocessing
+from threading import Thread
+
+from tinydb import TinyDB
+from tinydb.operations import add
+
+sys.path.append('../')
+
+from logger import Logger
+from position_store import PositionStore
+from storage import JsonStorage, SqliteStorage
+from thresholds import ThresholdIndex, Rule
+from state_service import StateService, StateClient
+from ledger import Ledger
+
+# Several processes (webserver stand-ins) with several threads each add to
+# the wallet while the owning process (trader stand-in) spends from it and
+# moves thresholds. Every write must show up in the final balance, in
+# memory and after reloading the snapshot. For comparison the same load
+# goes straight at a TinyDB file from all processes, as before.
+
+PROCESSES = 4
+THREADS = 4
+UPDATES = 250
+START = 1000
+
+
+def service_worker(path: str) -> None:
+    client = StateClient(path)
+    rules = {row['kind']: row['uuid'] for row in client.watchlist()}
+
+    def work():
+        for i in range(UPDATES):
+            client.add_to_wallet('in', 1)
+            if i % 50 == 0:
+                assert client.set_threshold('ABC', rules['take_profit'], float(i + 2))
+                # only the rule asked for moves; expiry rules can't be moved at all
+                assert not client.set_threshold('ABC', rules['expiry'], float(i + 2))
+
+    threads = [Thread(target=work) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def tinydb_worker(path: str) -> None:
+    def work():
+        for _ in range(UPDATES):
+            with TinyDB(path) as db:
+                db.update(add('in', 1))
+
+    threads = [Thread(target=work) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_processes(target: 'callable', arg: str) -> float:
+    start = time.perf_counter()
+    processes = [multiprocessing.Process(target=target, args=(arg,)) for _ in range(PROCESSES)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return time.perf_counter() - start
+
+
+def service_run(tmp: str, backend: str) -> None:
+    db_dir = os.path.join(tmp, backend)
+    os.mkdir(db_dir)
+    open_storage = (lambda: JsonStorage(db_dir)) if backend == 'json' else (lambda: SqliteStorage(os.path.join(db_dir, 'plunder.db')))
+    storage = open_storage()
+    storage.initialize_wallet(START)
+    store = PositionStore(storage)
+    store.start()
+    rules = ThresholdIndex(storage)
+    rules.add('ABC', Rule.TAKE_PROFIT, 1.0)
+    rules.add('ABC', Rule.STOP_LOSS, 0.25)
+    rules.add('ABC', Rule.EXPIRY, time.time() + 3600)
+    rules.start()
+
+    ledger = Ledger(store)
+    service = StateService(store, ledger, rules, os.path.join(db_dir, 'state.sock'))
+    service.start()
+
+    # trader stand-in spends from the same wallet meanwhile
+    def spend():
+        for _ in range(UPDATES):
+            ledger.spend(1)
+            rules.evaluate('ABC', 0.5)
+
+    spender = Thread(target=spend)
+    spender.start()
+    elapsed = run_processes(service_worker, os.path.join(db_dir, 'state.sock'))
+    spender.join()
+
+    expected = START + PROCESSES * THREADS * UPDATES - UPDATES
+    in_memory = store.wallet('in')
+    store.snapshot()
+    service.stop()
+    reloaded = PositionStore(open_storage()).wallet('in')
+
+    print(f'service ({backend:>6}): expected {expected}  in memory {in_memory}  reloaded {reloaded}  lost {expected - reloaded}  ({elapsed:.2f} s)')
+    assert in_memory == expected and reloaded == expected, 'lost writes through state service'
+    kinds = {rule.kind: rule.threshold for rule in rules.rules('ABC')}
+    assert kinds[Rule.TAKE_PROFIT] > 1 and kinds[Rule.STOP_LOSS] == 0.25 and kinds[Rule.EXPIRY] > time.time(), kinds
+
+
+def tinydb_run(tmp: str) -> None:
+    path = os.path.join(tmp, 'wallet_tinydb.json')
+    with TinyDB(path) as db:
+        db.insert({'in': START, 'out': 0})
+
+    elapsed = run_processes(tinydb_worker, path)
+
+    expected = START + PROCESSES * THREADS * UPDATES
+    with TinyDB(path) as db:
+        actual = db.all()[0]['in']
+    print(f'shared TinyDB:   expected {expected}  actual {actual}  lost {expected - actual}  ({elapsed:.2f} s)')
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        Logger.PATH = os.path.join(tmp, 'log.txt')
+        Logger.set_level('WARN')
+        print(f'{PROCESSES} processes x {THREADS} threads x {UPDATES} updates')
+        tinydb_run(tmp)
+        service_run(tmp, 'json')
+        service_run(tmp, 'sqlite')
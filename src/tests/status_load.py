@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import random
+import logging
+import tempfile
+from threading import Thread, Event
+
+import requests
+from tinydb import TinyDB
+from werkzeug.serving import make_server
+
+sys.path.append('../')
+
+import constants as ct
+import webserver
+from storage import JsonStorage, write_table
+
+# Hammers /status from several client threads against the threaded dev
+# server and reports requests/sec for the old page (TinyDB scan and string
+# concatenation on every request), the cached page, and the cached page
+# with If-None-Match (304s). A writer thread rewrites the portfolio every
+# second like the trader does.
+#
+# usage: ./status_load.py [positions]
+
+CLIENTS = 8
+DURATION = 5
+AUTH = ('Quaid', webserver.MANAGE_PW)
+# json files of the temp db dir set up below
+WALLET_PATH = PORTFOLIO_PATH = WATCHLIST_PATH = None
+
+
+def legacy_status():
+    """
+    /status as it was before the render cache.
+    """
+    wallet_table = TinyDB(WALLET_PATH)
+    portfolio_table = TinyDB(PORTFOLIO_PATH)
+    watchlist_table = TinyDB(WATCHLIST_PATH)
+
+    result = ''
+    profit = 0.0
+    result += '<style>table, td { border: 1px solid black; border-collapse: collapse;}</style>'
+    result += '<table style="border: 0;"><tr><td style="border: 0;"><h2>Portfolio: </br></h2><table >'
+    result += '<tr><td>Ticker</td><td>Avg price</td><td>Stake</td><td>Share #</td><td>Status</td></tr>'
+    for entry in portfolio_table:
+        share_no = entry['shares']
+        stake = entry['stake']
+        if share_no > 0:
+            status = '<td style="background-color:#e0d900">HOLD</td>'
+        elif int(share_no) == 0 and int(stake) == 0:
+            status = '<td style="background-color:#f2780c">CANCELLED</td>'
+        else:
+            profit += -stake
+            status = '<td style="background-color:#6dba02">SOLD</td>'
+        avg_price = 'N/A' if share_no == 0 else round(stake/share_no, 5)
+        result += f'<tr><td>{entry["ticker"]}</td><td>{avg_price}</td><td>{round(stake, 4)}</td><td>{share_no}</td>{status}</tr>'
+    result += '</table></td><td style="vertical-align:top; border: 0; padding-left: 20px;">'
+    result += '<h2>Watchlist: </br></h2><form method="POST"><table><tr><td>Ticker</td><td>Sell at</td><td></td></tr>'
+    for entry in watchlist_table:
+        result += f'<tr><td>{entry["ticker"]}</td><td><input type="text" name={entry["ticker"]}_st value="{round(entry["threshold"], 4)}" size=8></td><td><input type="submit" value="update"/></td></tr>'
+    result += '</table></form></td></tr></table>'
+    result += '<h2>Wallet: </br></h2><form action="/manage" method="POST">'
+    for entry in wallet_table:
+        result += f'Available to invest: <input type="text" name="new_budget" value={round(entry["in"], 4)} {ct.CURRENCY_SYMBOL} size=5/>USD</br>'
+        result += f'Actual total profit: {profit} {ct.CURRENCY_SYMBOL}</br>'
+        result += f'Estimated profit (from 02/02): {round(entry["out"], 4)} {ct.CURRENCY_SYMBOL}</br></br>'
+    result += '<input type="submit" value="update"/></form>'
+    for table in [wallet_table, portfolio_table, watchlist_table]:
+        table.close()
+    return result
+
+
+def make_rows(n: int) -> (list, list):
+    portfolio, watchlist = [], []
+    for i in range(n):
+        ticker = f'T{i:04d}'
+        shares = random.choice([0, 100, 250])
+        portfolio.append({'ticker': ticker, 'shares': shares, 'stake': shares * random.uniform(0.1, 5)})
+        if shares > 0:
+            watchlist.append({'uuid': str(i), 'ticker': ticker, 'threshold': random.uniform(0.1, 5), 'op': '>'})
+    return portfolio, watchlist
+
+
+def load(url: str, conditional: bool) -> float:
+    stop = Event()
+    counts = [0] * CLIENTS
+
+    def client(i: int):
+        session = requests.Session()
+        etag = None
+        while not stop.is_set():
+            headers = {'If-None-Match': etag} if conditional and etag is not None else {}
+            response = session.get(url, auth=AUTH, headers=headers)
+            assert response.status_code in (200, 304), response.status_code
+            etag = response.headers.get('ETag', etag)
+            counts[i] += 1
+
+    workers = [Thread(target=client, args=(i,)) for i in range(CLIENTS)]
+    for worker in workers:
+        worker.start()
+    time.sleep(DURATION)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / DURATION
+
+
+if __name__ == '__main__':
+    positions = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        WALLET_PATH = os.path.join(tmp, 'wallet.json')
+        PORTFOLIO_PATH = os.path.join(tmp, 'portfolio.json')
+        WATCHLIST_PATH = os.path.join(tmp, 'watchlist.json')
+        webserver.status_cache = webserver.StatusCache(JsonStorage(tmp))
+
+        portfolio, watchlist = make_rows(positions)
+        write_table(WALLET_PATH, [{'in': 1000, 'out': 0}])
+        write_table(PORTFOLIO_PATH, portfolio)
+        write_table(WATCHLIST_PATH, watchlist)
+
+        webserver.app.add_url_rule('/status_old', 'status_old', webserver.requires_auth(legacy_status))
+        server = make_server('127.0.0.1', 0, webserver.app, threaded=True)
+        Thread(target=server.serve_forever, daemon=True).start()
+        base = f'http://127.0.0.1:{server.server_port}'
+
+        # trader stand-in: portfolio changes once a second
+        stop_writer = Event()
+
+        def writer():
+            while not stop_writer.wait(1):
+                portfolio[random.randrange(len(portfolio))]['shares'] += 1
+                write_table(PORTFOLIO_PATH, portfolio)
+
+        Thread(target=writer, daemon=True).start()
+
+        print(f'positions: {positions}  clients: {CLIENTS}  {DURATION} s per run')
+        for name, path, conditional in [('old /status', '/status_old', False), ('cached /status', '/status', False), ('cached /status + ETag', '/status', True), ('cached /status.json + ETag', '/status.json', True)]:
+            renders = webserver.status_cache.renders
+            rate = load(base + path, conditional)
+            print(f'{name:<28} {rate:>8.0f} req/s  (renders: {webserver.status_cache.renders - renders})')
+
+        stop_writer.set()
+        server.shutdown()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import tempfile
+
+sys.path.append('../')
+
+from tinydb import TinyDB, Query
+from tinydb.operations import subtract
+from storage import JsonStorage, SqliteStorage, write_table
+
+# Per-operation latency against portfolio history of 1k, 10k and 100k rows:
+# TinyDB as used before (linear Query scans, whole-file rewrite per update)
+# vs the SQLite backend (indexed ticker, in-place `value = value + ?`).
+# Also times migrating the json files into SQLite.
+
+
+def timed(fn, n: int) -> float:
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def bench(rows: int, tmp: str) -> dict:
+    db_dir = os.path.join(tmp, str(rows))
+    os.mkdir(db_dir)
+    tickers = [f'T{i:06d}' for i in range(rows)]
+    write_table(os.path.join(db_dir, 'portfolio.json'), [{'shares': 0, 'ticker': t, 'stake': -1.5} for t in tickers])
+    write_table(os.path.join(db_dir, 'wallet.json'), [{'in': 100000, 'out': 0}])
+    write_table(os.path.join(db_dir, 'watchlist.json'), [])
+
+    # TinyDB rewrites the whole file per update; keep its runs short
+    slow = max(2, 20000 // rows)
+    results = {}
+
+    portfolio = TinyDB(os.path.join(db_dir, 'portfolio.json'))
+    wallet = TinyDB(os.path.join(db_dir, 'wallet.json'))
+    results['tinydb'] = {
+        'lookup': timed(lambda i: portfolio.search(Query().ticker == tickers[i * 7919 % rows]), slow),
+        'update': timed(lambda i: portfolio.update({'shares': i, 'stake': 2.0}, Query().ticker == tickers[i * 7919 % rows]), slow),
+        'balance -= x': timed(lambda i: wallet.update(subtract('in', 1)), 200),
+    }
+    portfolio.close()
+    wallet.close()
+
+    start = time.perf_counter()
+    sqlite = SqliteStorage(os.path.join(db_dir, 'plunder.db'))
+    sqlite.import_from(JsonStorage(db_dir))
+    migration = time.perf_counter() - start
+
+    results['sqlite'] = {
+        'lookup': timed(lambda i: sqlite.get_position(tickers[i * 7919 % rows]), 2000),
+        'update': timed(lambda i: sqlite.write([{'t': 'pos', 'ticker': tickers[i * 7919 % rows], 'shares': i, 'stake': 2.0}]), 500),
+        'balance -= x': timed(lambda i: sqlite.write([{'t': 'wallet', 'field': 'in', 'delta': -1}]), 500),
+    }
+    return results, migration
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f'{"rows":>7} {"op":>13} {"tinydb (us)":>12} {"sqlite (us)":>12} {"speedup":>8}')
+        for rows in [1000, 10000, 100000]:
+            results, migration = bench(rows, tmp)
+            for op in results['tinydb']:
+                old, new = results['tinydb'][op], results['sqlite'][op]
+                print(f'{rows:>7} {op:>13} {old:>12.1f} {new:>12.1f} {old / new:>7.0f}x')
+            print(f'{rows:>7} {"migration":>13} {migration * 1000:>21.0f} ms')
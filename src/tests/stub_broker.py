@@ -0,0 +1,242 @@
+import sys
+import json
+import time
+import types
+import random
+import re
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime
+
+import requests
+
+sys.path.append('../')
+
+# Local stand-in for the E*TRADE REST API used by benchmarks & tests.
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # hundreds of clients may connect at once
+    request_queue_size = 1024
+
+
+class StubBroker(object):
+    """
+    Serves quote and order requests on localhost with a configurable
+    per-request latency and injectable faults (see set_faults).
+    """
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = 0
+        # request path kind ('quote', 'orders', 'preview', 'place') -> requests received
+        self.calls = {}
+        self.set_faults()
+        self.__faults = random.Random(7)
+        self.__lock = Lock()
+        self.__ids = 0
+        # filled orders, oldest first
+        self.__orders = []
+        self.__prices = {}
+
+        broker = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections alive like the real broker does
+            protocol_version = 'HTTP/1.1'
+            # send headers & body in one go; split writes on a kept-alive
+            # connection stall on delayed ACKs
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                path = url.path
+                broker._count('orders' if path.endswith('/orders.json') else 'quote')
+                time.sleep(broker.latency)
+                if broker._fault(self):
+                    return
+
+                if path.endswith('/orders.json'):
+                    self._send_json(broker._orders_page(parse_qs(url.query)))
+                    return
+
+                match = re.match(r'^/v1/market/quote/(.+)\.json$', path)
+
+                if match is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                symbols = match.group(1).split(',')
+                body = {'QuoteResponse': {'QuoteData': [broker._quote(s) for s in symbols]}}
+                self._send_json(body)
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                payload = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                broker._count('place' if path.endswith('/place.json') else 'preview')
+                time.sleep(broker.latency)
+                if broker._fault(self):
+                    return
+
+                if path.endswith('/orders/preview.json'):
+                    body = {'PreviewOrderResponse': {'PreviewIds': [{'previewId': broker._next_id()}]}}
+                elif path.endswith('/orders/place.json'):
+                    symbol = re.search(r'<symbol>(.+?)</symbol>', payload).group(1)
+                    body = {'PlaceOrderResponse': {'OrderIds': [{'orderId': broker._next_id()}], 'Order': [{'Instrument': [{'Product': {'symbol': symbol}}]}]}}
+                else:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                self._send_json(body)
+
+            def _send_json(self, body: dict):
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.__server = _Server(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.__server.server_port}'
+
+    def _count(self, kind: str):
+        self.__lock.acquire()
+        self.requests += 1
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        self.__lock.release()
+
+    def set_faults(self, error_rate: float = 0.0, drop_rate: float = 0.0, stall_rate: float = 0.0, stall: float = 0.0):
+        """
+        Makes requests fail at random: error_rate of them get a 503, drop_rate
+        get the connection closed without a response and stall_rate hang for
+        stall seconds before being answered. No arguments clears all faults.
+        """
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+
+    def _fault(self, handler) -> bool:
+        """
+        Injects a fault into the request handler is serving. Returns True if it took care of the response.
+        """
+        self.__lock.acquire()
+        stall, roll = self.__faults.random(), self.__faults.random()
+        self.__lock.release()
+
+        if stall < self.stall_rate:
+            time.sleep(self.stall)
+
+        if roll < self.error_rate:
+            handler.send_response(503)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return True
+
+        if roll < self.error_rate + self.drop_rate:
+            handler.close_connection = True
+            return True
+
+        return False
+
+    def _next_id(self) -> int:
+        self.__lock.acquire()
+        self.__ids += 1
+        result = self.__ids
+        self.__lock.release()
+        return result
+
+    def add_fill(self, symbol: str, action: str, quantity: int, value: float, placed_at: float = None, order_id: int = None) -> int:
+        """
+        Records a filled order and returns its order id. Passing the id of an
+        order already recorded (or placed) sets its filled quantity and value instead.
+        """
+        order_id = self._next_id() if order_id is None else order_id
+        placed_at = time.time() if placed_at is None else placed_at
+        self.__lock.acquire()
+        for order in self.__orders:
+            if order['orderId'] == order_id:
+                order['OrderDetail'][0]['orderValue'] = value
+                order['OrderDetail'][0]['Instrument'][0]['filledQuantity'] = quantity
+                break
+        else:
+            self.__orders.append({
+                'orderId': order_id,
+                'OrderDetail': [{
+                    'placedTime': int(placed_at * 1000),
+                    'orderValue': value,
+                    'Instrument': [{'Product': {'symbol': symbol}, 'orderAction': action, 'filledQuantity': quantity}],
+                }],
+            })
+        self.__lock.release()
+        return order_id
+
+    def _orders_page(self, query: dict) -> dict:
+        orders = self.__orders[::-1]
+
+        if 'fromDate' in query:
+            since = datetime.strptime(query['fromDate'][0], '%m%d%Y').timestamp() * 1000
+            orders = [o for o in orders if o['OrderDetail'][0]['placedTime'] >= since]
+
+        count = int(query.get('count', ['25'])[0])
+        offset = int(query.get('marker', ['0'])[0])
+        page = {'Order': orders[offset:offset + count]}
+        if offset + count < len(orders):
+            page['marker'] = str(offset + count)
+        return {'OrdersResponse': page}
+
+    def _quote(self, symbol: str) -> dict:
+        if symbol not in self.__prices:
+            self.__prices[symbol] = round(random.uniform(0.0001, 0.002), 4)
+        return {'Product': {'symbol': symbol}, 'All': {'lastTrade': self.__prices[symbol]}}
+
+    def start(self):
+        Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+
+
+class StubSession(requests.Session):
+    """
+    Plain requests session that accepts (and ignores) rauth's header_auth kwarg.
+    """
+    def request(self, method, url, header_auth=False, **kwargs):
+        return super().request(method, url, **kwargs)
+
+
+def install_credentials(base_url: str = 'http://127.0.0.1'):
+    """
+    Makes sure a credentials module is importable and points it at base_url.
+    """
+    try:
+        import credentials
+    except ImportError:
+        credentials = types.ModuleType('credentials')
+        credentials.CONSUMER_KEY = 'stub'
+        credentials.ACCOUNT_ID_KEY = 'stub'
+        sys.modules['credentials'] = credentials
+
+    credentials.BASE_URL = base_url
+    return credentials
+
+
+def make_etrader(broker: StubBroker):
+    """
+    Returns an ETrader talking to the given stub broker.
+    """
+    install_credentials(broker.url)
+
+    from etrader import ETrader
+    return ETrader(session=StubSession())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+import sys
+import os
+import csv
+import json
+import time
+import random
+import tempfile
+
+import numpy as np
+
+sys.path.append('../')
+
+from logger import Logger
+from backtest_replay import START, message, random_walks
+
+# Grid-searches strategy constants over a synthetic month (60 symbols,
+# 600 messages) with the process pool sweep:
+#
+#   resume    a sweep killed after 6 of 16 runs (last row half written)
+#             must run only the other 10 and leave every run once in the file
+#   parity    rows must match a backtest of the same constants in-process
+#   scaling   runs/s with 1, 2, 4 ... workers up to the number of cores
+#
+# usage: ./sweep_bench.py [days]
+
+DAYS = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+VALUES = {
+    'DEFAULT_BALANCE_IN': [200000],
+    'SELL_THRESH_MULTIPLIER': [1.2, 1.3, 1.5, 2.0],
+    'BUY_LIMIT_PRICE_MULTIPLIER': [1.05, 1.1],
+    'MAX_TICKER_PRICE': [0.001, 0.002],
+}
+
+
+def rows(path: str) -> list:
+    with open(path, newline='') as fh:
+        return list(csv.DictReader(fh))
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        Logger.PATH = os.path.join(tmp, 'log.txt')
+        Logger.set_level('ERROR')
+        Logger.set_level(Logger.LEVEL_ERROR + 1, 'trader')
+
+        from backtest import Backtest, PriceHistory, load_messages
+        from sweep import Sweep, grid, run_key
+
+        rng = np.random.default_rng(11)
+        random.seed(11)
+        symbols = [''.join(random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(4)) for _ in range(60)]
+        history_dir = os.path.join(tmp, 'prices')
+        PriceHistory.from_series(random_walks(symbols, DAYS, rng)).save(history_dir)
+
+        messages_path = os.path.join(tmp, 'messages.jsonl')
+        words = ['gap up', 'watch', 'loading', 'runner', 'chart', 'nice', 'new high', 'hod', 'boom']
+        with open(messages_path, 'w') as fh:
+            for when in sorted(rng.uniform(START, START + DAYS * 86400, DAYS * 20)):
+                tickers = ' '.join(random.sample(symbols, random.randint(1, 3)))
+                fh.write(json.dumps(message(when, f'{random.choice(words)} {tickers} {random.choice(words)}')[1]) + '\n')
+
+        combinations = grid(VALUES)
+        history = PriceHistory.open(history_dir)
+        print(f'{len(combinations)} combinations, {len(history.prices)} ticks mapped from {history_dir}')
+
+        # resume
+        results = os.path.join(tmp, 'resume.csv')
+        first = Sweep(history_dir, messages_path, results, workers=2).run(combinations[:6])
+        with open(results, 'a') as fh:
+            fh.write('1.1,200000,0.002,1.5,12,0,')
+        second = Sweep(history_dir, messages_path, results, workers=2).run(combinations)
+        keys = [row['key'] for row in rows(results)]
+        print(f'resume:  first sweep ran {first}, resumed sweep ran {second}; {len(keys)} rows, {len(set(keys))} distinct')
+        assert first == 6 and second == 10 and sorted(keys) == sorted(run_key(params) for params in combinations)
+
+        # parity
+        params = combinations[5]
+        with tempfile.TemporaryDirectory() as workdir:
+            summary = Backtest(history, load_messages(messages_path), params).run(workdir)
+        row = next(row for row in rows(results) if row['key'] == run_key(params))
+        print(f'parity:  {params} equity {float(row["equity"]):.2f} in the sweep, {summary["equity"]:.2f} in-process')
+        assert abs(float(row['equity']) - summary['equity']) < 1e-6 and int(row['orders']) == summary['orders']
+
+        # scaling
+        print(f'\n{"workers":>7} {"runs":>5} {"wall s":>7} {"runs/s":>7} {"speedup":>8}')
+        workers = 1
+        base = None
+        while workers <= os.cpu_count():
+            results = os.path.join(tmp, f'scaling-{workers}.csv')
+            start = time.perf_counter()
+            ran = Sweep(history_dir, messages_path, results, workers=workers).run(combinations)
+            wall = time.perf_counter() - start
+            base = wall if base is None else base
+            print(f'{workers:>7} {ran:>5} {wall:>7.2f} {ran / wall:>7.2f} {base / wall:>7.2f}x')
+            workers *= 2
+        print(f'({os.cpu_count()} cores)')
+
+        best = max(rows(os.path.join(tmp, 'scaling-1.csv')), key=lambda row: float(row['equity']))
+        print(f'\nbest equity {float(best["equity"]):.2f} with {best["key"]}')
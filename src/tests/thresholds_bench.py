@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import random
+import tempfile
+
+sys.path.append('../')
+
+from thresholds import ThresholdIndex, Rule
+from storage import JsonStorage
+
+# Evaluates 10k watchlist rules across 500 tickers per price tick: the old
+# linear scan over subscription rows against the per-ticker threshold index.
+
+RULES = 10000
+TICKERS = 500
+TICKS = 200
+
+random.seed(11)
+tickers = [f'T{i:03d}' for i in range(TICKERS)]
+base = {ticker: random.uniform(0.0005, 0.002) for ticker in tickers}
+
+with tempfile.TemporaryDirectory() as tmp:
+    index = ThresholdIndex(JsonStorage(tmp))
+    rows = []
+    for i in range(RULES):
+        ticker = random.choice(tickers)
+        kind = random.choice([Rule.TAKE_PROFIT, Rule.STOP_LOSS, Rule.TRAILING])
+        if kind == Rule.TAKE_PROFIT:
+            rule = index.add(ticker, kind, base[ticker] * random.uniform(1.2, 2.0))
+        elif kind == Rule.STOP_LOSS:
+            rule = index.add(ticker, kind, base[ticker] * random.uniform(0.5, 0.9))
+        else:
+            rule = index.add(ticker, kind, base[ticker], random.uniform(0.1, 0.3))
+        rows.append(rule.as_dict())
+
+    old_time = new_time = 0.0
+    old_fired = new_fired = 0
+    for tick in range(TICKS):
+        prices = {ticker: base[ticker] * random.uniform(0.95, 1.05) for ticker in tickers}
+
+        # old: walk every row, compare by operator string (trailing rows as fixed stops)
+        start = time.perf_counter()
+        for row in rows:
+            price = prices[row['ticker']]
+            if row['op'] == '>' and price > row['threshold']:
+                old_fired += 1
+            elif row['op'] == '<' and price < row['threshold']:
+                old_fired += 1
+        old_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for ticker, fired in index.evaluate_many(prices).items():
+            new_fired += len(fired)
+        new_time += time.perf_counter() - start
+
+    print(f'{RULES} rules, {TICKERS} tickers, {TICKS} ticks')
+    print(f'linear scan:     {old_time / TICKS * 1000:.2f} ms/tick ({old_fired // TICKS} fired/tick)')
+    print(f'threshold index: {new_time / TICKS * 1000:.2f} ms/tick ({new_fired // TICKS} fired/tick)')
+
+    start = time.perf_counter()
+    for ticker in tickers:
+        index.remove_ticker(ticker)
+    print(f'unsubscribe_all: {(time.perf_counter() - start) / TICKERS * 1e6:.2f} us/ticker')
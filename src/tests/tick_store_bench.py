@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import tempfile
+
+import numpy as np
+
+sys.path.append('../')
+
+from logger import Logger
+
+# Records quotes to the tick store and reads them back:
+#
+#   hot path   cost of record() / record_many() on the quoting thread
+#   write      ticks/s the writer appends (20 bytes a tick)
+#   read       3 days of ticks for 500 symbols: every symbol's series of a
+#              compacted day is a slice of the mapping, the open day is
+#              searched; both must match what was recorded
+#   late       a tick for a compacted day reopens it and is sorted in
+#   crash      a half-written record and an interrupted compaction are
+#              repaired when the recorder starts again
+#   watchdog   quotes fetched through the watchdog are recorded once,
+#              cache hits are not, and backtest history loads from the store
+#
+# usage: ./tick_store_bench.py [ticks per symbol per day]
+
+START = 1700006400.0
+
+
+def write(recorder, series: dict) -> None:
+    # interleaved in time like the watchdog's batch quotes
+    steps = max(len(timestamps) for timestamps, _ in series.values())
+    for i in range(steps):
+        for symbol, (timestamps, prices) in series.items():
+            if i < len(timestamps):
+                recorder.record(symbol, prices[i], timestamps[i])
+
+
+if __name__ == '__main__':
+    PER_DAY = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    with tempfile.TemporaryDirectory() as tmp:
+        Logger.PATH = os.path.join(tmp, 'log.txt')
+        Logger.set_level('ERROR')
+
+        import constants as ct
+        from tick_store import TickRecorder, TickStore, COLUMNS, day_of
+
+        # hot path
+        recorder = TickRecorder(os.path.join(tmp, 'hot'), max_buffered=10 ** 7)
+        n = 500000
+        start = time.perf_counter()
+        for i in range(n):
+            recorder.record('ABCD', 0.001, START + i)
+        single = (time.perf_counter() - start) / n
+        batch = {f'S{i:03d}': 0.001 for i in range(50)}
+        start = time.perf_counter()
+        for i in range(n // 50):
+            recorder.record_many(batch, START + i)
+        many = (time.perf_counter() - start) / n
+        print(f'hot path: record() {single * 1e6:.2f} us/tick, record_many() of 50 {many * 1e6:.2f} us/tick')
+
+        # write
+        start = time.perf_counter()
+        recorder.flush()
+        elapsed = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(tmp, 'hot', day_of(START), name)) for name, _ in COLUMNS)
+        print(f'write:    {recorder.written} ticks in {elapsed:.2f} s ({recorder.written / elapsed / 1e6:.2f} M ticks/s), {size / recorder.written:.0f} bytes/tick')
+        assert recorder.written == 2 * n and size == 20 * recorder.written
+
+        # read
+        directory = os.path.join(tmp, 'ticks')
+        rng = np.random.default_rng(5)
+        symbols = [f'S{i:03d}' for i in range(500)]
+        recorded = {symbol: ([], []) for symbol in symbols}
+        recorder = TickRecorder(directory, flush_period=0.05)
+        recorder.start()
+        for day in range(3):
+            series = {}
+            for symbol in symbols:
+                timestamps = np.sort(START + day * 86400 + rng.uniform(0, 86000, PER_DAY))
+                prices = np.round(rng.uniform(0.0001, 0.01, PER_DAY), 6)
+                series[symbol] = (timestamps, prices)
+                recorded[symbol][0].append(timestamps)
+                recorded[symbol][1].append(prices)
+            write(recorder, series)
+        recorder.stop()
+
+        store = TickStore(directory)
+        days = store.days()
+        compacted = [os.path.exists(os.path.join(directory, day, 'index.npy')) for day in days]
+        print(f'\nread:     {recorder.written} ticks over days {days}, compacted {compacted}')
+        assert len(days) == 3 and compacted == [True, True, False] and recorder.dropped == 0
+
+        for day, label in [(days[0], 'compacted'), (days[2], 'open')]:
+            mapping = store.day(day)[0]
+            start = time.perf_counter()
+            parts = [store.day_series(day, symbol) for symbol in symbols]
+            elapsed = time.perf_counter() - start
+            shared = all(np.shares_memory(timestamps, mapping) for timestamps, _ in parts)
+            print(f'          {label:>9} day: {len(symbols)} series in {elapsed * 1e3:.1f} ms ({elapsed / len(symbols) * 1e6:.0f} us each), views of the mapping: {shared}')
+            assert shared == (label == 'compacted')
+
+        for symbol in symbols:
+            timestamps, prices = store.series(symbol)
+            assert np.array_equal(timestamps, np.concatenate(recorded[symbol][0]))
+            assert np.array_equal(prices, np.concatenate(recorded[symbol][1]))
+        print('          series of every symbol over 3 days match what was recorded')
+
+        # late
+        recorder = TickRecorder(directory)
+        recorder.record('S007', 0.5, START + 10)
+        recorder.record('S007', 0.6, START + 2 * 86400 + 10)
+        recorder.flush()
+        timestamps, prices = store.day_series(days[0], 'S007')
+        print(f'\nlate:     S007 on {days[0]} has {len(timestamps)} ticks after a late one, sorted: {bool(np.all(np.diff(timestamps) >= 0))}, '
+              f'compacted again: {os.path.exists(os.path.join(directory, days[0], "index.npy"))}')
+        assert len(timestamps) == PER_DAY + 1 and np.all(np.diff(timestamps) >= 0) and prices[np.searchsorted(timestamps, START + 10)] == 0.5
+
+        # crash
+        with open(os.path.join(directory, days[2], 'px'), 'ab') as fh:
+            fh.write(b'\x00\x01\x02')
+        with open(os.path.join(directory, days[2], 'ts'), 'ab') as fh:
+            fh.write(np.array([START + 2 * 86400 + 5], dtype=np.float64).tobytes())
+        os.rename(os.path.join(directory, days[1]), os.path.join(directory, days[1] + '.old'))
+        os.makedirs(os.path.join(directory, days[0] + '.tmp'))
+        before = len(store.day(days[2])[0])
+        recorder = TickRecorder(directory)
+        sizes = {name: os.path.getsize(os.path.join(directory, days[2], name)) // np.dtype(dtype).itemsize for name, dtype in COLUMNS}
+        print(f'crash:    open day has {sizes} records after repair ({before} readable before), days {store.days()}, '
+              f'leftovers {sorted(name for name in os.listdir(directory) if "." in name and name != "dictionary.txt")}')
+        assert set(sizes.values()) == {before} and store.days() == days
+        assert np.array_equal(store.series('S001')[1], np.concatenate(recorded['S001'][1]))
+
+        # watchdog
+        os.chdir(tmp)
+        os.makedirs('db', exist_ok=True)
+        ct.STORAGE_BACKEND = 'json'
+        from watchdog import Watchdog
+        from backtest import PriceHistory
+
+        quotes = {'AAAA': 0.001, 'BBBB': 0.002, 'CCCC': None}
+        calls = []
+
+        def get_ticker_prices(tickers):
+            calls.append(tickers)
+            return {ticker: quotes[ticker] for ticker in tickers}
+
+        recorder = TickRecorder(os.path.join(tmp, 'watched'))
+        watchdog = Watchdog(None, None, None, lambda ticker: quotes[ticker], get_ticker_prices, recorder)
+        watchdog.get_prices(['AAAA', 'BBBB', 'CCCC'])
+        watchdog.get_prices(['AAAA', 'BBBB'])
+        watchdog.get_price('AAAA')
+        recorder.flush()
+        watchdog.rules.stop()
+        history = PriceHistory.load_ticks(os.path.join(tmp, 'watched'))
+        print(f'\nwatchdog: {len(calls)} broker call, {recorder.written} ticks recorded, history of {history.symbols} '
+              f'with {len(history.prices)} ticks, AAAA at {history.price_at("AAAA", time.time() + 1)}')
+        assert len(calls) == 1 and recorder.written == 2 and history.symbols == ['AAAA', 'BBBB']
+        assert history.price_at('AAAA', time.time() + 1) == 0.001
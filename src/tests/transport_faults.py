@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import tempfile
+
+sys.path.append('../')
+
+from logger import Logger
+from stub_broker import StubBroker, StubSession, make_etrader
+from transport import Transport, CircuitBreaker
+
+# Runs broker calls through the transport while the stub broker misbehaves:
+#
+#   flaky     30% 503s and 10% dropped connections; retries should hide them
+#   stalled   requests hang far past the read timeout; calls must come back
+#   outage    every call fails; the breaker should open, short-circuit calls,
+#             and close again once the broker recovers
+#   place     a dropped order placement must not be sent a second time
+#
+# and prints the per-endpoint latency histograms.
+
+REQUESTS = 200
+
+
+def quote(transport: Transport, broker: StubBroker, symbol: str):
+    return transport.get('quote', f'{broker.url}/v1/market/quote/{symbol}.json')
+
+
+def success_rate(transport: Transport, broker: StubBroker) -> float:
+    ok = 0
+    for i in range(REQUESTS):
+        response = quote(transport, broker, f'S{i % 20}')
+        ok += response is not None and response.status_code == 200
+    return ok / REQUESTS
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        Logger.PATH = os.path.join(tmp, 'log.txt')
+        Logger.set_level('ERROR')
+
+        import constants as ct
+        ct.HTTP_BACKOFF_BASE = 0.01
+        ct.HTTP_BACKOFF_MAX = 0.05
+        timeouts = dict(ct.HTTP_TIMEOUTS, quote=(0.5, 0.3))
+
+        broker = StubBroker().start()
+
+        # flaky broker; a breaker that can't trip keeps this about retries
+        broker.set_faults(error_rate=0.3, drop_rate=0.1)
+        without = success_rate(Transport(StubSession(), retries=0, breaker=CircuitBreaker(10 ** 6, 0)), broker)
+        before = broker.requests
+        with_retries = success_rate(Transport(StubSession(), timeouts=timeouts, breaker=CircuitBreaker(10 ** 6, 0)), broker)
+        print(f'flaky:   {without:.0%} succeed without retries, {with_retries:.0%} with {ct.HTTP_RETRIES} retries '
+              f'({(broker.requests - before) / REQUESTS:.2f} attempts per call)')
+        assert with_retries > 0.9
+
+        # stalled broker
+        broker.set_faults(stall_rate=1.0, stall=5)
+        transport = Transport(StubSession(), timeouts=timeouts, retries=1, breaker=CircuitBreaker(10 ** 6, 0))
+        start = time.perf_counter()
+        response = quote(transport, broker, 'ABC')
+        elapsed = time.perf_counter() - start
+        print(f'stalled: call gave up after {elapsed:.2f} s (broker stalls 5 s, read timeout {timeouts["quote"][1]} s x 2 attempts)')
+        assert response is None and elapsed < 2
+
+        # outage & recovery
+        broker.set_faults(error_rate=1.0)
+        breaker = CircuitBreaker(ct.BREAKER_FAILURES, 0.5)
+        transport = Transport(StubSession(), timeouts=timeouts, breaker=breaker)
+        before = broker.requests
+        for _ in range(20):
+            quote(transport, broker, 'ABC')
+        reached = broker.requests - before
+        start = time.perf_counter()
+        quote(transport, broker, 'ABC')
+        short_circuit = time.perf_counter() - start
+        print(f'outage:  breaker {breaker.state} after {reached} of {20 * (ct.HTTP_RETRIES + 1)} possible attempts; '
+              f'short-circuited call took {short_circuit * 1e6:.0f} us')
+        assert breaker.state == CircuitBreaker.OPEN and reached == ct.BREAKER_FAILURES
+
+        broker.set_faults()
+        time.sleep(0.6)
+        response = quote(transport, broker, 'ABC')
+        print(f'         broker back: trial call {response.status_code}, breaker {breaker.state}')
+        assert response.status_code == 200 and breaker.state == CircuitBreaker.CLOSED
+
+        # a dropped preview is retried; a dropped placement is sent once
+        etrader = make_etrader(broker)
+        broker.set_faults(drop_rate=1.0)
+        before = broker.calls.get('preview', 0)
+        valid, _ = etrader.place_order(price_type='LIMIT', order_term='GOOD_FOR_DAY', limit_price=0.001, symbol='ABC', order_action='BUY', quantity=10)
+        previews = broker.calls.get('preview', 0) - before
+        broker.set_faults()
+        before_place = broker.calls.get('place', 0)
+
+        # let the preview through, drop the placement
+        class DropPlace(StubSession):
+            def request(self, method, url, header_auth=False, **kwargs):
+                if url.endswith('/place.json'):
+                    broker.set_faults(drop_rate=1.0)
+                try:
+                    return super().request(method, url, header_auth, **kwargs)
+                finally:
+                    broker.set_faults()
+
+        from etrader import ETrader
+        dropping = ETrader(session=DropPlace())
+        valid_place, _ = dropping.place_order(price_type='LIMIT', order_term='GOOD_FOR_DAY', limit_price=0.001, symbol='ABC', order_action='BUY', quantity=10)
+        places = broker.calls.get('place', 0) - before_place
+        print(f'place:   dropped preview retried {previews}x in total; dropped placement sent {places}x, reported {"placed" if valid_place else "failed"}')
+        assert not valid and previews == ct.HTTP_RETRIES + 1
+        assert not valid_place and places == 1
+
+        # histograms of a clean run
+        broker.set_faults()
+        broker.latency = 0.002
+        etrader = make_etrader(broker)
+        for i in range(REQUESTS):
+            etrader.get_ticker_price(f'S{i % 20}')
+        etrader.sync_filled_orders()
+        etrader.place_order(price_type='LIMIT', order_term='GOOD_FOR_DAY', limit_price=0.001, symbol='ABC', order_action='BUY', quantity=10)
+
+        stats = etrader.transport.stats()
+        print(f'\nbreaker {stats["breaker"]}')
+        print(f'{"endpoint":>8} {"count":>6} {"mean ms":>8} {"p50 ms":>7} {"p95 ms":>7} {"p99 ms":>7} {"max ms":>7} {"retries":>8}')
+        for endpoint, s in stats['endpoints'].items():
+            print(f'{endpoint:>8} {s["count"]:>6} {s["mean"] * 1000:>8.2f} {s["p50"] * 1000:>7.1f} {s["p95"] * 1000:>7.1f} {s["p99"] * 1000:>7.1f} {s["max"] * 1000:>7.1f} {s["retries"]:>8}')
+
+        broker.stop()
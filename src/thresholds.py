@@ -0,0 +1,359 @@
+import time
+import traceback
+import uuid
+from bisect import bisect_left, bisect_right, insort
+from threading import Thread, Lock, Event
+
+import constants as ct
+import storage
+from logger import Logger
+
+log = Logger.get('thresholds')
+
+
+class Rule(object):
+    """
+    One watchlist subscription. Take-profit rules fire above their threshold,
+    stop-loss and trailing rules below it; a trailing rule's threshold follows
+    the highest price seen since it was created. Expiry rules fire once the
+    clock passes their threshold (unix time), whatever the price.
+    """
+    __slots__ = ('uuid', 'ticker', 'kind', 'threshold', 'trail', 'peak')
+
+    TAKE_PROFIT = storage.TAKE_PROFIT
+    STOP_LOSS = storage.STOP_LOSS
+    TRAILING = storage.TRAILING
+    EXPIRY = storage.EXPIRY
+    EDITABLE = storage.EDITABLE_KINDS
+
+    def __init__(self, identifier: str, ticker: str, kind: str, threshold: float, trail: float = None, peak: float = None):
+        self.uuid = identifier
+        self.ticker = ticker
+        self.kind = kind
+        self.threshold = threshold
+        self.trail = trail
+        self.peak = peak
+
+    @property
+    def op(self) -> str:
+        return '>' if self.kind == Rule.TAKE_PROFIT else '<'
+
+    def as_dict(self) -> dict:
+        row = {'uuid': self.uuid, 'ticker': self.ticker, 'threshold': self.threshold, 'op': self.op, 'kind': self.kind}
+        if self.kind == Rule.TRAILING:
+            row['trail'] = self.trail
+            row['peak'] = self.peak
+        return row
+
+    @staticmethod
+    def from_dict(row: dict) -> 'Rule':
+        return Rule(row['uuid'], row['ticker'], storage.rule_kind(row), row['threshold'], row.get('trail'), row.get('peak'))
+
+
+class TickerRules(object):
+    """
+    Rules of a single ticker kept sorted by threshold, so the rules fired by a
+    price are a prefix ('>') and a suffix ('<') found by bisection.
+    """
+    __slots__ = ('above_keys', 'above', 'below_keys', 'below', 'trailing', 'lowest_peak', 'timed', 'earliest_deadline')
+
+    def __init__(self):
+        # (threshold, uuid) keys and rules of take-profit rules
+        self.above_keys = []
+        self.above = {}
+        # same for stop-loss & trailing rules
+        self.below_keys = []
+        self.below = {}
+        # uuid -> trailing rule
+        self.trailing = {}
+        # prices at or below this can't raise any trailing threshold
+        self.lowest_peak = float('inf')
+        # uuid -> expiry rule
+        self.timed = {}
+        # nothing expires before this
+        self.earliest_deadline = float('inf')
+
+    def __len__(self):
+        return len(self.above) + len(self.below) + len(self.timed)
+
+    def add(self, rule: Rule) -> None:
+        if rule.kind == Rule.EXPIRY:
+            self.timed[rule.uuid] = rule
+            self.earliest_deadline = min(self.earliest_deadline, rule.threshold)
+        elif rule.kind == Rule.TAKE_PROFIT:
+            insort(self.above_keys, (rule.threshold, rule.uuid))
+            self.above[rule.uuid] = rule
+        else:
+            insort(self.below_keys, (rule.threshold, rule.uuid))
+            self.below[rule.uuid] = rule
+            if rule.kind == Rule.TRAILING:
+                self.trailing[rule.uuid] = rule
+                self.lowest_peak = min(self.lowest_peak, rule.peak)
+
+    def remove(self, rule: Rule) -> None:
+        if rule.kind == Rule.EXPIRY:
+            del self.timed[rule.uuid]
+            self.earliest_deadline = min((timed.threshold for timed in self.timed.values()), default=float('inf'))
+            return
+        keys, rules = (self.above_keys, self.above) if rule.kind == Rule.TAKE_PROFIT else (self.below_keys, self.below)
+        del keys[bisect_left(keys, (rule.threshold, rule.uuid))]
+        del rules[rule.uuid]
+        self.trailing.pop(rule.uuid, None)
+
+    def rules(self) -> list:
+        return list(self.above.values()) + list(self.below.values()) + list(self.timed.values())
+
+    def get(self, identifier: str) -> Rule:
+        return self.above.get(identifier) or self.below.get(identifier) or self.timed.get(identifier)
+
+    def fired(self, price: float, now: float = None) -> list:
+        """
+        Returns rules fired by price, and by time now if given: O(log n + k).
+        """
+        expired = now is not None and now >= self.earliest_deadline
+        # common case: price sits between the lowest take-profit and highest stop
+        if not expired and (len(self.above_keys) == 0 or self.above_keys[0][0] >= price) and (len(self.below_keys) == 0 or self.below_keys[-1][0] <= price):
+            return []
+
+        fired = []
+        # take-profit rules with threshold < price
+        for threshold, identifier in self.above_keys[:bisect_left(self.above_keys, (price, ''))]:
+            fired.append(self.above[identifier])
+        # stop-loss/trailing rules with threshold > price
+        for threshold, identifier in self.below_keys[bisect_right(self.below_keys, (price, '\uffff')):]:
+            fired.append(self.below[identifier])
+        if expired:
+            fired.extend(rule for rule in self.timed.values() if rule.threshold <= now)
+        return fired
+
+    def raise_peaks(self, price: float) -> bool:
+        """
+        Moves trailing thresholds up after a new high. Returns True if any moved.
+        """
+        if price <= self.lowest_peak:
+            return False
+
+        for rule in self.trailing.values():
+            if price > rule.peak:
+                self.remove_key(rule)
+                rule.peak = price
+                rule.threshold = price * (1 - rule.trail)
+                insort(self.below_keys, (rule.threshold, rule.uuid))
+        self.lowest_peak = min((rule.peak for rule in self.trailing.values()), default=float('inf'))
+        return True
+
+    def remove_key(self, rule: Rule) -> None:
+        del self.below_keys[bisect_left(self.below_keys, (rule.threshold, rule.uuid))]
+
+    def distance(self, price: float) -> float:
+        """
+        Relative distance from price to the closest threshold.
+        """
+        distance = 1.0
+        # closest take-profit threshold at or above price
+        i = bisect_left(self.above_keys, (price, ''))
+        if i < len(self.above_keys):
+            distance = min(distance, (self.above_keys[i][0] - price) / price)
+        # closest stop threshold at or below price
+        i = bisect_right(self.below_keys, (price, '\uffff'))
+        if i > 0:
+            distance = min(distance, (price - self.below_keys[i - 1][0]) / price)
+        return distance
+
+
+class ThresholdIndex(object):
+    """
+    In-memory index of watchlist rules per ticker. Changes are written to
+    storage in the background.
+    """
+    def __init__(self, storage: 'JsonStorage | SqliteStorage'):
+        self.__storage = storage
+        self.__lock = Lock()
+        # ticker -> TickerRules
+        self.__tickers = {}
+        self.__dirty = False
+        self.__stopped = Event()
+        self.__writer = None
+
+        for row in storage.load_watchlist():
+            self.__add(Rule.from_dict(row))
+        self.__persist()
+
+    def __contains__(self, ticker: str) -> bool:
+        return ticker in self.__tickers
+
+    def tickers(self) -> list:
+        return list(self.__tickers.keys())
+
+    def __add(self, rule: Rule) -> None:
+        # caller holds self.__lock
+        rules = self.__tickers.get(rule.ticker)
+        if rules is None:
+            rules = self.__tickers[rule.ticker] = TickerRules()
+        rules.add(rule)
+
+    def add(self, ticker: str, kind: str, threshold: float, trail: float = None) -> Rule:
+        """
+        Adds rule for ticker. For trailing rules threshold is the current price,
+        for expiry rules the unix time to sell at.
+        """
+        peak = None
+        if kind == Rule.TRAILING:
+            peak = threshold
+            threshold = peak * (1 - trail)
+
+        rule = Rule(str(uuid.uuid1()), ticker, kind, threshold, trail, peak)
+        self.__lock.acquire()
+        self.__add(rule)
+        self.__dirty = True
+        self.__lock.release()
+        return rule
+
+    def remove_ticker(self, ticker: str) -> None:
+        """
+        Drops every rule of ticker.
+        """
+        self.__lock.acquire()
+        if self.__tickers.pop(ticker, None) is not None:
+            self.__dirty = True
+        self.__lock.release()
+
+    def remove_tickers(self, tickers: list) -> None:
+        """
+        Drops every rule of many tickers under one lock; they are written out together.
+        """
+        self.__lock.acquire()
+        for ticker in tickers:
+            if self.__tickers.pop(ticker, None) is not None:
+                self.__dirty = True
+        self.__lock.release()
+
+    def set_threshold(self, ticker: str, identifier: str, threshold: float) -> bool:
+        """
+        Moves one take-profit or stop-loss rule of ticker. Trailing and expiry
+        rules can't be moved. Returns True if the rule was moved.
+        """
+        self.__lock.acquire()
+        rules = self.__tickers.get(ticker)
+        rule = None if rules is None else rules.get(identifier)
+        moved = rule is not None and rule.kind in Rule.EDITABLE
+        if moved:
+            rules.remove(rule)
+            rule.threshold = threshold
+            rules.add(rule)
+            self.__dirty = True
+        self.__lock.release()
+        return moved
+
+    def rules(self, ticker: str) -> list:
+        self.__lock.acquire()
+        rules = self.__tickers.get(ticker)
+        result = [] if rules is None else rules.rules()
+        self.__lock.release()
+        return result
+
+    def evaluate(self, ticker: str, price: float, now: float = None) -> list:
+        """
+        Feeds price to ticker's rules and returns the ones it fires (expiry
+        rules only if now is given).
+        """
+        self.__lock.acquire()
+        rules = self.__tickers.get(ticker)
+        if rules is None:
+            self.__lock.release()
+            return []
+        if rules.raise_peaks(price):
+            self.__dirty = True
+        fired = rules.fired(price, now)
+        self.__lock.release()
+        return fired
+
+    def evaluate_many(self, prices: dict, now: float = None) -> dict:
+        """
+        Feeds a price snapshot taken at unix time now to the rules of its
+        tickers. Each rule's state (peak of a trailing rule) moves with the
+        price it is fed; nothing is rescanned.
+
+        :returns: dict of ticker -> fired rules (tickers without fired rules are left out)
+        """
+        result = {}
+        self.__lock.acquire()
+        for ticker, price in prices.items():
+            rules = self.__tickers.get(ticker)
+            if rules is None or price is None or price <= 0:
+                continue
+            if rules.raise_peaks(price):
+                self.__dirty = True
+            fired = rules.fired(price, now)
+            if len(fired) > 0:
+                result[ticker] = fired
+        self.__lock.release()
+        return result
+
+    def bounds(self, ticker: str) -> (float, float):
+        """
+        Returns (low, high): prices from low to high neither fire nor move any rule of ticker.
+        """
+        self.__lock.acquire()
+        rules = self.__tickers.get(ticker)
+        low, high = 0.0, float('inf')
+        if rules is not None:
+            if len(rules.above_keys) > 0:
+                high = rules.above_keys[0][0]
+            if len(rules.below_keys) > 0:
+                low = rules.below_keys[-1][0]
+            high = min(high, rules.lowest_peak)
+        self.__lock.release()
+        return low, high
+
+    def deadline(self, ticker: str) -> float:
+        """
+        Returns unix time the earliest expiry rule of ticker fires at (inf if none).
+        """
+        self.__lock.acquire()
+        rules = self.__tickers.get(ticker)
+        result = float('inf') if rules is None else rules.earliest_deadline
+        self.__lock.release()
+        return result
+
+    def distance(self, ticker: str, price: float) -> float:
+        self.__lock.acquire()
+        rules = self.__tickers.get(ticker)
+        result = 1.0 if rules is None else rules.distance(price)
+        self.__lock.release()
+        return result
+
+    def start(self) -> None:
+        """
+        Starts background writer.
+        """
+        self.__writer = Thread(target=self.__run, name='watchlist-writer')
+        self.__writer.daemon = True
+        self.__writer.start()
+
+    def stop(self) -> None:
+        """
+        Stops background writer after writing out pending changes.
+        """
+        self.__stopped.set()
+        if self.__writer is not None:
+            self.__writer.join()
+        if self.__dirty:
+            self.__persist()
+
+    def __run(self):
+        while not self.__stopped.wait(ct.PORTFOLIO_FLUSH_PERIOD):
+            try:
+                if self.__dirty:
+                    self.__persist()
+            except Exception as ex:
+                log.error('Exception %s while persisting watchlist', ex)
+                log.error(traceback.format_exc())
+
+    def __persist(self) -> None:
+        self.__lock.acquire()
+        rows = [rule.as_dict() for rules in self.__tickers.values() for rule in rules.rules()]
+        self.__dirty = False
+        self.__lock.release()
+
+        self.__storage.write_watchlist(rows)
@@ -0,0 +1,356 @@
+import os
+import shutil
+import time
+import traceback
+from threading import Thread, Lock, Event
+
+import numpy as np
+
+import clock
+import constants as ct
+from logger import Logger
+
+log = Logger.get('ticks')
+
+# one file per column per day; record i of a day is row i of every column
+COLUMNS = (('ts', np.float64), ('sym', np.uint32), ('px', np.float64))
+# symbol id -> symbol, one per line; ids are line numbers and never change
+DICTIONARY = 'dictionary.txt'
+# offsets of each symbol id's rows in a compacted (symbol, time) sorted day
+INDEX = 'index.npy'
+
+
+def day_of(when: float) -> str:
+    """
+    Returns the (UTC) day directory name a tick at when goes into.
+    """
+    return time.strftime('%Y%m%d', time.gmtime(when))
+
+
+def _map(path: str, dtype, count: int) -> np.ndarray:
+    """
+    Returns the first count values of a column file mapped read-only.
+    """
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    # a plain ndarray view; memmap's subclass hooks cost more than the slices they run on
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count,)).view(np.ndarray)
+
+
+def _rows(day_dir: str) -> int:
+    """
+    Returns records every column of day_dir holds in full.
+    """
+    counts = []
+    for name, dtype in COLUMNS:
+        path = os.path.join(day_dir, name)
+        counts.append(os.path.getsize(path) // np.dtype(dtype).itemsize if os.path.exists(path) else 0)
+    return min(counts)
+
+
+class TickStore(object):
+    """
+    Read side of the quotes the watchdog observed: fixed-width column files
+    per day, mapped into memory instead of read. Days the recorder has
+    compacted are sorted by symbol, so a symbol's ticks of such a day are
+    a slice of the mapping; the day being written is searched instead.
+    """
+    def __init__(self, directory: str):
+        self.__directory = directory
+        # (dictionary size, symbols, symbol -> id)
+        self.__dictionary = (0, [], {})
+        # day -> (rows, index mtime, columns, offsets); remapped when either changes
+        self.__days = {}
+
+    def symbols(self) -> list:
+        """
+        Returns symbols by id.
+        """
+        return self.__load_dictionary()[1]
+
+    def __load_dictionary(self) -> tuple:
+        path = os.path.join(self.__directory, DICTIONARY)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size != self.__dictionary[0]:
+            with open(path) as fh:
+                symbols = fh.read().split()
+            self.__dictionary = (size, symbols, {symbol: i for i, symbol in enumerate(symbols)})
+        return self.__dictionary
+
+    def days(self) -> list:
+        """
+        Returns days (YYYYMMDD) with ticks, oldest first.
+        """
+        if not os.path.exists(self.__directory):
+            return []
+        return sorted(name for name in os.listdir(self.__directory) if len(name) == 8 and name.isdigit())
+
+    def day(self, day: str) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Returns timestamps, symbol ids & prices of a day, mapped read-only.
+        """
+        return self.__map_day(day)[2]
+
+    def __map_day(self, day: str) -> tuple:
+        day_dir = os.path.join(self.__directory, day)
+        count = _rows(day_dir)
+        index_path = os.path.join(day_dir, INDEX)
+        indexed = os.stat(index_path).st_mtime_ns if os.path.exists(index_path) else None
+
+        mapped = self.__days.get(day)
+        if mapped is None or mapped[:2] != (count, indexed):
+            columns = tuple(_map(os.path.join(day_dir, name), dtype, count) for name, dtype in COLUMNS)
+            offsets = np.load(index_path) if indexed is not None else None
+            mapped = (count, indexed, columns, offsets)
+            self.__days[day] = mapped
+        return mapped
+
+    def day_series(self, day: str, symbol: str) -> (np.ndarray, np.ndarray):
+        """
+        Returns (timestamps, prices) of symbol on day in time order; views
+        of the mapping if the day is compacted, copies otherwise.
+        """
+        return self.__day_series(day, self.__load_dictionary()[2].get(symbol))
+
+    def __day_series(self, day: str, symbol_id: int) -> (np.ndarray, np.ndarray):
+        _, _, (timestamps, symbol_ids, prices), offsets = self.__map_day(day)
+        if symbol_id is None:
+            return timestamps[:0], prices[:0]
+
+        if offsets is not None:
+            if symbol_id >= len(offsets) - 1:
+                return timestamps[:0], prices[:0]
+            start, end = offsets[symbol_id], offsets[symbol_id + 1]
+            return timestamps[start:end], prices[start:end]
+
+        mask = symbol_ids == symbol_id
+        timestamps, prices = timestamps[mask], prices[mask]
+        order = np.argsort(timestamps, kind='stable')
+        return timestamps[order], prices[order]
+
+    def series(self, symbol: str, first_day: str = None, last_day: str = None) -> (np.ndarray, np.ndarray):
+        """
+        Returns (timestamps, prices) of symbol over a range of days.
+        """
+        symbol_id = self.__load_dictionary()[2].get(symbol)
+        parts = [self.__day_series(day, symbol_id) for day in self.__range(first_day, last_day)]
+        if len(parts) == 0:
+            return np.empty(0), np.empty(0)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts])
+
+    def all_series(self, first_day: str = None, last_day: str = None) -> dict:
+        """
+        Returns dict of symbol -> (timestamps, prices) over a range of days
+        (PriceHistory.from_series takes it as is).
+        """
+        symbols = self.symbols()
+        days = self.__range(first_day, last_day)
+        result = {}
+        for symbol_id, symbol in enumerate(symbols):
+            parts = [self.__day_series(day, symbol_id) for day in days]
+            parts = [part for part in parts if len(part[0]) > 0]
+            if len(parts) > 0:
+                result[symbol] = (np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts]))
+        return result
+
+    def __range(self, first_day: str, last_day: str) -> list:
+        return [day for day in self.days() if (first_day is None or day >= first_day) and (last_day is None or day <= last_day)]
+
+
+class TickRecorder(object):
+    """
+    Appends (timestamp, symbol id, price) records to a TickStore directory.
+    record() only buffers; a background writer appends the buffer to the
+    column files of its day, adds new symbols to the dictionary and sorts
+    days that are over by symbol.
+    """
+    def __init__(self, directory: str, flush_period: float = None, max_buffered: int = None):
+        self.__directory = directory
+        self.__flush_period = ct.TICK_FLUSH_PERIOD if flush_period is None else flush_period
+        self.__max_buffered = ct.TICK_BUFFER_SIZE if max_buffered is None else max_buffered
+        self.__store = TickStore(directory)
+        self.__lock = Lock()
+        # serializes writes
+        self.__io_lock = Lock()
+        # (timestamp, symbol, price) not written yet
+        self.__buffer = []
+        self.__stopped = Event()
+        self.__writer = None
+        self.written = 0
+        self.dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.__repair()
+        # symbol -> id
+        self.__ids = {symbol: i for i, symbol in enumerate(self.__store.symbols())}
+
+    def record(self, symbol: str, price: float, when: float = None) -> None:
+        """
+        Buffers a quote. Quotes without a price are not worth keeping.
+        """
+        if price is None or price <= 0:
+            return
+        when = clock.time() if when is None else when
+
+        self.__lock.acquire()
+        if len(self.__buffer) < self.__max_buffered:
+            self.__buffer.append((when, symbol, price))
+        else:
+            self.dropped += 1
+        self.__lock.release()
+
+    def record_many(self, prices: dict, when: float = None) -> None:
+        """
+        Buffers a dict of symbol -> price observed at the same time.
+        """
+        when = clock.time() if when is None else when
+        ticks = [(when, symbol, price) for symbol, price in prices.items() if price is not None and price > 0]
+
+        self.__lock.acquire()
+        room = max(0, self.__max_buffered - len(self.__buffer))
+        self.__buffer.extend(ticks[:room])
+        self.dropped += len(ticks) - min(room, len(ticks))
+        self.__lock.release()
+
+    def start(self) -> None:
+        """
+        Starts background writer.
+        """
+        self.__writer = Thread(target=self.__run, name='tick-writer')
+        self.__writer.daemon = True
+        self.__writer.start()
+
+    def stop(self) -> None:
+        """
+        Stops background writer after writing out what is buffered.
+        """
+        self.__stopped.set()
+        if self.__writer is not None:
+            self.__writer.join()
+        self.flush()
+
+    def __run(self):
+        while not self.__stopped.wait(self.__flush_period):
+            try:
+                self.flush()
+            except Exception as ex:
+                log.error('Exception %s while writing ticks', ex)
+                log.error(traceback.format_exc())
+
+    def flush(self) -> None:
+        """
+        Writes buffered ticks; days before the newest one written get compacted.
+        """
+        self.__io_lock.acquire()
+        try:
+            self.__flush()
+        finally:
+            self.__io_lock.release()
+
+    def __flush(self) -> None:
+        # caller holds self.__io_lock
+        self.__lock.acquire()
+        ticks = self.__buffer
+        self.__buffer = []
+        self.__lock.release()
+
+        if len(ticks) == 0:
+            return
+
+        # new symbols reach the dictionary before any record using them
+        new = []
+        for _, symbol, _ in ticks:
+            if symbol not in self.__ids:
+                self.__ids[symbol] = len(self.__ids)
+                new.append(symbol)
+        if len(new) > 0:
+            with open(os.path.join(self.__directory, DICTIONARY), 'a') as fh:
+                fh.write(''.join(f'{symbol}\n' for symbol in new))
+
+        timestamps = np.fromiter((tick[0] for tick in ticks), dtype=np.float64, count=len(ticks))
+        symbol_ids = np.fromiter((self.__ids[tick[1]] for tick in ticks), dtype=np.uint32, count=len(ticks))
+        prices = np.fromiter((tick[2] for tick in ticks), dtype=np.float64, count=len(ticks))
+        days = np.array([day_of(when) for when in timestamps]) if timestamps[0] // 86400 != timestamps[-1] // 86400 else None
+
+        for day in (sorted(set(days)) if days is not None else [day_of(timestamps[0])]):
+            mask = days == day if days is not None else slice(None)
+            self.__append(day, timestamps[mask], symbol_ids[mask], prices[mask])
+        self.written += len(ticks)
+
+        # days before the newest one get no more ticks (late ones reopen the day)
+        newest = day_of(timestamps.max())
+        for day in self.__store.days():
+            if day < newest and not os.path.exists(os.path.join(self.__directory, day, INDEX)):
+                self.compact(day)
+
+    def __append(self, day: str, timestamps: np.ndarray, symbol_ids: np.ndarray, prices: np.ndarray) -> None:
+        # caller holds self.__io_lock
+        day_dir = os.path.join(self.__directory, day)
+        os.makedirs(day_dir, exist_ok=True)
+        index_path = os.path.join(day_dir, INDEX)
+        if os.path.exists(index_path):
+            # a late tick for a compacted day; it gets sorted in again later
+            os.remove(index_path)
+
+        for (name, _), column in zip(COLUMNS, (timestamps, symbol_ids, prices)):
+            with open(os.path.join(day_dir, name), 'ab') as fh:
+                column.tofile(fh)
+
+    def compact(self, day: str) -> None:
+        """
+        Sorts a day by symbol and time and indexes where each symbol's rows start.
+        """
+        day_dir = os.path.join(self.__directory, day)
+        timestamps, symbol_ids, prices = self.__store.day(day)
+        order = np.lexsort((timestamps, symbol_ids))
+        offsets = np.searchsorted(symbol_ids[order], np.arange(len(self.__ids) + 1), side='left').astype(np.int64)
+
+        # written next to the day and swapped in, so a crash leaves one whole copy
+        tmp_dir = day_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for (name, _), column in zip(COLUMNS, (timestamps, symbol_ids, prices)):
+            column[order].tofile(os.path.join(tmp_dir, name))
+        np.save(os.path.join(tmp_dir, INDEX), offsets)
+
+        old_dir = day_dir + '.old'
+        os.rename(day_dir, old_dir)
+        os.rename(tmp_dir, day_dir)
+        shutil.rmtree(old_dir)
+        log.info('Compacted %d ticks of %s', len(order), day)
+
+    def __repair(self) -> None:
+        """
+        Finishes a compaction a crash interrupted and cuts off records a
+        crash left in only some of the columns.
+        """
+        for name in os.listdir(self.__directory):
+            path = os.path.join(self.__directory, name)
+            if name.endswith('.tmp'):
+                day_dir = path[:-4]
+                if not os.path.exists(day_dir) and os.path.exists(os.path.join(path, INDEX)):
+                    os.rename(path, day_dir)
+                else:
+                    shutil.rmtree(path)
+            elif name.endswith('.old'):
+                day_dir = path[:-4]
+                if os.path.exists(day_dir):
+                    shutil.rmtree(path)
+                else:
+                    os.rename(path, day_dir)
+
+        for day in self.__store.days():
+            day_dir = os.path.join(self.__directory, day)
+            count = _rows(day_dir)
+            for name, dtype in COLUMNS:
+                path = os.path.join(day_dir, name)
+                size = count * np.dtype(dtype).itemsize
+                if os.path.exists(path) and os.path.getsize(path) > size:
+                    log.warn('Cutting %s of %s back to %d complete records', name, day, count)
+                    with open(path, 'rb+') as fh:
+                        fh.truncate(size)
+
+    def stats(self) -> dict:
+        return {'written': self.written, 'dropped': self.dropped, 'buffered': len(self.__buffer), 'symbols': len(self.__ids)}
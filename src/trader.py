@@ -1,61 +1,116 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import clock
 import constants as ct
 
 from portfolio import Portfolio
 from watchdog import Watchdog
 from logger import Logger
-from etrader import ETrader
+from symbols import SymbolIndex
+from state_service import StateService
+from orders import Order, parse_order_id
+from thresholds import Rule
+from tick_store import TickRecorder
+
+log = Logger.get('trader')
 
 
 class Trader(object):
-    def __init__(self):
+    def __init__(self, broker=None, background: bool = True):
         """
         Sets up trader with given parameters.
 
+        :param broker: client with ETrader's quote, order & fill calls; logs in to E*TRADE if omitted
+        :param background: run the watchdog thread & state service; if False the caller drives watchdog.tick()
         :return: None
         """
         # Setup etrade
-        self.__etrader = ETrader()
+        if broker is None:
+            # imported here so a simulated broker needs no credentials
+            from etrader import ETrader
+            broker = ETrader()
+            if ct.BROKER_CLIENT == 'asyncio':
+                # imported here so aiohttp is only needed when asked for
+                from async_etrader import AsyncETrader, BlockingETrader
+                broker = BlockingETrader(AsyncETrader.from_session(broker.session))
+        self.__etrader = broker
+        # places the orders of many positions sold at once
+        self.__exit_pool = ThreadPoolExecutor(max_workers=ct.ORDER_WORKERS, thread_name_prefix='exit')
+        # seconds from observing a price to placing the sell order, per order
+        self.exit_latencies = deque(maxlen=1000)
+        # (positions, seconds until the last of their orders was placed) per bulk sell
+        self.liquidation_latencies = deque(maxlen=1000)
+        # Load symbol universe & denylists
+        self.__symbols = SymbolIndex('db/symbols.txt', 'db/denylist.json')
         # Initialize portfolio
         Portfolio.initialize_wallet(ct.DEFAULT_BALANCE_IN)
         self.__portfolio: Portfolio = Portfolio()
+        # Record fetched quotes
+        self.__ticks = TickRecorder(ct.TICK_DIR) if ct.TICK_RECORDING else None
         # Initialize watchdog
-        self.__watchdog: Watchdog = Watchdog(self.__portfolio, self.handle_sell_sig, self.__etrader.get_filled_orders, self.__etrader.get_ticker_price)
+        self.__watchdog: Watchdog = Watchdog(self.__portfolio, self.handle_sell_sigs, self.__etrader.sync_filled_orders, self.__etrader.get_ticker_price, self.__etrader.get_ticker_prices, self.__ticks)
 
-        self.__watchdog.daemon = True
-        self.__watchdog.start()
-        
         # hand off pointer to portfolio to set of latest prices
         self.__portfolio.set_watchdog(self.__watchdog)
 
+        if not background:
+            return
+
+        if self.__ticks is not None:
+            self.__ticks.start()
+        self.__watchdog.daemon = True
+        self.__watchdog.start()
+
+        # let the webserver change wallet & watchlist through us instead of the db files
+        self.__state_service = StateService(self.__portfolio.store, self.__portfolio.ledger, self.__watchdog.rules, ct.STATE_SOCKET)
+        self.__state_service.start()
+
+    @property
+    def portfolio(self) -> Portfolio:
+        return self.__portfolio
+
+    @property
+    def watchdog(self) -> Watchdog:
+        return self.__watchdog
+
     def __ticker_contract(self, ticker: str) -> None:
         if not isinstance(ticker, str):
             raise TypeError('Expected str for ticker!')
 
-    def handle_buy_sig(self, ticker: str, negative_bias: bool = False) -> None:
+    def handle_buy_sig(self, ticker: str, negative_bias: bool = False) -> bool:
         """
         Handles BUY signal for stock with given ticker.
+
+        :returns: True if an order was submitted
         """
         self.__ticker_contract(ticker)
 
         # Check if we already own ticker
         if self.__portfolio.get_asset(ticker):
-            Logger.warn(f'Already own {ticker}!')
-            return
+            log.warn('Already own %s!', ticker)
+            return False
+
+        # Don't waste a quote call on something that can't be a symbol
+        if not self.__symbols.allow(ticker):
+            return False
 
         # Get latest price
         current_price = self.__watchdog.get_price(ticker)
+        self.__symbols.report_price(ticker, current_price)
 
         if current_price is None or current_price <= 0:
-            Logger.error(f'Ticker {ticker} has a price <= 0. Not buying any shares.')
-            return
+            log.error('Ticker %s has a price <= 0. Not buying any shares.', ticker)
+            return False
 
         if current_price > ct.MAX_TICKER_PRICE:
-            Logger.error(f'Ticker {ticker} has a price higher than max allowed {ct.MAX_TICKER_PRICE}')
-            return
+            log.error('Ticker %s has a price higher than max allowed %s', ticker, ct.MAX_TICKER_PRICE)
+            return False
 
         if negative_bias and current_price > ct.MAX_TICKER_NO_FILTER_PRICE:
-            Logger.error(f'Ticker {ticker} has negative bias and is > no filter price {ct.MAX_TICKER_NO_FILTER_PRICE}')
-            return
+            log.error('Ticker %s has negative bias and is > no filter price %s', ticker, ct.MAX_TICKER_NO_FILTER_PRICE)
+            return False
 
         # Calculate number of shares based on currency amount
         shares_no = self.__portfolio.usd_to_shares(ticker, ct.DEFAULT_CURRENCY_BUY_AMOUNT)
@@ -63,60 +118,140 @@ class Trader(object):
         limit_price = round(current_price * ct.BUY_LIMIT_PRICE_MULTIPLIER, 4)
 
 
-        if limit_price * shares_no > self.__portfolio.balance:
-            Logger.error(f'Not placing order for {ticker}: cost at limit price: ({limit_price*shares_no}) > balance ({self.__portfolio.balance}).')
-            return
+        # Hold the cost so concurrent buys can't spend the same balance
+        cost = limit_price * shares_no
+        reservation = self.__portfolio.ledger.reserve(cost, ticker)
+        if reservation is None:
+            log.error('Not placing order for %s: cost at limit price: (%s) > available balance (%s).', ticker, cost, self.__portfolio.available)
+            return False
         else:
-            Logger.info(f'We have enough balance ({self.__portfolio.balance}) to make purchase at limit price; cost: {shares_no*limit_price}')
+            log.info('We have enough balance (%s) to make purchase at limit price; cost: %s', self.__portfolio.available + cost, cost)
 
-        # Add ticker to portfolio if needed
-        self.__portfolio.add_ticker_if_inexistent(ticker)
+        try:
+            # Add ticker to portfolio if needed
+            self.__portfolio.add_ticker_if_inexistent(ticker)
 
-        if ct.LIVE_TRADING:
-            Logger.warn('Placing LIVE BUY order!')
-            valid, order = self.__etrader.place_order(price_type='LIMIT', order_term='GOOD_FOR_DAY', limit_price=limit_price, symbol=ticker, order_action='BUY', quantity=shares_no)
+            if ct.LIVE_TRADING:
+                log.warn('Placing LIVE BUY order!')
+                # cost stays reserved until fills settle the order
+                order = self.__portfolio.orders.open(ticker, Order.BUY, shares_no, limit_price, reservation)
+                valid, response = self.__etrader.place_order(price_type='LIMIT', order_term='GOOD_FOR_DAY', limit_price=limit_price, symbol=ticker, order_action='BUY', quantity=shares_no, client_order_id=order.client_id)
+
+                if valid:
+                    log.info('Successful order. Tracking order %s & subscribing!', order.client_id)
+                    self.__portfolio.orders.placed(order, parse_order_id(response))
+                    self.__subscribe_exits(ticker, current_price)
+                    log.info('Subscribed')
+                else:
+                    self.__portfolio.orders.cancel(order)
+                return valid
+            else:
+                self.__portfolio.buy_shares(ticker, shares_no, cost, reservation)
+                self.__subscribe_exits(ticker, current_price)
+                return True
+        except Exception:
+            if reservation.open:
+                self.__portfolio.ledger.release(reservation)
+            raise
 
-            if valid:
-                Logger.info('Successful order. Updating portfolio & subscribing!')
-                self.__portfolio.buy_shares(ticker, shares_no, limit_price)
-                self.__watchdog.subscribe(ticker, current_price * ct.SELL_THRESH_MULTIPLIER, '>')
-                Logger.info('Subscribed')
-        else:
-            self.__portfolio.buy_shares(ticker, shares_no, limit_price)
-            self.__watchdog.subscribe(ticker, current_price * ct.SELL_THRESH_MULTIPLIER, '>')
-            
 
+    def __subscribe_exits(self, ticker: str, price: float) -> None:
+        """
+        Subscribes the rules a position bought at price is sold by.
+        """
+        self.__watchdog.subscribe(ticker, price * ct.SELL_THRESH_MULTIPLIER, '>')
+        if ct.STOP_LOSS_MULTIPLIER is not None:
+            self.__watchdog.subscribe(ticker, price * ct.STOP_LOSS_MULTIPLIER, '<')
+        if ct.TRAILING_STOP is not None:
+            self.__watchdog.subscribe(ticker, price, '<', Rule.TRAILING, ct.TRAILING_STOP)
+        if ct.MAX_HOLD_SECONDS is not None:
+            self.__watchdog.subscribe(ticker, clock.time() + ct.MAX_HOLD_SECONDS, '>', Rule.EXPIRY)
 
     def handle_sell_sig(self, ticker: str) -> None:
         """
         Handles SELL signal for stock with given ticker.
         """
-        row = self.__portfolio.get_asset(ticker)
+        self.handle_sell_sigs({ticker: self.__watchdog.get_price(ticker)})
+
+    def handle_sell_sigs(self, prices: dict, observed_at: float = None) -> dict:
+        """
+        Handles SELL signals of many tickers at once, e.g. every position a
+        watch cycle fired: their orders are placed concurrently (at most
+        ORDER_WORKERS at a time) at the prices given and their subscriptions
+        are dropped in one watchlist change.
+
+        :param prices: dict of ticker -> price to sell at
+        :param observed_at: time.perf_counter() the prices were observed at (now if omitted)
+        :returns: dict of ticker -> seconds from observed_at until its order was placed
+                  (None if it wasn't)
+        """
+        start = time.perf_counter() if observed_at is None else observed_at
+        latencies = {}
+        # tickers whose subscriptions go
+        done = []
+        # (ticker, order, place_order keyword arguments)
+        sells = []
 
-        if row:
-            current_price = self.__watchdog.get_price(ticker)
+        for ticker, current_price in prices.items():
+            row = self.__portfolio.get_asset(ticker)
+            if not row:
+                log.error('Attempted to sell unowned stock!')
+                continue
+            if current_price is None or current_price <= 0:
+                log.error('Cannot sell %s: no price to sell at', ticker)
+                continue
 
             profit = -row['stake'] + row['shares'] * current_price
-            Logger.info(f'stake: {row["stake"]} shares: {row["shares"]} current_price: {current_price}')
-            Logger.info(f'>> SELLING {ticker} for a profit of {profit}')
+            log.info('stake: %s shares: %s current_price: %s', row['stake'], row['shares'], current_price)
+            log.info('>> SELLING %s for a profit of %s', ticker, profit)
 
             limit_price = round(current_price * ct.SELL_LIMIT_PRICE_MULTIPLIER, 4)
 
-            if ct.LIVE_TRADING:
-                if row['shares'] < 1:
-                    Logger.error(f'Cannot sell: no shares. Maybe none were filled?')
-                    return
-
-                valid, order = self.__etrader.place_order(price_type='LIMIT', order_term='GOOD_FOR_DAY', limit_price=limit_price, symbol=ticker, order_action='SELL', quantity=row['shares'])
-                
-                if not valid:
-                    Logger.error(f'Unsuccessful SELL order for {ticker}')
-                    self.__watchdog.unsubscribe_all(ticker)
-                    return
-
-            self.__watchdog.unsubscribe_all(ticker)
-            self.__portfolio.sell_all_shares(ticker, row)
+            if not ct.LIVE_TRADING:
+                self.__portfolio.sell_all_shares(ticker, row, current_price)
+                latencies[ticker] = time.perf_counter() - start
+                done.append(ticker)
+                continue
+
+            # shares still on the book that no sell order is out for yet
+            shares = row['shares'] - self.__portfolio.orders.pending(ticker, Order.SELL)
+            if shares < 1:
+                log.error('Cannot sell %s: no shares left to sell. Maybe none were filled?', ticker)
+                continue
+
+            order = self.__portfolio.orders.open(ticker, Order.SELL, shares, limit_price)
+            sells.append((ticker, order, dict(price_type='LIMIT', order_term='GOOD_FOR_DAY', limit_price=limit_price, symbol=ticker, order_action='SELL', quantity=shares, client_order_id=order.client_id)))
+
+        if len(sells) == 1:
+            results = [self.__place(sells[0][2], start)]
         else:
-            Logger.error('Attempted to sell unowned stock!')
+            results = list(self.__exit_pool.map(lambda sell: self.__place(sell[2], start), sells))
+
+        for (ticker, order, _), (valid, response, latency) in zip(sells, results):
+            done.append(ticker)
+            latencies[ticker] = None
+            if not valid:
+                log.error('Unsuccessful SELL order for %s', ticker)
+                self.__portfolio.orders.cancel(order)
+                continue
 
+            # position and profit follow from the fills
+            self.__portfolio.orders.placed(order, parse_order_id(response))
+            latencies[ticker] = latency
+            self.exit_latencies.append(latency)
+            log.info('SELL order for %s placed %.1f ms after its price was observed', ticker, latency * 1000)
 
+        self.__watchdog.unsubscribe_many(done)
+
+        if len(prices) > 1:
+            total = time.perf_counter() - start
+            self.liquidation_latencies.append((len(prices), total))
+            log.info('Sold %d of %d positions in %.1f ms', sum(latency is not None for latency in latencies.values()), len(prices), total * 1000)
+        return latencies
+
+    def __place(self, order: dict, start: float) -> (bool, dict, float):
+        """
+        Places order. Returns success flag, response & seconds since start.
+        """
+        valid, response = self.__etrader.place_order(**order)
+        return valid, response, time.perf_counter() - start
@@ -0,0 +1,250 @@
+import random
+import time
+from bisect import bisect_left
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+import constants as ct
+from logger import Logger
+
+log = Logger.get('transport')
+
+
+class LatencyHistogram(object):
+    """
+    Request latencies counted in log-spaced buckets (four per doubling, 1 ms up to ~65 s).
+    """
+    BOUNDS = [0.001 * 2 ** (i / 4) for i in range(65)]
+
+    def __init__(self):
+        # counts[i] holds latencies <= BOUNDS[i]; the last one everything slower
+        self.counts = [0] * (len(LatencyHistogram.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.counts[bisect_left(LatencyHistogram.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p: float) -> float:
+        """
+        Returns upper bound (seconds) of the bucket holding the p-th percentile.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return min(LatencyHistogram.BOUNDS[i], self.max) if i < len(LatencyHistogram.BOUNDS) else self.max
+        return self.max
+
+    def as_dict(self) -> dict:
+        return {'count': self.count, 'mean': self.total / self.count if self.count > 0 else 0.0, 'p50': self.percentile(50),
+                'p95': self.percentile(95), 'p99': self.percentile(99), 'max': self.max}
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to the broker after too many consecutive failures. Once
+    cooldown seconds have passed a single trial call goes through: if it
+    works calls resume, otherwise the breaker stays open for another cooldown.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failures: int, cooldown: float):
+        self.__failures = failures
+        self.__cooldown = cooldown
+        self.__lock = Lock()
+        self.__consecutive = 0
+        self.__opened_at = 0.0
+        self.state = CircuitBreaker.CLOSED
+
+    def allow(self) -> bool:
+        """
+        Returns True if a call may go out now.
+        """
+        self.__lock.acquire()
+        try:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and time.monotonic() - self.__opened_at >= self.__cooldown:
+                # let this one call find out whether the broker is back
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+        finally:
+            self.__lock.release()
+
+    def success(self) -> None:
+        self.__lock.acquire()
+        if self.state != CircuitBreaker.CLOSED:
+            log.info('Broker calls resumed')
+        self.state = CircuitBreaker.CLOSED
+        self.__consecutive = 0
+        self.__lock.release()
+
+    def failure(self) -> None:
+        self.__lock.acquire()
+        self.__consecutive += 1
+        if self.state == CircuitBreaker.HALF_OPEN or (self.state == CircuitBreaker.CLOSED and self.__consecutive >= self.__failures):
+            log.error('Broker degraded after %d failed calls; holding off for %s s', self.__consecutive, self.__cooldown)
+            self.state = CircuitBreaker.OPEN
+            self.__opened_at = time.monotonic()
+        self.__lock.release()
+
+
+class EndpointStats(object):
+    """
+    Latency histogram of every attempt and retry/failure counts per endpoint.
+    """
+    RETRIES = 0
+    FAILED = 1
+    SHORT_CIRCUITED = 2
+
+    def __init__(self):
+        self.__lock = Lock()
+        # endpoint -> LatencyHistogram
+        self.__latencies = {}
+        # endpoint -> [retries, failed requests, short-circuited requests]
+        self.__counters = {}
+
+    def record(self, endpoint: str, seconds: float) -> None:
+        self.__lock.acquire()
+        histogram = self.__latencies.get(endpoint)
+        if histogram is None:
+            histogram = self.__latencies[endpoint] = LatencyHistogram()
+        histogram.record(seconds)
+        self.__lock.release()
+
+    def count(self, endpoint: str, counter: int) -> None:
+        self.__lock.acquire()
+        counters = self.__counters.get(endpoint)
+        if counters is None:
+            counters = self.__counters[endpoint] = [0, 0, 0]
+        counters[counter] += 1
+        self.__lock.release()
+
+    def as_dict(self) -> dict:
+        self.__lock.acquire()
+        result = {}
+        for endpoint in sorted(set(self.__latencies) | set(self.__counters)):
+            histogram = self.__latencies.get(endpoint, LatencyHistogram())
+            counters = self.__counters.get(endpoint, [0, 0, 0])
+            result[endpoint] = dict(histogram.as_dict(), retries=counters[0], failed=counters[1], short_circuited=counters[2])
+        self.__lock.release()
+        return result
+
+
+def backoff(attempt: int) -> float:
+    """
+    Returns seconds to wait before retry number attempt + 1 (full jitter).
+    """
+    return random.uniform(0, min(ct.HTTP_BACKOFF_MAX, ct.HTTP_BACKOFF_BASE * 2 ** attempt))
+
+
+def _never_sent(error: Exception) -> bool:
+    """
+    Returns True if error means the request didn't reach the broker.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    return isinstance(error, requests.exceptions.ConnectionError) and len(error.args) > 0 and isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+
+
+class Transport(object):
+    """
+    Sends broker requests over a session with a sized connection pool, a
+    timeout per endpoint, retries with jittered exponential backoff on 5xx
+    and connection errors and a circuit breaker. Keeps a latency histogram
+    per endpoint.
+
+    Requests that fail for good return the last 5xx response or None, like
+    a request that got no response.
+    """
+    # endpoints not safe to send twice
+    NOT_IDEMPOTENT = {'place'}
+
+    def __init__(self, session, pool_size: int = None, timeouts: dict = None, retries: int = None, breaker: CircuitBreaker = None):
+        self.__session = session
+        self.__timeouts = ct.HTTP_TIMEOUTS if timeouts is None else timeouts
+        self.__retries = ct.HTTP_RETRIES if retries is None else retries
+        self.breaker = CircuitBreaker(ct.BREAKER_FAILURES, ct.BREAKER_COOLDOWN) if breaker is None else breaker
+        self.__stats = EndpointStats()
+
+        # one host, so one pool; sized for our concurrent callers so none
+        # of them opens (and drops) a connection of its own
+        pool_size = ct.HTTP_POOL_SIZE if pool_size is None else pool_size
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    def get(self, endpoint: str, url: str, **kwargs):
+        return self.request('GET', endpoint, url, **kwargs)
+
+    def post(self, endpoint: str, url: str, **kwargs):
+        return self.request('POST', endpoint, url, **kwargs)
+
+    def request(self, method: str, endpoint: str, url: str, **kwargs):
+        """
+        Sends request, retrying what can be retried.
+
+        :param endpoint: name the timeout, stats & retry policy go by
+        :returns: response or None
+        """
+        timeout = self.__timeouts.get(endpoint)
+        idempotent = endpoint not in Transport.NOT_IDEMPOTENT
+        response = None
+
+        for attempt in range(self.__retries + 1):
+            if not self.breaker.allow():
+                self.__stats.count(endpoint, EndpointStats.SHORT_CIRCUITED)
+                log.warn('Not calling %s: broker calls are on hold', endpoint)
+                return response
+
+            start = time.perf_counter()
+            try:
+                response = self.__session.request(method, url, timeout=timeout, **kwargs)
+                error = None
+            except requests.exceptions.RequestException as ex:
+                response = None
+                error = ex
+            self.__stats.record(endpoint, time.perf_counter() - start)
+
+            if error is None and response.status_code < 500:
+                self.breaker.success()
+                return response
+
+            self.breaker.failure()
+            if error is None:
+                retry = idempotent
+                log.warn('%s returned %s (attempt %d)', endpoint, response.status_code, attempt + 1)
+            else:
+                # a timed out read may have placed the order already
+                retry = idempotent or _never_sent(error)
+                log.warn('%s failed: %s (attempt %d)', endpoint, error, attempt + 1)
+
+            if not retry or attempt == self.__retries:
+                break
+
+            self.__stats.count(endpoint, EndpointStats.RETRIES)
+            time.sleep(backoff(attempt))
+
+        self.__stats.count(endpoint, EndpointStats.FAILED)
+        log.warn('Giving up on %s after %d attempts', endpoint, attempt + 1)
+        return response
+
+    def stats(self) -> dict:
+        """
+        Returns per endpoint latencies (seconds) and retry/failure counts, and the breaker state.
+        """
+        return {'breaker': self.breaker.state, 'endpoints': self.__stats.as_dict()}
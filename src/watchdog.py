@@ -1,11 +1,17 @@
+import heapq
 import traceback
-import uuid
-from threading import Thread, Lock
+from collections import deque
+from threading import Thread, Condition, Lock
 import time
 from enum import Enum
+import clock
 import constants as ct
 from logger import Logger
-from tinydb import TinyDB, Query
+from quote_cache import QuoteCache
+from thresholds import ThresholdIndex, Rule
+from storage import open_storage
+
+log = Logger.get('watchdog')
 
 
 class Watchdog(Thread):
@@ -13,72 +19,199 @@ class Watchdog(Thread):
     """Aggregates price data for stocks and flares events."""
     DEBUG=True
 
-    def __init__(self, portfolio: 'Portfolio', sell_handler: 'callable', get_order_fills: 'callable', get_ticker_price: 'callable'):
+    def __init__(self, portfolio: 'Portfolio', sell_handler: 'callable', get_order_fills: 'callable', get_ticker_price: 'callable', get_ticker_prices: 'callable', ticks: 'TickRecorder' = None):
         """TODO: to be defined. """
 
         Thread.__init__(self)
         # initialize portfolio
         self.__portfolio = portfolio
-        # initialize get_ticker_price mutex
-        self.__mutex = Lock()
-        # initialize watch list (list of list)
-        self.__watchlist = TinyDB('db/watchlist.json')
-        # initialize sell handler
+        # initialize watch list: sorted thresholds per ticker, persisted in the background
+        self.__rules = ThresholdIndex(open_storage())
+        self.__rules.start()
+        # guards schedule; notified when a check is due earlier
+        self.__cond = Condition(Lock())
+        # heap of (next check time, ticker); entries not matching __next_check are stale
+        self.__schedule = []
+        self.__next_check = {}
+        self.__next_fill_sync = 0
+        # seconds from observing a price crossing to calling the sell handler
+        self.trigger_latencies = deque(maxlen=1000)
+        # initialize sell handler; called with ticker -> price of every position fired
+        # in a cycle and the time.perf_counter() the prices were observed at
         self.__sell_handler = sell_handler
         # initialize get_order_fills
         self.__get_order_fills = get_order_fills
-        # initialize get_ticker_price
+        # initialize quote cache in front of get_ticker_price(s); it coalesces
+        # concurrent requests for the same symbol into one broker call
         self.__get_ticker_price = get_ticker_price
+        self.__get_ticker_prices = get_ticker_prices
+        self.__quotes = QuoteCache(self.__fetch_price, self.__fetch_prices, ct.QUOTE_CACHE_TTL, ct.QUOTE_CACHE_SIZE)
+        # records quotes fetched from the broker (cache hits aren't new observations)
+        self.__ticks = ticks
 
     def run(self):
         """
-        Watches market to trigger sales.
+        Watches market to trigger sales. Each ticker is checked when it is
+        due; tickers close to a threshold are due more often.
         """
         while True:
-            if Watchdog.DEBUG:
-                Logger.debug('Pulling latest prices..')
-
             try:
-                self.__check_for_events()
-                time.sleep(ct.WATCHDOG_UPDATE_PERIOD)
+                self.tick(clock.monotonic())
+
+                # sleep until the next ticker is due or a new subscription comes in
+                self.__cond.acquire()
+                self.__cond.wait(max(0, self.__next_wake() - clock.monotonic()))
+                self.__cond.release()
             except Exception as ex:
-                Logger.error(f'Exception {ex}. Exiting thread..')
-                Logger.error(traceback.format_exc())
+                log.error('Exception %s. Exiting thread..', ex)
+                log.error(traceback.format_exc())
                 break
 
-    def __check_for_events(self):
-        """TODO: Docstring for __check_for_events.
-        """
-        tickers = self.__portfolio.get_tickers()
+    def __fetch_price(self, ticker: str) -> float:
+        price = self.__get_ticker_price(ticker)
+        if self.__ticks is not None:
+            self.__ticks.record(ticker, price)
+        return price
 
+    def __fetch_prices(self, tickers: list) -> dict:
+        prices = self.__get_ticker_prices(tickers)
+        if self.__ticks is not None:
+            self.__ticks.record_many(prices)
+        return prices
+
+    def tick(self, now: float) -> None:
+        """
+        Runs one watch cycle at monotonic time now: syncs order fills if
+        that is due and checks the tickers that are due.
+        """
         # check for order fills
-        if ct.LIVE_TRADING:
-            orders = self.__get_order_fills()
-            self.__portfolio.sync_order_fills(orders)
-
-        # check for sell signals
-        for subscription in self.__watchlist:
-            # extract tokens
-            ticker = subscription['ticker']
-            op = subscription['op']
-            thresh = subscription['threshold']
-            identifier = subscription['uuid']
-
-            # make sure ticker is owned
-            if ticker not in tickers:
-                Logger.warn(f'Skipping over subscribed ticker not in portfolio!')
+        if now >= self.__next_fill_sync:
+            if ct.LIVE_TRADING:
+                fills, complete = self.__get_order_fills()
+                self.__portfolio.sync_order_fills(fills, complete)
+            self.__schedule_unscheduled()
+            self.__next_fill_sync = now + ct.WATCHDOG_UPDATE_PERIOD
+
+        due = self.__pop_due(now)
+        if len(due) > 0:
+            if Watchdog.DEBUG:
+                log.debug('Pulling latest prices for %d tickers..', len(due))
+            self.__check_for_events(due)
+
+    def next_wake(self) -> float:
+        """
+        Returns monotonic time of the next cycle with anything to do.
+        """
+        self.__cond.acquire()
+        result = self.__next_wake()
+        self.__cond.release()
+        return result
+
+    def __next_wake(self) -> float:
+        # caller holds self.__cond
+        next_due = self.__schedule[0][0] if len(self.__schedule) > 0 else self.__next_fill_sync
+        return min(next_due, self.__next_fill_sync)
+
+    def __pop_due(self, now: float) -> list:
+        """
+        Returns tickers whose next check time has come.
+        """
+        due = []
+        self.__cond.acquire()
+        while len(self.__schedule) > 0 and self.__schedule[0][0] <= now:
+            when, ticker = heapq.heappop(self.__schedule)
+            # stale entry left behind by a reschedule or unsubscribe
+            if self.__next_check.get(ticker) != when:
+                continue
+            del self.__next_check[ticker]
+            due.append(ticker)
+        self.__cond.release()
+        return due
+
+    def __schedule_check(self, ticker: str, when: float) -> None:
+        # caller holds self.__cond
+        current = self.__next_check.get(ticker)
+        if current is not None and current <= when:
+            return
+        self.__next_check[ticker] = when
+        heapq.heappush(self.__schedule, (when, ticker))
+
+    def __schedule_unscheduled(self) -> None:
+        """
+        Makes sure every watched ticker has a check coming up.
+        """
+        now = clock.monotonic()
+        self.__cond.acquire()
+        for ticker in self.__rules.tickers():
+            if ticker not in self.__next_check:
+                self.__schedule_check(ticker, now)
+        self.__cond.release()
+
+    def __interval(self, ticker: str, price: float) -> float:
+        """
+        Seconds until ticker should be checked again given its latest price.
+        """
+        if price is None or price <= 0:
+            return ct.WATCHDOG_UPDATE_PERIOD
+
+        # relative distance to the closest threshold
+        interval = ct.WATCHDOG_UPDATE_PERIOD * self.__rules.distance(ticker, price) / ct.WATCHDOG_NEAR_THRESH
+        # and no later than an expiry rule is due
+        interval = min(interval, self.__rules.deadline(ticker) - clock.time())
+        return max(ct.WATCHDOG_MIN_PERIOD, min(ct.WATCHDOG_UPDATE_PERIOD, interval))
+
+    def __check_for_events(self, tickers: list):
+        """
+        Checks subscriptions of given tickers against one price snapshot.
+        """
+        # make sure ticker is owned
+        owned = []
+        for ticker in tickers:
+            if self.__portfolio.get_asset(ticker) is None:
+                log.warn('Skipping over subscribed ticker not in portfolio!')
                 # TODO: unsubscribe from this ticker
+                self.__cond.acquire()
+                if ticker in self.__rules:
+                    self.__schedule_check(ticker, clock.monotonic() + ct.WATCHDOG_UPDATE_PERIOD)
+                self.__cond.release()
                 continue
+            owned.append(ticker)
+
+        # take one price snapshot for the whole cycle
+        prices = self.get_prices(owned)
+        observed_at = time.perf_counter()
+
+        if Watchdog.DEBUG:
+            log.debug(lambda: f'Quote cache: {self.quote_stats()}')
 
-            ticker_price = self.get_price(ticker)
+        # find every fired rule in one pass over the snapshot
+        fired = self.__rules.evaluate_many(prices, clock.time())
 
-            if op == '>' and ticker_price > thresh:
-                self.__sell_handler(ticker)
-            elif op == '<' and ticker_price < thresh:
-                self.__sell_handler(ticker)
-            else:
-                if Watchdog.DEBUG:
-                    Logger.debug(f'Not triggering event for {ticker}: price: {ticker_price} operator: {op} thresh: {thresh}')
+        # hand every position that fired over at once, so they all sell at this snapshot
+        if len(fired) > 0:
+            latency = time.perf_counter() - observed_at
+            for ticker, rules in fired.items():
+                rule = rules[0]
+                self.trigger_latencies.append(latency)
+                log.info('%s crossed %s %s %s at %s; sell handler called after %.1f ms', ticker, rule.kind, rule.op, rule.threshold, prices[ticker], latency * 1000)
+            self.__sell_handler({ticker: prices[ticker] for ticker in fired}, observed_at)
+
+        for ticker in owned:
+            ticker_price = prices[ticker]
+            triggered = ticker in fired
+            if not triggered and Watchdog.DEBUG:
+                log.debug('Not triggering event for %s: price: %s', ticker, ticker_price)
+
+            # keep watching if the sell didn't go through
+            self.__cond.acquire()
+            if ticker in self.__rules:
+                interval = ct.WATCHDOG_UPDATE_PERIOD if triggered else self.__interval(ticker, ticker_price)
+                self.__schedule_check(ticker, clock.monotonic() + interval)
+            self.__cond.release()
+
+    @property
+    def rules(self) -> ThresholdIndex:
+        return self.__rules
 
     def get_price(self, ticker: str) -> float:
         """TODO: Docstring for get_price.
@@ -88,25 +221,60 @@ class Watchdog(Thread):
         if not isinstance(ticker, str):
             raise TypeError('Expected str for ticker!')
 
-        self.__mutex.acquire()
-        price = self.__get_ticker_price(ticker)
-        self.__mutex.release()
+        return self.__quotes.get(ticker)
 
-        return price
+    def get_prices(self, tickers: list) -> dict:
+        """
+        Fetches prices for many tickers at once.
+
+        :returns: dict of ticker -> current market price
+        """
+        if len(tickers) == 0:
+            return {}
+
+        return self.__quotes.get_many(tickers)
+
+    def quote_stats(self) -> dict:
+        """
+        Returns quote cache hit/miss/coalesced counters.
+        """
+        return self.__quotes.stats()
 
     def unsubscribe_all(self, ticker: str) -> None:
         """
         Kills all subscriptions associated with ticker.
         """
-        self.__watchlist.remove(Query().ticker == ticker)
+        self.__rules.remove_ticker(ticker)
+        self.__cond.acquire()
+        self.__next_check.pop(ticker, None)
+        self.__cond.release()
 
-    def subscribe(self, ticker: str, threshold: float, op: str):
+    def unsubscribe_many(self, tickers: list) -> None:
         """
-        Subscribes delegate to event described by $CURRENT_PRICE [operator] threshold.
+        Kills all subscriptions of many tickers in one watchlist change.
+        """
+        self.__rules.remove_tickers(tickers)
+        self.__cond.acquire()
+        for ticker in tickers:
+            self.__next_check.pop(ticker, None)
+        self.__cond.release()
 
-        :param ticker: TODO
-        :returns: TODO
+    def subscribe(self, ticker: str, threshold: float, op: str, kind: str = None, trail: float = None):
+        """
+        Subscribes delegate to event described by $CURRENT_PRICE [operator] threshold.
 
+        :param kind: Rule.TAKE_PROFIT, Rule.STOP_LOSS, Rule.TRAILING or Rule.EXPIRY (derived from op if omitted);
+                     an expiry rule's threshold is the unix time to sell at
+        :param trail: fraction below the running high a trailing rule fires at;
+                      threshold is then the current price
         """
-        identifier = str(uuid.uuid1())
-        self.__watchlist.insert({'uuid': identifier, 'ticker': ticker, 'threshold': threshold, 'op': op})
+        if kind is None:
+            kind = Rule.TAKE_PROFIT if op == '>' else Rule.STOP_LOSS
+
+        self.__rules.add(ticker, kind, threshold, trail)
+
+        self.__cond.acquire()
+        # check new subscription right away
+        self.__schedule_check(ticker, clock.monotonic())
+        self.__cond.notify()
+        self.__cond.release()
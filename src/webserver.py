@@ -1,14 +1,195 @@
 from flask import Flask, request, render_template, url_for, Response
 from functools import wraps
-from tinydb import TinyDB, Query
+from threading import Lock
+import hashlib
 import json
+import time
 import constants as ct
+from storage import open_storage, rule_kind, TABLES, EDITABLE_KINDS, EXPIRY, TRAILING
+from change_feed import ChangeFeed
+from state_service import StateClient
 
 app = Flask(__name__)
 
-wallet_table = TinyDB('../db/wallet.json')
-portfolio_table = TinyDB('../db/portfolio.json')
-watchlist_table = TinyDB('../db/watchlist.json')
+# read side of portfolio, wallet & watchlist, status page cache and dashboard
+# feed; opened on first use so importing this module touches no database
+storage = None
+status_cache = None
+change_feed = None
+_open_lock = Lock()
+
+# writes go through the trader while it runs
+state_client = StateClient('../' + ct.STATE_SOCKET)
+
+STATUS_COLORS = {'HOLD': '#e0d900', 'CANCELLED': '#f2780c', 'SOLD': '#6dba02'}
+
+
+class StatusCache(object):
+    """
+    Status page data, HTML and JSON built once per change of the stored
+    tables; requests in between only check the tables' versions.
+    """
+    def __init__(self, storage: 'JsonStorage | SqliteStorage'):
+        self.__storage = storage
+        self.__lock = Lock()
+        # versions of the tables the cached data was read from
+        self.__version = None
+        self.__model = None
+        self.__html = None
+        self.__json = None
+        self.__etag = None
+        self.renders = 0
+
+    def __current_version(self) -> tuple:
+        return tuple(self.__storage.version(table) for table in TABLES)
+
+    def __refresh(self) -> None:
+        # caller holds self.__lock
+        version = self.__current_version()
+        if version == self.__version:
+            return
+
+        self.__model = build_status(self.__storage.read('wallet'), self.__storage.read('portfolio'), self.__storage.read('watchlist'))
+        self.__html = None
+        self.__json = None
+        self.__etag = hashlib.md5(repr(version).encode()).hexdigest()
+        # a table changed while we read it: serve what we got but read again next time
+        self.__version = version if self.__current_version() == version else None
+
+    def html(self) -> (str, str):
+        """
+        Returns etag and rendered status page.
+        """
+        self.__lock.acquire()
+        try:
+            self.__refresh()
+            if self.__html is None:
+                self.__html = render_template('status.html', **self.__model)
+                self.renders += 1
+            return self.__etag, self.__html
+        finally:
+            self.__lock.release()
+
+    def json(self) -> (str, str):
+        """
+        Returns etag and compact json summary.
+        """
+        self.__lock.acquire()
+        try:
+            self.__refresh()
+            if self.__json is None:
+                model = self.__model
+                self.__json = json.dumps({
+                    'portfolio': [{'ticker': e['ticker'], 'shares': e['shares'], 'stake': e['stake'], 'status': e['status']} for e in model['portfolio']],
+                    'watchlist': [{'uuid': e['uuid'], 'ticker': e['ticker'], 'kind': e['kind'], 'threshold': e['threshold']} for e in model['watchlist']],
+                    'wallet': model['wallet'][0] if len(model['wallet']) > 0 else None,
+                    'profit': model['profit'],
+                }, separators=(',', ':'))
+            return self.__etag, self.__json
+        finally:
+            self.__lock.release()
+
+
+def watchlist_entry(row: dict) -> dict:
+    """
+    Returns status page row of a watchlist rule. Only take-profit and
+    stop-loss thresholds can be edited; an expiry rule's is a time.
+    """
+    kind = rule_kind(row)
+    entry = {'uuid': row['uuid'], 'ticker': row['ticker'], 'kind': kind, 'threshold': round(row['threshold'], 4), 'editable': kind in EDITABLE_KINDS}
+    if kind == EXPIRY:
+        entry['threshold'] = row['threshold']
+        entry['deadline'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['threshold']))
+    elif kind == TRAILING:
+        entry['trail'] = row['trail']
+    return entry
+
+
+def build_status(wallet: list, portfolio: list, watchlist: list) -> dict:
+    """
+    Returns status page template context.
+    """
+    profit = 0.0
+    positions = []
+    for entry in portfolio:
+        share_no = entry['shares']
+        stake = entry['stake']
+
+        if share_no > 0:
+            status = 'HOLD'
+        elif int(share_no) == 0 and int(stake) == 0:
+            status = 'CANCELLED'
+        else:
+            profit += -stake
+            status = 'SOLD'
+
+        avg_price = 'N/A' if share_no == 0 else round(stake/share_no, 5)
+        positions.append({'ticker': entry['ticker'], 'avg_price': avg_price, 'stake': round(stake, 4), 'shares': share_no, 'status': status})
+
+    return {
+        'portfolio': positions,
+        'watchlist': [watchlist_entry(entry) for entry in watchlist],
+        'wallet': [{'in': round(entry['in'], 4), 'out': round(entry['out'], 4)} for entry in wallet],
+        'profit': profit,
+        'status_colors': STATUS_COLORS,
+        'currency': ct.CURRENCY_SYMBOL,
+        'config': {'max_ticker_price': ct.MAX_TICKER_PRICE, 'buy_amount': ct.DEFAULT_CURRENCY_BUY_AMOUNT, 'sell_thresh': ct.SELL_THRESH_MULTIPLIER},
+    }
+
+
+def get_storage() -> 'JsonStorage | SqliteStorage':
+    """
+    Returns storage of ../db, opened on the first call.
+    """
+    global storage
+    if storage is None:
+        _open_lock.acquire()
+        try:
+            if storage is None:
+                storage = open_storage(ct.STORAGE_BACKEND, '../db')
+        finally:
+            _open_lock.release()
+    return storage
+
+
+def get_status_cache() -> StatusCache:
+    global status_cache
+    if status_cache is None:
+        backend = get_storage()
+        _open_lock.acquire()
+        try:
+            if status_cache is None:
+                status_cache = StatusCache(backend)
+        finally:
+            _open_lock.release()
+    return status_cache
+
+
+def get_change_feed() -> ChangeFeed:
+    """
+    Returns the one watcher shared by all dashboard clients.
+    """
+    global change_feed
+    if change_feed is None:
+        backend = get_storage()
+        _open_lock.acquire()
+        try:
+            if change_feed is None:
+                change_feed = ChangeFeed(backend, ct.FEED_POLL_PERIOD, ct.FEED_CLIENT_BUFFER)
+        finally:
+            _open_lock.release()
+    return change_feed
+
+
+def cached_response(etag: str, body: str, mimetype: str) -> Response:
+    """
+    Returns body, or 304 if the client already has this version.
+    """
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    # let browsers keep the page but ask every time whether it changed
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 MANAGE_PW = 'larryhadsex'
 
@@ -74,7 +255,11 @@ def manage_post():
     # make sure budget is within valid range
     if not (new_budget < 0 or new_budget > 99999):
         # update wallet
-        wallet_table.update({'in': new_budget})
+        try:
+            state_client.set_wallet('in', new_budget)
+        except ConnectionError:
+            # trader is down: nobody else writes, it picks this up on start
+            get_storage().set_wallet('in', new_budget)
         # great success
         return f'<p><img src={url_for("static", filename="success.jpg")}/></p><p><a href="/status">Take me back to the status page</a>'
     else:
@@ -85,11 +270,22 @@ def manage_post():
 def update_config():
     request.form = dict(request.form)
 
+    # the form posts every editable rule: only move the ones whose value changed
+    shown = {row['uuid']: watchlist_entry(row)['threshold'] for row in get_storage().read('watchlist')}
     for k in request.form:
-        if '_st' in k:
-            ticker = k.split('_st')[0]
-            print(f'updating {ticker} to {request.form[k]}')
-            watchlist_table.update({"threshold": float(request.form[k])}, Query().ticker == ticker)
+        if '_st_' in k:
+            ticker, identifier = k.split('_st_', 1)
+            threshold = float(request.form[k])
+            if shown.get(identifier) == threshold:
+                continue
+            print(f'updating {ticker} rule {identifier} to {threshold}')
+            try:
+                moved = state_client.set_threshold(ticker, identifier, threshold)
+            except ConnectionError:
+                # trader is down: nobody else writes, it picks this up on start
+                moved = get_storage().set_threshold(ticker, identifier, threshold)
+            if not moved:
+                print(f'rule {identifier} of {ticker} is gone or can\'t be edited')
 
     print(f'got the following: {request.form}')
     return 'Success. <a href="javascript:history.back()">Go Back?</a>'
@@ -97,63 +293,33 @@ def update_config():
 @app.route('/status')
 @requires_auth
 def status():
-    result = ''
-    profit = 0.0
+    etag, html = get_status_cache().html()
+    return cached_response(etag, html, 'text/html')
 
-    result += '<style>table, td { border: 1px solid black; border-collapse: collapse;}</style>'
-    # define parent table
-    result += '<table style="border: 0;">'
-    # add first entry
-    result += '<tr><td style="border: 0;">'
-    result += '<h2>Portfolio: </br></h2>'
-    result += '<table >'
-    result += '<tr><td>Ticker</td><td>Avg price</td><td>Stake</td><td>Share #</td><td>Status</td></tr>'
-
-    # cycle over portfolio
-    for entry in portfolio_table:
-        share_no = entry['shares']
-        stake = entry['stake']
-        ticker = entry['ticker']
+@app.route('/status.json')
+@requires_auth
+def status_json():
+    etag, body = get_status_cache().json()
+    return cached_response(etag, body, 'application/json')
 
-        if share_no > 0:
-            status = '<td style="background-color:#e0d900">HOLD</td>'
-        elif int(share_no) == 0 and int(stake) == 0:
-            status = '<td style="background-color:#f2780c">CANCELLED</td>'
-        else:
-            profit += -stake 
-            status = '<td style="background-color:#6dba02">SOLD</td>'
-        avg_price = 'N/A' if share_no == 0 else round(stake/share_no, 5)
-        info = f'<td>{avg_price}</td><td>{round(stake, 4)}</td><td>{share_no}</td>{status}'
-        result += f'<tr><td>{ticker}</td>{info}</tr>'
-    result += '</table>'
-    # end parent table column, start new one
-    result += '</td><td style="vertical-align:top; border: 0; padding-left: 20px;">'
-    result += '<h2>Watchlist: </br></h2>'
-    result += '<form method="POST">'
-    result += '<table>'
-    result += '<tr><td>Ticker</td><td>Sell at</td><td></td></tr>'
-    for entry in watchlist_table:
-        result += f'<tr><td>{entry["ticker"]}</td><td><input type="text" name={entry["ticker"]}_st value="{round(entry["threshold"], 4)}" size=8></td><td><input type="submit" value="update"/></td></tr>'
-    result += '</table>'
-    result += '</form>'
-    # close off parent table
-    result += '</td></tr></table>'
-
-    result += '<h2>Wallet: </br></h2>'
-    result += '<form action="/manage" method="POST">'
-    for entry in wallet_table:
-        result += f'Available to invest: <input type="text" name="new_budget" value={round(entry["in"], 4)} {ct.CURRENCY_SYMBOL} size=5/>USD</br>'
-        result += f'Actual total profit: {profit} {ct.CURRENCY_SYMBOL}</br>'
-        result += f'Estimated profit (from 02/02): {round(entry["out"], 4)} {ct.CURRENCY_SYMBOL}</br>'
-        result += '</br>'
-
-    result += '<input type="submit" value="update"/>'
-    result += '</form>'
-    result += '<h2>Config: </br></h2>'
-    result += f'Max ticker price: {ct.MAX_TICKER_PRICE} {ct.CURRENCY_SYMBOL}</br>'
-    result += f'Buy increments: {ct.DEFAULT_CURRENCY_BUY_AMOUNT} {ct.CURRENCY_SYMBOL}</br>'
-    result += f'Sell threshold: {ct.SELL_THRESH_MULTIPLIER}x purchase price</br>'
-    return result
+@app.route('/dashboard')
+@requires_auth
+def dashboard():
+    return render_template('dashboard.html')
+
+@app.route('/events')
+@requires_auth
+def events():
+    """
+    Streams a snapshot followed by portfolio, watchlist & wallet diffs.
+    """
+    feed = get_change_feed()
+    subscription = feed.subscribe()
+    response = Response(feed.stream(subscription, ct.FEED_KEEPALIVE), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 if __name__ == '__main__':
+    get_change_feed().start()
     app.run(debug=True, host='0.0.0.0', port=80)